@@ -0,0 +1,309 @@
+###############################################################################
+# This script benchmarks the hot paths of controller.py through the Flask test
+# client, against a synthetic dataset (see DBSynthetic.py).
+#
+# Each scenario is requested --iterations times with ids drawn from a seeded
+# generator, and reports its p50/p95/p99 latency, the number of SQL
+# statements per request and the memory allocated at the peak of a request.
+# Results are written as JSON (--output); benchmarks/ keeps the baselines, so
+# a change in queries per request shows up in the diff of a PR. --compare
+# checks a run against a baseline and exits with 1 on a regression.
+#
+#   python Benchmark.py --scale 10k --compare benchmarks/sqlite-10k.json
+#   python Benchmark.py --db postgresql://... --scale 100k --output result.json
+#
+# By default a new sqlite DB is generated in a temporary directory for every
+# run. A DB given with --db is migrated, and filled with the dataset only if
+# it has no users.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+# number of requests of a scenario measured for allocations, tracing slows requests down
+ALLOCATION_SAMPLES = 20
+
+# relative increase of p95 latency reported as a regression by --compare
+LATENCY_TOLERANCE = 0.25
+
+# number of ids of each kind the scenarios draw from
+_SAMPLE_SIZE = 1000
+
+
+def _percentile(values: list, percent: float) -> float:
+    # nearest-rank percentile of sorted values
+    return values[max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))]
+
+
+def dataset_ids(seed: int) -> dict:
+    """
+    Pick the users, resources, channels, posts and comments the scenarios request
+
+    Only public items are picked, so that every request is answered with the
+    item rather than a redirect or an error.
+
+    :param seed: The seed of the picks
+    :return dict of kind -> list of ids, and "email" of the user the logged in
+            scenarios run as
+    """
+    from DBFunc import Session
+    from DBStructure import User, Resource, Channel, ChannelPost, PostComment, Tag, ChannelVisibility
+
+    with Session() as conn:
+        public_channels = conn.query(Channel.cid).filter(Channel.visibility == ChannelVisibility.PUBLIC)
+        ids = {
+            "uid": [uid for uid, in conn.query(User.uid).order_by(User.uid).limit(_SAMPLE_SIZE)],
+            "rid": [rid for rid, in conn.query(Resource.rid).filter(Resource.is_public).
+                    order_by(Resource.rid).limit(_SAMPLE_SIZE)],
+            "cid": [cid for cid, in public_channels.order_by(Channel.cid).limit(_SAMPLE_SIZE)],
+            "post": [tuple(row) for row in conn.query(ChannelPost.cid, ChannelPost.post_id).
+                     filter(ChannelPost.cid.in_(public_channels.subquery())).
+                     order_by(ChannelPost.post_id).limit(_SAMPLE_SIZE)],
+            "comment": [comment_id for comment_id, in conn.query(PostComment.post_comment_id).
+                        join(ChannelPost, ChannelPost.post_id == PostComment.post_id).
+                        filter(ChannelPost.cid.in_(public_channels.subquery())).
+                        order_by(PostComment.post_comment_id).limit(_SAMPLE_SIZE)],
+            "tag": [name for name, in conn.query(Tag.tag_name).order_by(Tag.tag_id).limit(_SAMPLE_SIZE)],
+        }
+        if not ids["uid"]:
+            raise ValueError("the DB has no users, load a dataset first")
+        uid = random.Random(seed).choice(ids["uid"])
+        ids["user"] = uid
+        ids["email"] = conn.query(User.email).filter_by(uid=uid).scalar()
+    return ids
+
+
+def scenarios(ids: dict) -> list:
+    """
+    Returns the requests benchmarked
+
+    :param ids: The ids to request, see dataset_ids()
+    :return list of (name, logged in, function of a random.Random -> url)
+    """
+    uid = ids["user"]
+
+    def pick(kind):
+        return lambda rng: rng.choice(ids[kind]) if ids[kind] else 0
+
+    rid, cid, post, comment, tag, other = pick("rid"), pick("cid"), pick("post"), pick("comment"), \
+        pick("tag"), pick("uid")
+
+    def post_url(rng):
+        channel, post_id = post(rng) or (0, 0)
+        return f"/channel/{channel}/post/{post_id}"
+
+    return [
+        ("homeAJAX anonymous", False, lambda rng: "/AJAX/homeAJAX"),
+        ("homeAJAX", True, lambda rng: "/AJAX/homeAJAX"),
+        ("resourceAJAX", False, lambda rng: "/AJAX/resourceAJAX?limit=20"),
+        ("resourceAJAX newest", True, lambda rng: "/AJAX/resourceAJAX?sort=newest&limit=20"),
+        ("resourceAJAX upvotes tag", True, lambda rng: f"/AJAX/resourceAJAX?sort=upvotes&limit=20&tags[]={tag(rng)}"),
+        ("resourceAJAX trending", True, lambda rng: "/AJAX/resourceAJAX?sort=trending&limit=20"),
+        ("resourceAJAX title search", True, lambda rng: f"/AJAX/resourceAJAX?title={rng.choice(['the', 'with', 'red', 'boy'])}&limit=20"),
+        ("search_channel", False, lambda rng: "/search/channel?uid=-1&is_public=true"),
+        ("search_channel newest", True, lambda rng: f"/search/channel?uid={uid}&sort_by_date=newest&is_public=true"),
+        ("search_channel private", True, lambda rng: f"/search/channel?uid={uid}&is_public=false"),
+        ("search_channel_post newest", True, lambda rng: f"/search/channel/{cid(rng)}/post?sort_algo=newest"),
+        ("search_channel_post trending", True, lambda rng: f"/search/channel/{cid(rng)}/post?sort_algo=trending"),
+        ("view_channel_post", True, post_url),
+        ("resourceComment", True, lambda rng: f"/AJAX/resourceComment?rid={rid(rng)}"),
+        ("load_studio_contents resource", True,
+         lambda rng: f"/profile/studio_contents?uid={other(rng)}&load_type=resource&create_or_access=create"),
+        ("load_studio_contents channel", True,
+         lambda rng: f"/profile/studio_contents?uid={other(rng)}&load_type=channel&create_or_access=access"),
+        ("resourceVote", True, lambda rng: f"/AJAX/resourceVote?rid={rid(rng)}&up={rng.randint(0, 1)}&down=0"),
+        ("vote channel post", True,
+         lambda rng: f"/AJAX/channel/post/vote?uid={uid}&id={(post(rng) or (0, 0))[1]}"
+                     f"&upvote={rng.choice(['true', 'false'])}&post_or_comment=post"),
+        ("vote post comment", True,
+         lambda rng: f"/AJAX/channel/post/vote?uid={uid}&id={comment(rng)}"
+                     f"&upvote={rng.choice(['true', 'false'])}&post_or_comment=comment"),
+    ]
+
+
+def run_benchmarks(seed: int = 0, iterations: int = 200, warmup: int = 5, only: str = None) -> dict:
+    """
+    Run every scenario against the DB of the shared engine
+
+    :param seed: The seed of the ids requested
+    :param iterations: The number of measured requests per scenario
+    :param warmup: The number of requests per scenario before measuring
+    :param only: Run only the scenarios whose name contains this
+    :return dict of scenario name -> dict of results
+    """
+    from sqlalchemy import event
+    from controller import app
+    from DBFunc import user_auth
+    from DBStructure import engine
+
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    ids = dataset_ids(seed)
+    anonymous, logged_in = app.test_client(), app.test_client()
+    # as the login page does
+    user_auth(ids["email"], True)
+    with logged_in.session_transaction() as session:
+        session["_user_id"] = ids["email"]
+        session["_fresh"] = True
+
+    results = {}
+    event.listen(engine, "before_cursor_execute", count_query)
+    try:
+        for name, login, url in scenarios(ids):
+            if only and only not in name:
+                continue
+            client = logged_in if login else anonymous
+            rng = random.Random(f"{seed}/{name}")
+            for _ in range(warmup):
+                client.get(url(rng))
+
+            latencies, counts, statuses = [], [], {}
+            for _ in range(iterations):
+                path = url(rng)
+                queries[0] = 0
+                start = time.perf_counter()
+                response = client.get(path)
+                latencies.append((time.perf_counter() - start) * 1000)
+                counts.append(queries[0])
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+            allocations = []
+            tracemalloc.start()
+            for _ in range(min(iterations, ALLOCATION_SAMPLES)):
+                path = url(rng)
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                client.get(path)
+                allocations.append(tracemalloc.get_traced_memory()[1] - before)
+            tracemalloc.stop()
+
+            latencies.sort()
+            results[name] = {
+                "p50_ms": round(_percentile(latencies, 50), 2),
+                "p95_ms": round(_percentile(latencies, 95), 2),
+                "p99_ms": round(_percentile(latencies, 99), 2),
+                "queries": round(sum(counts) / len(counts), 2),
+                "max_queries": max(counts),
+                "alloc_kib": round(sorted(allocations)[len(allocations) // 2] / 1024, 1),
+                "statuses": statuses,
+            }
+    finally:
+        event.remove(engine, "before_cursor_execute", count_query)
+    return results
+
+
+def compare(report: dict, baseline: dict, tolerance: float = LATENCY_TOLERANCE) -> list:
+    """
+    Compare a run against a baseline run with the same settings
+
+    :param report: The report of this run, as written by --output
+    :param baseline: The report of the baseline
+    :param tolerance: The relative increase of p95 latency tolerated
+    :return list of the regressions found, as readable lines
+    """
+    settings = ("dialect", "scale", "seed", "iterations")
+    meta = baseline["meta"]
+    if any(report["meta"][key] != meta[key] for key in settings):
+        # other ids are requested, queries per request cannot be compared
+        return [f"the baseline ran with {', '.join(f'{key}={meta[key]}' for key in settings)}"]
+    regressions = []
+    for name, result in report["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if result["queries"] > base["queries"]:
+            regressions.append(f"{name}: {base['queries']} -> {result['queries']} queries per request")
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']} -> {result['p95_ms']} ms")
+        if sorted(result["statuses"]) != sorted(base["statuses"]):
+            regressions.append(f"{name}: statuses {sorted(base['statuses'])} -> {sorted(result['statuses'])}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of controller.py")
+    parser.add_argument("--db", help="URL of the DB to run against, default to a new sqlite DB")
+    parser.add_argument("--scale", default="10k", help="Size of the dataset generated, see SYNTHETIC_SCALES")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dataset and of the requests")
+    parser.add_argument("--iterations", type=int, default=200, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="Requests per scenario before measuring")
+    parser.add_argument("--only", help="Run only the scenarios whose name contains this")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to check the results against")
+    parser.add_argument("--tolerance", type=float, default=LATENCY_TOLERANCE,
+                        help="Relative increase of p95 latency tolerated by --compare")
+    args = parser.parse_args()
+
+    directory = None
+    if args.db is None:
+        directory = tempfile.mkdtemp(prefix="doctrina-benchmark-")
+        args.db = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+    # the engine is created from these when DBStructure is first imported
+    os.environ["DOCTRINA_DBPATH"] = args.db
+    # measure the work of the anonymous scenarios rather than the response cache
+    os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+    warnings.simplefilter("ignore")
+    # DBProfile logs every request with an N+1 pattern, writing them to stderr would be measured too
+    logging.getLogger("doctrina.queries").setLevel(logging.ERROR)
+
+    import sqlalchemy
+    from DBMigration import migrate
+    from DBStructure import engine, User
+    from DBFunc import Session
+    from DBSynthetic import synthetic_data, load_synthetic
+
+    try:
+        migrate()
+        with Session() as conn:
+            empty = conn.query(User.uid).first() is None
+        if empty:
+            start = time.perf_counter()
+            load_synthetic(synthetic_data(args.scale, args.seed))
+            print(f"loaded the {args.scale} dataset in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+        results = run_benchmarks(args.seed, args.iterations, args.warmup, args.only)
+    finally:
+        engine.dispose()
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for name, result in results.items():
+        print(f"{name:36s} p50 {result['p50_ms']:8.2f}  p95 {result['p95_ms']:8.2f}  p99 {result['p99_ms']:8.2f} ms"
+              f"  {result['queries']:6.2f} queries  {result['alloc_kib']:8.1f} KiB")
+
+    report = {
+        "meta": {"dialect": engine.dialect.name, "scale": args.scale, "seed": args.seed,
+                 "iterations": args.iterations, "python": platform.python_version(),
+                 "sqlalchemy": sqlalchemy.__version__},
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=1, sort_keys=True)
+            fp.write("\n")
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(report, json.load(fp), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+###############################################################################
+# This file provides the bulk import and export of every table in
+# DBStructure.py, as JSONL or CSV files named after their table
+# (user.jsonl, resource.csv, ...).
+#
+# Rows are loaded in batches of BULK_BATCH_SIZE, each in a transaction of its
+# own: on postgres with COPY, on other DBs with one executemany INSERT. Before
+# a batch is written, its foreign keys are checked against the DB with one
+# query per referenced table, and rows pointing at missing rows are rejected
+# (and reported) instead of failing the whole batch.
+#
+# Files hold the columns of the DB as they are stored: enums by name, dates in
+# ISO 8601. In CSV files a NULL is written as \N. The tables derived from the
+# others (recommendation candidates, trending scores, cache versions) are not
+# imported or exported, they are rebuilt once all files are loaded.
+#
+# Use `flask import-data` and `flask export-data` from the command line.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import csv
+import datetime
+import decimal
+import enum
+import io
+import json
+import os
+
+from sqlalchemy import select, text, Integer, Numeric, Boolean, DateTime, Enum, String
+from sqlalchemy.exc import SQLAlchemyError
+
+from DBFunc import rebuild_recommendations, rebuild_trending, rebuild_channel_stats, rebuild_post_stats, \
+    DATA_KINDS, DATA_VERSION_PREFIX
+from DBStructure import Base, engine, CacheVersion, RecommendationCandidate, TrendingScore, ChannelStats, \
+    PostStats
+
+# number of rows written per transaction
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 10000))
+
+# file formats, by file extension
+BULK_FORMATS = ("jsonl", "csv")
+
+# how a NULL is written in CSV files, an empty field is an empty string
+CSV_NULL = "\\N"
+
+# tables rebuilt from the others after an import instead of being imported
+DERIVED_TABLES = (CacheVersion.__tablename__, RecommendationCandidate.__tablename__,
+                  TrendingScore.__tablename__, ChannelStats.__tablename__, PostStats.__tablename__)
+
+# every imported table, referenced tables before the tables referencing them
+BULK_TABLES = [table for table in Base.metadata.sorted_tables if table.name not in DERIVED_TABLES]
+
+# number of ids per statement when checking foreign keys
+_LOOKUP_CHUNK_SIZE = 500
+
+# number of rejected rows described in a report, the others are only counted
+_MAX_REPORTED_ERRORS = 10
+
+
+def bulk_table(name: str):
+    """
+    Returns the table a bulk file is loaded into
+
+    :param name: The name of the table, or the path of a file named after it
+    :return the Table, None if no imported table has this name
+    """
+    name = os.path.basename(name).split(".")[0]
+    for table in BULK_TABLES:
+        if table.name == name:
+            return table
+    return None
+
+
+def file_format(path: str) -> str:
+    """
+    Returns the format of a bulk file from its extension
+
+    :param path: The path of the file
+    :return one of BULK_FORMATS, None if the extension is not one of them
+    """
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    return extension if extension in BULK_FORMATS else None
+
+
+def read_rows(path: str):
+    """
+    Iterate over the rows of a bulk file
+
+    :param path: The path of a .jsonl or .csv file
+    :return generator of dicts of column name -> value as read from the file
+    """
+    with open(path, "r", newline="", encoding="utf-8") as fp:
+        if file_format(path) == "csv":
+            for row in csv.DictReader(fp):
+                yield {name: None if value == CSV_NULL else value for name, value in row.items()}
+        else:
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _coerce(column, value):
+    # value read from a file -> value of the column, raises ValueError or KeyError
+    if value is None:
+        return None
+    column_type = column.type
+    if isinstance(column_type, Enum):
+        # before String, which Enum derives from
+        return value if isinstance(value, enum.Enum) else column_type.enum_class[value]
+    if value == "" and not isinstance(column_type, String):
+        # empty CSV field of a number, date or boolean
+        return None
+    if isinstance(column_type, Boolean):
+        if isinstance(value, str):
+            if value.lower() in ("1", "true", "t", "yes"):
+                return True
+            if value.lower() in ("0", "false", "f", "no"):
+                return False
+            raise ValueError(f"{value!r} is not a boolean")
+        return bool(value)
+    if isinstance(column_type, DateTime):
+        return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+    if isinstance(column_type, Integer):
+        return int(value)
+    if isinstance(column_type, Numeric):
+        return decimal.Decimal(str(value))
+    return str(value)
+
+
+def _serial_column(table):
+    # the single integer primary key filled in by the DB, if any
+    keys = list(table.primary_key.columns)
+    if len(keys) == 1 and isinstance(keys[0].type, Integer) and keys[0].autoincrement in (True, "auto") \
+            and not keys[0].foreign_keys:
+        return keys[0]
+    return None
+
+
+def _prepare(table, raw: dict) -> dict:
+    """
+    Turn a row read from a file into the values to insert, default values are
+    filled in for missing columns
+
+    :param table: The table of the row
+    :param raw: The row as read by read_rows()
+    :return dict of column name -> value, raises ValueError if the row is invalid
+    """
+    unknown = set(raw) - set(table.columns.keys())
+    if unknown:
+        raise ValueError(f"unknown columns {', '.join(sorted(unknown))}")
+    serial = _serial_column(table)
+    row = {}
+    for column in table.columns:
+        if raw.get(column.name) is not None:
+            try:
+                row[column.name] = _coerce(column, raw[column.name])
+            except (ValueError, KeyError, decimal.InvalidOperation):
+                expected = column.type.enum_class if isinstance(column.type, Enum) else column.type.python_type
+                raise ValueError(f"{column.name}={raw[column.name]!r} is not a valid {expected.__name__}")
+        elif column is serial:
+            # numbered by the DB
+            continue
+        elif column.default is not None and column.default.is_scalar:
+            row[column.name] = column.default.arg
+        elif not column.nullable:
+            raise ValueError(f"{column.name} is missing")
+        else:
+            row[column.name] = None
+    return row
+
+
+def _check_foreign_keys(conn, table, rows: list, known: dict) -> list:
+    """
+    Split a batch into the rows whose foreign keys all exist and the others
+
+    :param conn: The connection to look the referenced rows up with
+    :param table: The table of the rows
+    :param rows: The prepared rows
+    :param known: Referenced column -> set of values known to exist, shared by
+                  the batches of an import to look each value up only once
+    :return list of (row, error) of the rejected rows, the valid rows are left in rows
+    """
+    rejected = []
+    for column in table.columns:
+        for foreign_key in column.foreign_keys:
+            target = foreign_key.column
+            found = known.setdefault(target, set())
+            missing = list({row[column.name] for row in rows if row.get(column.name) is not None} - found)
+            for i in range(0, len(missing), _LOOKUP_CHUNK_SIZE):
+                chunk = missing[i:i + _LOOKUP_CHUNK_SIZE]
+                found.update(conn.execute(select(target).where(target.in_(chunk))).scalars())
+            valid = []
+            for row in rows:
+                value = row.get(column.name)
+                if value is None or value in found:
+                    valid.append(row)
+                else:
+                    rejected.append((row, f"{column.name}={value} is not in {target.table.name}"))
+            rows[:] = valid
+    return rejected
+
+
+def _copy_value(value) -> str:
+    # value -> field of postgres COPY text format
+    if value is None:
+        return "\\N"
+    if isinstance(value, enum.Enum):
+        value = value.name
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy_rows(conn, table, columns: list, rows: list) -> bool:
+    """
+    Write rows with postgres COPY
+
+    :return False if the driver cannot COPY, nothing is written then
+    """
+    cursor = conn.connection.cursor()
+    if not hasattr(cursor, "copy_expert"):
+        cursor.close()
+        return False
+    data = io.StringIO()
+    for row in rows:
+        data.write("\t".join(_copy_value(row[name]) for name in columns))
+        data.write("\n")
+    data.seek(0)
+    names = ", ".join(conn.dialect.identifier_preparer.quote(name) for name in columns)
+    try:
+        cursor.copy_expert(f"COPY {conn.dialect.identifier_preparer.format_table(table)} ({names}) "
+                           f"FROM STDIN", data)
+    finally:
+        cursor.close()
+    return True
+
+
+def _write_batch(conn, table, rows: list):
+    # rows with and without their serial id are written apart, each set of rows
+    # must have the same columns
+    serial = _serial_column(table)
+    groups = {}
+    for row in rows:
+        groups.setdefault(serial is not None and serial.name in row, []).append(row)
+    for group in groups.values():
+        columns = list(group[0])
+        if conn.dialect.name == "postgresql" and _copy_rows(conn, table, columns, group):
+            continue
+        conn.execute(table.insert(), group)
+
+
+def _reset_sequence(conn, table):
+    # after rows were imported with their ids, the next id postgres hands out
+    # must come after them
+    serial = _serial_column(table)
+    if conn.dialect.name != "postgresql" or serial is None:
+        return
+    name = conn.dialect.identifier_preparer.format_table(table)
+    conn.execute(text(f"SELECT setval(pg_get_serial_sequence(:table, :column), "
+                      f"COALESCE(MAX({serial.name}), 0) + 1, false) FROM {name}"),
+                 {"table": name, "column": serial.name})
+
+
+def import_rows(table, rows, bind=None, batch_size: int = BULK_BATCH_SIZE) -> dict:
+    """
+    Load rows into a table, in batches
+
+    Derived tables are not updated, call rebuild_derived() once all tables are
+    loaded.
+
+    :param table: The Table to load, see BULK_TABLES
+    :param rows: Iterable of dicts of column name -> value, as read by read_rows()
+    :param bind: The engine of the DB, default to the shared engine
+    :param batch_size: The number of rows per transaction
+    :return report dict with the table name, the number of "inserted" and
+            "rejected" rows and the "errors" of the first rejected rows
+    """
+    bind = bind or engine
+    report = {"table": table.name, "inserted": 0, "rejected": 0, "errors": []}
+    known = {}
+
+    def reject(line, error):
+        report["rejected"] += 1
+        if len(report["errors"]) < _MAX_REPORTED_ERRORS:
+            report["errors"].append(f"row {line}: {error}")
+
+    def write(batch, lines):
+        try:
+            with bind.begin() as conn:
+                for row, error in _check_foreign_keys(conn, table, batch, known):
+                    reject(lines[id(row)], error)
+                if batch:
+                    _write_batch(conn, table, batch)
+        except SQLAlchemyError as e:
+            # the whole batch is rolled back, e.g. on a duplicate primary key
+            for row in batch:
+                reject(lines[id(row)], str(e.orig if hasattr(e, "orig") else e).splitlines()[0])
+            return
+        report["inserted"] += len(batch)
+
+    batch, lines = [], {}
+    for line, raw in enumerate(rows, start=1):
+        try:
+            row = _prepare(table, raw)
+        except ValueError as e:
+            reject(line, e)
+            continue
+        batch.append(row)
+        lines[id(row)] = line
+        if len(batch) >= batch_size:
+            write(batch, lines)
+            batch, lines = [], {}
+    if batch:
+        write(batch, lines)
+    with bind.begin() as conn:
+        _reset_sequence(conn, table)
+    return report
+
+
+def import_files(paths: list, bind=None, batch_size: int = BULK_BATCH_SIZE, rebuild: bool = True) -> list:
+    """
+    Load bulk files, each into the table it is named after
+
+    Files are loaded in the order of BULK_TABLES, so that the rows they
+    reference are loaded first.
+
+    :param paths: The paths of .jsonl and .csv files, or directories of them
+    :param bind: The engine of the DB, default to the shared engine
+    :param batch_size: The number of rows per transaction
+    :param rebuild: Whether to rebuild the derived tables afterwards
+    :return list of reports of import_rows(), one per file, files which are not
+            named after a table get a report with an error and no table
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if file_format(name))
+        else:
+            files.append(path)
+    order = {table.name: i for i, table in enumerate(BULK_TABLES)}
+    reports = [{"table": None, "file": path, "inserted": 0, "rejected": 0,
+                "errors": ["not a .jsonl or .csv file named after a table"]}
+               for path in files if not file_format(path) or bulk_table(path) is None]
+    files = sorted((path for path in files if file_format(path) and bulk_table(path) is not None),
+                   key=lambda path: order[bulk_table(path).name])
+    for path in files:
+        report = import_rows(bulk_table(path), read_rows(path), bind, batch_size)
+        report["file"] = path
+        reports.append(report)
+    if rebuild and files:
+        rebuild_derived(bind)
+    return reports
+
+
+def rebuild_derived(bind=None):
+    """
+    Recompute the tables derived from the others and make every process reload
+    its in-memory copy of the tags, its cached responses and listing ETags,
+    after rows were written behind their back
+
+    :param bind: The engine of the DB, default to the shared engine
+    """
+    with (bind or engine).begin() as conn:
+        rebuild_recommendations(conn)
+        rebuild_trending(conn)
+        rebuild_channel_stats(conn)
+        rebuild_post_stats(conn)
+        versions = CacheVersion.__table__
+        # the tags, the cached responses of anonymous users and every listing are stale
+        for name in ("tags", "responses") + tuple(DATA_VERSION_PREFIX + kind for kind in DATA_KINDS):
+            if not conn.execute(versions.update().where(versions.c.name == name).
+                                values(version=versions.c.version + 1)).rowcount:
+                conn.execute(versions.insert().values(name=name, version=1))
+
+
+def _dump_value(value, csv_format: bool):
+    # value of a column -> value written to a file
+    if value is None:
+        return CSV_NULL if csv_format else None
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, bool) and csv_format:
+        return "true" if value else "false"
+    return value
+
+
+def write_rows(table, rows, path: str) -> int:
+    """
+    Write rows to a bulk file, which import_files() loads back
+
+    :param table: The Table of the rows
+    :param rows: Iterable of dicts of column name -> value, missing columns are written as NULL
+    :param path: The path of the file, its extension sets the format
+    :return the number of rows written
+    """
+    csv_format = file_format(path) == "csv"
+    names = [column.name for column in table.columns]
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as fp:
+        writer = csv.writer(fp) if csv_format else None
+        if writer:
+            writer.writerow(names)
+        for row in rows:
+            values = [_dump_value(row.get(name), csv_format) for name in names]
+            if writer:
+                writer.writerow(values)
+            else:
+                fp.write(json.dumps(dict(zip(names, values)), ensure_ascii=False))
+                fp.write("\n")
+            count += 1
+    return count
+
+
+def export_table(table, path: str, bind=None, batch_size: int = BULK_BATCH_SIZE) -> int:
+    """
+    Write every row of a table to a bulk file, in primary key order
+
+    :param table: The Table to export, see BULK_TABLES
+    :param path: The path of the file, its extension sets the format
+    :param bind: The engine of the DB, default to the shared engine
+    :param batch_size: The number of rows fetched at a time
+    :return the number of rows written
+    """
+    with (bind or engine).connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size). \
+            execute(select(table).order_by(*table.primary_key.columns))
+        return write_rows(table, (row._mapping for row in result), path)
+
+
+def export_tables(directory: str, file_type: str = "jsonl", tables: list = None, bind=None,
+                  batch_size: int = BULK_BATCH_SIZE) -> dict:
+    """
+    Write tables to bulk files named after them, which import_files() loads back
+
+    :param directory: The directory of the files, created if missing
+    :param file_type: One of BULK_FORMATS
+    :param tables: The names of the tables to export, default to every table of BULK_TABLES
+    :param bind: The engine of the DB, default to the shared engine
+    :param batch_size: The number of rows fetched at a time
+    :return dict of file path -> number of rows written
+    """
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table in BULK_TABLES:
+        if tables is None or table.name in tables:
+            path = os.path.join(directory, f"{table.name}.{file_type}")
+            counts[path] = export_table(table, path, bind, batch_size)
+    return counts
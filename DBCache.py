@@ -0,0 +1,196 @@
+###############################################################################
+# This file keeps the responses served to anonymous and demo users, who all
+# get the same response to the same request.
+#
+# A response is stored under a key made of its path, its query string, the
+# kind of user and the version of the data (DBFunc.get_response_version()).
+# Writes that change what these users see bump the version, which makes every
+# response cached before unreachable; they are dropped when they expire after
+# RESPONSE_CACHE_TTL seconds, or earlier when the least recently used
+# responses make room. Votes, views and comments do not bump the version, the
+# counts they change are at most RESPONSE_CACHE_TTL seconds old.
+#
+# Responses are kept in the memory of each process (MemoryBackend), or in a
+# Redis compatible server shared by all processes (RedisBackend) when
+# RESPONSE_CACHE_URL is set, e.g. redis://localhost:6379/0. That server evicts
+# according to its own maxmemory-policy, set it to allkeys-lru.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import warnings
+
+from DBMetrics import count_cache
+
+# whether the responses of anonymous and demo users are cached at all
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# seconds a response is served from the cache
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 10))
+# bytes of responses kept in the memory of each process
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# largest response cached, in bytes
+RESPONSE_CACHE_MAX_BODY = int(os.environ.get("RESPONSE_CACHE_MAX_BODY", 1024 * 1024))
+# URL of the Redis compatible server keeping the responses, in process memory if empty
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL", "")
+
+# prefix of the keys of the responses in a shared server
+_KEY_PREFIX = "doctrina:response:"
+
+# a cached response, etag is derived from its body
+CachedResponse = collections.namedtuple("CachedResponse", ["status", "headers", "body", "etag"])
+
+
+class MemoryBackend:
+    """
+    Responses kept in the memory of this process, least recently used first
+    out once they take more than max_bytes
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (expiry time, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: str):
+        """
+        :return the value stored under key, None if there is none or it expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                self._bytes -= len(self._entries.pop(key)[1])
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: int):
+        """
+        :param key: The key to store value under
+        :param value: The bytes to store
+        :param ttl: Seconds value is kept
+        """
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self):
+        """
+        Drop every value
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class RedisBackend:
+    """
+    Responses kept in a Redis compatible server shared by all processes
+
+    A server that cannot be reached is treated as an empty cache, so requests
+    are served from the DB rather than failing.
+    """
+
+    def __init__(self, url: str):
+        # only needed when a server is configured
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self._errors = (redis.RedisError, OSError)
+
+    def get(self, key: str):
+        try:
+            return self._client.get(_KEY_PREFIX + key)
+        except self._errors as e:
+            warnings.warn(f"response cache unavailable: {e}")
+            return None
+
+    def set(self, key: str, value: bytes, ttl: int):
+        try:
+            self._client.set(_KEY_PREFIX + key, value, ex=ttl)
+        except self._errors as e:
+            warnings.warn(f"response cache unavailable: {e}")
+
+    def clear(self):
+        try:
+            for key in self._client.scan_iter(_KEY_PREFIX + "*"):
+                self._client.delete(key)
+        except self._errors as e:
+            warnings.warn(f"response cache unavailable: {e}")
+
+
+def create_backend(url: str = RESPONSE_CACHE_URL):
+    """
+    Returns the backend keeping the responses
+
+    :param url: The URL of a Redis compatible server, in process memory if empty
+    """
+    if url:
+        return RedisBackend(url)
+    return MemoryBackend()
+
+
+# the backend of this process
+response_backend = create_backend() if RESPONSE_CACHE_ENABLED else None
+
+
+def response_key(path: str, args: list, user_class: str, version: int) -> str:
+    """
+    Returns the key a response is cached under
+
+    :param path: The path of the request
+    :param args: The [name, value] pairs of its query string
+    :param user_class: "anonymous" or "demo"
+    :param version: The version of the data, see DBFunc.get_response_version()
+    """
+    raw = json.dumps([path, sorted(args), user_class, version])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def get_response(key: str):
+    """
+    Returns the response cached under key
+
+    :return CachedResponse, None if no response is cached under key
+    """
+    value = response_backend.get(key) if response_backend is not None else None
+    count_cache("response", value is not None)
+    if value is None:
+        return None
+    # a JSON line with the status, headers and etag, then the body
+    meta, body = value.split(b"\n", 1)
+    status, headers, etag = json.loads(meta)
+    return CachedResponse(status, headers, body, etag)
+
+
+def store_response(key: str, status: int, headers: list, body: bytes):
+    """
+    Cache a response under key for RESPONSE_CACHE_TTL seconds
+
+    :param key: see response_key()
+    :param status: The HTTP status of the response
+    :param headers: The [name, value] pairs of its headers
+    :param body: The body of the response
+    :return the CachedResponse
+    """
+    cached = CachedResponse(status, headers, body, hashlib.sha1(body).hexdigest())
+    if response_backend is not None and len(body) <= RESPONSE_CACHE_MAX_BODY:
+        meta = json.dumps([status, headers, cached.etag]).encode()
+        response_backend.set(key, meta + b"\n" + body, RESPONSE_CACHE_TTL)
+    return cached
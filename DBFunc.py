@@ -5,14 +5,27 @@
 #
 # works of OfficialTeamName (con.d). All rights reserved.
 ##################################################################
+import base64
+import contextlib
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
 import traceback
 
 import sqlalchemy.exc
-from sqlalchemy import or_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import or_, and_, func, distinct, event, select, cast, true, literal, union_all, Float, \
+    bindparam, case, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import sessionmaker, scoped_session
 from werkzeug.security import generate_password_hash
-import random
+from collections import defaultdict, namedtuple
 from DBStructure import *
+from DBSearch import SEARCH_KINDS, query_terms, match_query
+from DBMetrics import db_writes, count_cache
 
 # define if you want method output messages for debugging
 VERBOSE = False
@@ -30,6 +43,8 @@ DEFAULT_PROFILE_BACKGROUND_LINK = "profile_background/default_background.jpg"
 DEFAULT_USER_AVATAR_LINK = "avatar/1.png"
 # link to default channel avatar
 DEFAULT_CHANNEL_AVATAR_LINK = "channel_avatar/logo_icon.png"
+# link to thumbnail shown for resources without one
+DEFAULT_RESOURCE_THUMBNAIL_LINK = "img/placeholder.png"
 
 
 class ErrorCode(enum.Enum):
@@ -63,12 +78,131 @@ class Modification(enum.Enum):
     MODIFY_DELETE = 1
 
 
-engine = create_engine(DBPATH)
-Session = sessionmaker(engine)
+class _JoinedSession:
+    """
+    Context manager handing out the request session to a DBFunc call
+
+    Unlike a session of its own, the request session is not closed on exit.
+    Whatever the outermost caller leaves uncommitted is rolled back instead,
+    just like closing a session of its own would discard it.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        self.session.info["depth"] = self.session.info.get("depth", 0) + 1
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        info = self.session.info
+        info["depth"] -= 1
+        if info["depth"] == 0 and (exc_type is not None or info.get("uncommitted") or
+                                   self.session.new or self.session.dirty or self.session.deleted):
+            self.session.rollback()
+        return False
+
+
+class _RequestSessionMaker(sessionmaker):
+    """
+    sessionmaker that joins the request session when one is open
+    """
+
+    def __call__(self, **local_kw):
+        if getattr(_request_state, "active", False):
+            return _JoinedSession(_request_session())
+        return super().__call__(**local_kw)
+
+
+# Session() opens a new session, or joins the request session if one is open
+Session = _RequestSessionMaker(engine)
+
+# the session shared by all DBFunc calls between begin_request_session() and
+# end_request_session() of the same thread
+_request_session = scoped_session(sessionmaker(engine))
+_request_state = threading.local()
+
+
+@event.listens_for(_request_session, "after_flush")
+def _mark_uncommitted(session, flush_context):
+    session.info["uncommitted"] = True
+
+
+@event.listens_for(_request_session, "after_commit")
+@event.listens_for(_request_session, "after_rollback")
+def _clear_uncommitted(session):
+    session.info.pop("uncommitted", None)
+
+
+def begin_request_session():
+    """
+    Let every following Session() call of this thread share one session,
+    i.e. one connection checkout and one identity map, until end_request_session()
+    """
+    _request_state.active = True
+
+
+def end_request_session():
+    """
+    Close the session opened by begin_request_session(), returning its connection to the pool
+    """
+    if getattr(_request_state, "active", False):
+        _request_state.active = False
+        _request_session.remove()
 
 # starting timestamp of UTC
 EPOCH = datetime.datetime.utcfromtimestamp(0)
 
+# number of rows read from the DB at a time when streaming a result set
+STREAM_BATCH_SIZE = 100
+
+# sort modes supported by find_resources()
+RESOURCE_SORT_MODES = ["natural", "newest", "upvotes", "trending"]
+
+# seconds an access set stays cached. Other processes drop theirs only when it
+# expires, so this bounds how long a removed member may still see private content
+ACCESS_CACHE_TTL = 30
+# number of users whose access set is cached before the cache is emptied
+ACCESS_CACHE_MAX_USERS = 10000
+
+# seconds between checks of the tag version in the DB, i.e. the longest a
+# process keeps serving tags after another process added one
+TAG_VERSION_CHECK_INTERVAL = 5
+
+# seconds between checks of the response version in the DB, i.e. the longest a
+# process keeps serving cached responses after another process changed the data
+RESPONSE_VERSION_CHECK_INTERVAL = float(os.environ.get("RESPONSE_VERSION_CHECK_INTERVAL", 2))
+
+# recommendation bucket every resource and public channel belongs to
+RECOMMEND_ALL_BUCKET = "all"
+
+# trending scores grow by one every TRENDING_DECAY_SECONDS of activity time and by
+# one for every tenfold of points, so an item needs ten times the points to trend
+# as high as one active TRENDING_DECAY_SECONDS later. See trending_score()
+TRENDING_DECAY_SECONDS = 45000
+TRENDING_EPOCH = datetime.datetime(2021, 1, 1, tzinfo=pytz.utc)
+# points of a view and of a comment, a net upvote is worth one point
+TRENDING_VIEW_WEIGHT = 0.25
+TRENDING_COMMENT_WEIGHT = 2
+# trending scores are stored as integers, in units of 1 / TRENDING_PRECISION
+TRENDING_PRECISION = 10 ** 6
+# number of items whose trending scores are recomputed together by rebuild_trending()
+# and, in a transaction of their own, by refresh_all_trending()
+TRENDING_REFRESH_BATCH = 1000
+# kind of item with a trending score -> its id column
+TRENDING_KEYS = {"resource": Resource.rid, "channel": Channel.cid, "post": ChannelPost.post_id}
+# sort key of items without a stored trending score (e.g. bulk loaded without a
+# rebuild), below any real score so they are listed last
+TRENDING_MISSING_SCORE = -2 ** 62
+# what trending listings sort by, see trending_join()
+TRENDING_SORT_SCORE = func.coalesce(TrendingScore.score, TRENDING_MISSING_SCORE)
+
+# default number of items of each kind returned by search()
+SEARCH_LIMIT = 20
+# upvotes needed for search() to boost the relevance of an item by half,
+# the boost approaches (but never reaches) double the relevance
+SEARCH_VOTE_SATURATION = 10
+
 
 def try_to_commit(trans):
     """
@@ -95,6 +229,354 @@ def try_to_commit(trans):
     return False
 
 
+def try_to_flush(trans):
+    """
+    Call flush for a transaction (i.e. conn), e.g. to get the primary key of
+    a new row before adding the rows referring to it, without committing
+
+    :param trans: The transaction to be flushed
+    :return: True if the pending changes are sent to the DB.
+            In case of error, if DEBUG_MODE is False, then let error raised
+            and program terminates itself. Otherwise, show error message as a
+            warning and rollback this transaction
+    """
+    if DEBUG_MODE:
+        trans.flush()
+        return True
+
+    try:
+        trans.flush()
+        return True
+    except sqlalchemy.exc.SQLAlchemyError:
+        warnings.warn(traceback.format_exc())
+        trans.rollback()
+        warnings.warn("Transaction is roll-backed")
+    return False
+
+
+def encode_cursor(mode: str, values: list) -> str:
+    """
+    Encode the sort key of the last row of a page as an opaque cursor
+
+    :param mode: The sort mode the page was produced with
+    :param values: The values of the sort columns of the last row
+    :return The cursor string (url safe)
+    """
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    raw = json.dumps([mode] + values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, mode: str, columns: list):
+    """
+    Decode a cursor created by encode_cursor()
+
+    :param cursor: The cursor string
+    :param mode: The sort mode the next page is requested with
+    :param columns: The sort columns of that mode
+    :return The list of sort column values on success.
+            None if the cursor is malformed or was created for another sort mode
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(columns) + 1 or values[0] != mode:
+        return None
+
+    out = []
+    for column, value in zip(columns, values[1:]):
+        if isinstance(column.type, DateTime):
+            try:
+                value = datetime.datetime.fromisoformat(value)
+            except (ValueError, TypeError):
+                return None
+        elif not isinstance(value, int) or isinstance(value, bool):
+            # all the other sort columns are integers
+            return None
+        out.append(value)
+    return out
+
+
+def apply_keyset(query, columns: list, descending: bool, after: list = None):
+    """
+    Order a query by columns and, if after is given, only keep the rows that
+    come strictly after that sort key (keyset pagination)
+
+    The last column must be unique (i.e. a primary key) so the order is total.
+
+    :param query: The Query to order
+    :param columns: The sort columns, most significant first
+    :param descending: Whether all columns are sorted in descending order
+    :param after: The sort key values of the last row of the previous page,
+                  as returned by decode_cursor()
+    :return The ordered (and filtered) Query
+    """
+    query = query.order_by(*[c.desc() if descending else c.asc() for c in columns])
+    if not after:
+        return query
+
+    # (c1, c2, ...) > (v1, v2, ...) spelt out, row value comparison is not portable
+    clauses = []
+    for i, column in enumerate(columns):
+        tie = [c == v for c, v in zip(columns[:i], after[:i])]
+        clauses.append(and_(*tie, column < after[i] if descending else column > after[i]))
+    return query.filter(or_(*clauses))
+
+
+# ids of the private resources and private channels a user is in the personnel of
+AccessSet = namedtuple("AccessSet", ["rids", "cids"])
+
+# uid -> (expiry time, AccessSet), see get_access_set()
+_access_cache = {}
+_access_cache_lock = threading.Lock()
+# bumped on every invalidation, so a set read before it is never cached after it
+_access_cache_generation = 0
+
+
+def get_access_set(uid) -> AccessSet:
+    """
+    Returns the private resources and channels a user has been given access to
+
+    The set is read in one query and then cached per user until it expires or
+    invalidate_access_set() is called for this user. A resource or channel is
+    visible to the user if it is public or its id is in the set.
+
+    :param uid: The user id
+    :return AccessSet of frozensets of rids and cids, both empty for an invalid uid
+    """
+    now = time.monotonic()
+    with _access_cache_lock:
+        cached = _access_cache.get(uid)
+        generation = _access_cache_generation
+    if cached and cached[0] > now:
+        count_cache("access_set", True)
+        return cached[1]
+    count_cache("access_set", False)
+
+    query = select(literal("resource").label("kind"), PrivateResourcePersonnel.rid.label("id")). \
+        where(PrivateResourcePersonnel.uid == uid). \
+        union_all(select(literal("channel"), ChannelPersonnel.cid).
+                  where(ChannelPersonnel.uid == uid))
+    with Session() as conn:
+        rows = conn.execute(query).all()
+    access = AccessSet(rids=frozenset(i for kind, i in rows if kind == "resource"),
+                       cids=frozenset(i for kind, i in rows if kind == "channel"))
+
+    with _access_cache_lock:
+        if generation == _access_cache_generation:
+            if len(_access_cache) >= ACCESS_CACHE_MAX_USERS:
+                _access_cache.clear()
+            _access_cache[uid] = (now + ACCESS_CACHE_TTL, access)
+    return access
+
+
+def invalidate_access_set(*uids):
+    """
+    Drop the cached access sets of users whose personnel membership changed
+
+    :param uids: The ids of the users
+    """
+    global _access_cache_generation
+    with _access_cache_lock:
+        _access_cache_generation += 1
+        for uid in uids:
+            _access_cache.pop(uid, None)
+
+
+def clear_access_cache():
+    """
+    Drop the cached access sets of all users
+    """
+    global _access_cache_generation
+    with _access_cache_lock:
+        _access_cache_generation += 1
+        _access_cache.clear()
+
+
+def get_cache_version(conn, name: str) -> int:
+    """
+    Returns the version of data cached in memory, see CacheVersion
+
+    :param conn: The Session() initiated
+    :param name: The name of the cached data
+    :return the version, 0 if it has never been changed
+    """
+    return conn.query(CacheVersion.version).filter_by(name=name).scalar() or 0
+
+
+def bump_cache_version(conn, name: str):
+    """
+    Increase the version of data cached in memory, as part of the
+    transaction of conn that changes the data
+
+    :param conn: The Session() initiated
+    :param name: The name of the cached data
+    """
+    versions = conn.query(CacheVersion).filter_by(name=name)
+    if not versions.update({CacheVersion.version: CacheVersion.version + 1}, synchronize_session=False):
+        # the migrations seed the known names, a concurrent first bump may insert it too
+        insert_if_absent(conn, CacheVersion, dict(name=name, version=0))
+        versions.update({CacheVersion.version: CacheVersion.version + 1}, synchronize_session=False)
+
+
+# kinds of data listed by the AJAX endpoints. Each has a version in CacheVersion
+# (named DATA_VERSION_PREFIX + kind), bumped by every transaction that changes
+# it, from which the endpoints derive their ETags. See get_data_versions().
+# Votes, views and trending scores only change counts and do not bump them, see
+# counts_only()
+DATA_KINDS = ("resource", "resource_comment", "channel", "post")
+DATA_VERSION_PREFIX = "data:"
+
+# table -> kinds of data a write to it changes. Writes to other tables that
+# change what is listed (e.g. usernames) call touch_data()
+DATA_TABLES = {
+    Resource.__tablename__: ("resource",),
+    ResourceThumbnail.__tablename__: ("resource",),
+    ResourceCreater.__tablename__: ("resource",),
+    ResourceTagRecord.__tablename__: ("resource",),
+    PrivateResourcePersonnel.__tablename__: ("resource",),
+    ResourceComment.__tablename__: ("resource_comment",),
+    ResourceCommentReply.__tablename__: ("resource_comment",),
+    Channel.__tablename__: ("channel",),
+    ChannelTagRecord.__tablename__: ("channel",),
+    ChannelPersonnel.__tablename__: ("channel",),
+    ChannelStats.__tablename__: ("channel",),
+    ChannelPost.__tablename__: ("post",),
+    PostComment.__tablename__: ("post",),
+    PostStats.__tablename__: ("post",),
+    Tag.__tablename__: ("resource", "channel"),
+}
+
+
+def touch_data(conn, *kinds):
+    """
+    Mark kinds of data as changed by the transaction of conn, their versions
+    are bumped when it commits
+
+    Writes to the tables of DATA_TABLES through a session are marked without
+    calling this.
+
+    :param conn: The Session() initiated
+    :param kinds: The kinds of data, see DATA_KINDS
+    """
+    conn.info.setdefault("touched_data", set()).update(kinds)
+
+
+@contextlib.contextmanager
+def counts_only(conn):
+    """
+    Do not mark the data written within the block as changed. For the vote
+    counts, views and trending scores written on every page view or vote, which
+    would otherwise bump the versions (and queue on their rows) all the time.
+    Listings show them up to controller.LISTING_COUNTS_MAX_AGE seconds late
+
+    :param conn: The Session() initiated
+    """
+    conn.info["counts_only"] = conn.info.get("counts_only", 0) + 1
+    try:
+        yield
+    finally:
+        conn.info["counts_only"] -= 1
+
+
+def get_data_versions(kinds) -> list:
+    """
+    Returns the versions of kinds of data, which change whenever the data does
+
+    :param kinds: The kinds of data, see DATA_KINDS
+    :return list of the version of each kind, in order
+    """
+    names = [DATA_VERSION_PREFIX + kind for kind in kinds]
+    with Session() as conn:
+        versions = dict(conn.query(CacheVersion.name, CacheVersion.version).
+                        filter(CacheVersion.name.in_(names)))
+    return [versions.get(name, 0) for name in names]
+
+
+def _touch_flushed(session, flush_context):
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        touch_data(session, *DATA_TABLES.get(instance.__tablename__, ()))
+
+
+def _touch_executed(orm_execute_state):
+    if orm_execute_state.session.info.get("counts_only"):
+        return
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        touch_data(orm_execute_state.session,
+                   *DATA_TABLES.get(orm_execute_state.statement.table.name, ()))
+
+
+def _bump_touched(session):
+    # flush the pending changes first so they are marked too. The versions are
+    # bumped last, in a fixed order, to hold their row locks for as short as possible
+    session.flush()
+    for kind in sorted(session.info.pop("touched_data", ())):
+        bump_cache_version(session, DATA_VERSION_PREFIX + kind)
+
+
+def _clear_touched(session):
+    session.info.pop("touched_data", None)
+
+
+for _maker in (Session, _request_session):
+    event.listen(_maker, "after_flush", _touch_flushed)
+    event.listen(_maker, "do_orm_execute", _touch_executed)
+    event.listen(_maker, "before_commit", _bump_touched)
+    event.listen(_maker, "after_rollback", _clear_touched)
+
+
+# in-memory copy of the tag table, see get_tags()
+_tag_registry = {"version": None, "checked_at": None, "name2id": {}, "id2name": {}}
+_tag_registry_lock = threading.Lock()
+
+
+def invalidate_tags():
+    """
+    Make the next get_tags() call check the tag version in the DB
+    """
+    with _tag_registry_lock:
+        _tag_registry["checked_at"] = None
+
+
+# last version of the responses read from the DB, see get_response_version()
+_response_version = {"version": None, "checked_at": None}
+_response_version_lock = threading.Lock()
+
+
+def get_response_version() -> int:
+    """
+    Returns the version of the data shown to anonymous and demo users, which
+    is part of the key of their cached responses (see DBCache.py)
+
+    Writes that change resources, channels, tags or usernames bump the version
+    in their transaction. It is read from the DB at most every
+    RESPONSE_VERSION_CHECK_INTERVAL seconds, or on the next call after
+    invalidate_responses().
+
+    :return the version, 0 if the data has never been changed
+    """
+    now = time.monotonic()
+    with _response_version_lock:
+        checked_at, version = _response_version["checked_at"], _response_version["version"]
+    if checked_at is None or now - checked_at >= RESPONSE_VERSION_CHECK_INTERVAL:
+        with Session() as conn:
+            version = get_cache_version(conn, "responses")
+        with _response_version_lock:
+            _response_version["version"] = version
+            _response_version["checked_at"] = now
+    return version
+
+
+def invalidate_responses():
+    """
+    Make the next get_response_version() call read the response version in the DB
+    """
+    with _response_version_lock:
+        _response_version["checked_at"] = None
+
+
 def add_user(username, password, email, teaching_areas: dict = None,
              bio=None, avatar_link=DEFAULT_USER_AVATAR_LINK,
              profile_background_link=DEFAULT_PROFILE_BACKGROUND_LINK):
@@ -126,28 +608,23 @@ def add_user(username, password, email, teaching_areas: dict = None,
             warnings.warn("This email address is registered")
             return ErrorCode.EMAIL_USED
 
-        # phase 1: add a new user
+        # the user and its teaching areas are added in one transaction,
+        # the flush gives the id of the new user
         conn.add(user)
-        if not try_to_commit(conn):
+        if not try_to_flush(conn):
             warnings.warn(f"failed to commit user creation {username}")
             return ErrorCode.COMMIT_ERROR
-
-        # phase 2: find id of new user -- using email,
-        # then update teaching_areas table
-        user = conn.query(User).filter_by(email=email).one()
+        uid = user.uid
 
         if teaching_areas:
-            modify_user_teaching_areas(uid=user.uid, conn=conn, teaching_areas=teaching_areas,
+            modify_user_teaching_areas(uid=uid, conn=conn, teaching_areas=teaching_areas,
                                        modification=Modification.MODIFY_ADD)
         if not try_to_commit(conn):
             warnings.warn(f"failed to commit user creation {username}")
-            conn.delete(user)
-            # rollback obsolete user object
-            conn.commit()
             return ErrorCode.COMMIT_ERROR
         if VERBOSE:
             print(f"User {username} created")
-        return user.uid
+        return uid
 
 
 def modify_user_teaching_areas(uid, conn, modification: Modification,
@@ -239,6 +716,14 @@ def modify_user(uid: int, username=None, password=None, email=None,
             user.email = email
         if username:
             user.username = username
+            # shown as the latest poster of channels
+            stats = ChannelStats.__table__
+            conn.execute(stats.update().where(stats.c.last_poster_uid == uid).
+                         values(last_poster_username=username))
+            # shown as the latest commenter of channel posts
+            stats = PostStats.__table__
+            conn.execute(stats.update().where(stats.c.last_commenter_uid == uid).
+                         values(last_commenter_username=username))
         if password:
             user.hash_password = generate_password_hash(password, "sha256")
         if profile_background_link != "NULL":
@@ -265,9 +750,14 @@ def modify_user(uid: int, username=None, password=None, email=None,
             modify_user_teaching_areas(uid=uid, conn=conn, teaching_areas=teaching_areas_to_delete,
                                        modification=Modification.MODIFY_DELETE)
 
+        if username or avatar_link != "NULL":
+            # shown on resource and channel cards, with comments and posts
+            bump_cache_version(conn, "responses")
+            touch_data(conn, "resource_comment", "channel", "post")
         if not try_to_commit(conn):
             warnings.warn("Error committing")
             return ErrorCode.COMMIT_ERROR
+        invalidate_responses()
 
 
 def remove_resource(rid: int):
@@ -283,7 +773,11 @@ def remove_resource(rid: int):
         resource = conn.query(Resource).filter_by(rid=rid).one_or_none()
         if resource:
             conn.delete(resource)
+            bump_cache_version(conn, "responses")
             conn.commit()
+            invalidate_responses()
+            refresh_recommendation("resource", rid)
+            refresh_trending("resource", rid)
 
 
 def get_user(email):
@@ -333,12 +827,21 @@ def add_tag(tag_name, tag_description=None):
             return
 
         conn.add(tag)
+        if not try_to_flush(conn):
+            warnings.warn(f"tag {tag_name} creation failed")
+            return ErrorCode.COMMIT_ERROR
+        tag_id = tag.tag_id
+        # let every process know the tags changed
+        bump_cache_version(conn, "tags")
+        bump_cache_version(conn, "responses")
         if not try_to_commit(conn):
             warnings.warn(f"tag {tag_name} creation failed")
             return ErrorCode.COMMIT_ERROR
+        invalidate_tags()
+        invalidate_responses()
         print(f"tag {tag_name} added") if VERBOSE else None
 
-        return conn.query(Tag).filter_by(tag_name=tag_name).one().tag_id
+        return tag_id
 
 
 def get_tags(mapping="name2id") -> dict:
@@ -351,22 +854,33 @@ def get_tags(mapping="name2id") -> dict:
 
     By default, the method returns a dict of tag_name -> tag_id mapping
 
+    Tags are served from memory. At most every TAG_VERSION_CHECK_INTERVAL
+    seconds, the tag version in the DB is read and the tags are reloaded only
+    if another process has changed them.
+
     :return: A dictionary of mapping tag_name -> tag_id or tag_id -> tag_name
     """
-    out = dict()
-
     if mapping not in ["name2id", "id2name"]:
         mapping = "name2id"
 
-    with Session() as conn:
-        tags = conn.query(Tag).all()
-
-        for i in tags:
-            if mapping == "name2id":
-                out[i.tag_name] = i.tag_id
-            else:
-                out[i.tag_id] = i.tag_name
-    return out
+    now = time.monotonic()
+    with _tag_registry_lock:
+        checked_at, known_version = _tag_registry["checked_at"], _tag_registry["version"]
+    tags = None
+    if checked_at is None or now - checked_at >= TAG_VERSION_CHECK_INTERVAL:
+        with Session() as conn:
+            version = get_cache_version(conn, "tags")
+            tags = conn.query(Tag.tag_id, Tag.tag_name).all() if version != known_version else None
+        with _tag_registry_lock:
+            if tags is not None:
+                _tag_registry["name2id"] = {name: tag_id for tag_id, name in tags}
+                _tag_registry["id2name"] = {tag_id: name for tag_id, name in tags}
+                _tag_registry["version"] = version
+            _tag_registry["checked_at"] = now
+    count_cache("tags", tags is None)
+
+    with _tag_registry_lock:
+        return dict(_tag_registry[mapping])
 
 
 def add_resource(title, resource_link, difficulty: ResourceDifficulty, subject: Subject,
@@ -414,16 +928,14 @@ def add_resource(title, resource_link, difficulty: ResourceDifficulty, subject:
 
     with Session() as conn:
 
-        # phase 1: add new resource
+        # the resource, its thumbnails, creaters, personnel, tags, recommendation
+        # candidates and trending score are added in one transaction,
+        # the flush gives the id of the new resource
         conn.add(resource)
-        if not try_to_commit(conn):
+        if not try_to_flush(conn):
             warnings.warn(f"resource {title} creation failed")
             return ErrorCode.COMMIT_ERROR
-
-        # phase 2: find the new row, update private_resource_personnel info, tag info
-        # and resource_creater table, resource_thumbnail
-        warnings.warn(resource_link)
-        resource = conn.query(Resource).filter_by(resource_link=resource_link).one()
+        rid = resource.rid
 
         # get rid of duplicate
         creaters_id = list(set(creaters_id))
@@ -435,36 +947,42 @@ def add_resource(title, resource_link, difficulty: ResourceDifficulty, subject:
             tags_id = list(set(tags_id))
 
         for i in resource_thumbnail_links:
-            thumbnail = ResourceThumbnail(rid=resource.rid, thumbnail_link=i)
+            thumbnail = ResourceThumbnail(rid=rid, thumbnail_link=i)
             conn.add(thumbnail)
 
         for i in creaters_id:
-            creater_instance = ResourceCreater(rid=resource.rid, uid=i)
+            creater_instance = ResourceCreater(rid=rid, uid=i)
             conn.add(creater_instance)
 
             # creaters must have access to this resource
             if not is_public and i not in private_personnel_id:
-                private_access = PrivateResourcePersonnel(rid=resource.rid, uid=i)
+                private_access = PrivateResourcePersonnel(rid=rid, uid=i)
                 conn.add(private_access)
 
         if not is_public:
             for uid in private_personnel_id:
-                private_access = PrivateResourcePersonnel(rid=resource.rid, uid=uid)
+                private_access = PrivateResourcePersonnel(rid=rid, uid=uid)
                 conn.add(private_access)
 
         if tags_id:
             for i in tags_id:
-                tag_record = ResourceTagRecord(rid=resource.rid, tag_id=i)
+                tag_record = ResourceTagRecord(rid=rid, tag_id=i)
                 conn.add(tag_record)
+        if not try_to_flush(conn):
+            warnings.warn(f"resource {title} creation failed")
+            return ErrorCode.COMMIT_ERROR
+        update_recommendation(conn, "resource", rid)
+        update_trending(conn, "resource", [rid])
+        bump_cache_version(conn, "responses")
         if not try_to_commit(conn):
             warnings.warn(f"resource {title} creation failed")
-            # roll back process
-            conn.delete(resource)
-            conn.commit()
             return ErrorCode.COMMIT_ERROR
+        invalidate_responses()
+        if not is_public:
+            invalidate_access_set(*creaters_id, *private_personnel_id)
         if VERBOSE:
             print(f"Resource {title} added")
-        return resource.rid
+        return rid
 
 
 def is_resource_public(rid: int):
@@ -521,6 +1039,7 @@ def modify_resource_personnel(rid, uid, modification: Modification):
         if not try_to_commit(conn):
             warnings.warn(f"User {uid} cannot be added to personnel of resource {rid}")
             return ErrorCode.COMMIT_ERROR
+        invalidate_access_set(uid)
         print(f"user {uid} is {msg} from/to personnel of resource {rid}")
 
 
@@ -558,6 +1077,8 @@ def modify_resource(rid: int, title=None, resource_link=None,
             ErrorCode.INVALID_RESOURCE is rid is invalid
             ErrorCode.COMMIT_ERROR if cannot commit (used when DEBUG_MODE is False)
     """
+    # users losing access when the resource is made public
+    removed_personnel = []
     with Session() as conn:
         resource = conn.query(Resource).filter_by(rid=rid).one_or_none()
         if not resource:
@@ -636,6 +1157,7 @@ def modify_resource(rid: int, title=None, resource_link=None,
                     for i in conn.query(PrivateResourcePersonnel). \
                             filter_by(rid=rid).all():
                         conn.delete(i)
+                        removed_personnel.append(i.uid)
                 elif is_public is None:
                     # modify the personnel for a private resource
                     if ids_to_add_to_personnel:
@@ -667,9 +1189,15 @@ def modify_resource(rid: int, title=None, resource_link=None,
                         modify_resource_personnel(
                             rid=rid, uid=i, modification=Modification.MODIFY_ADD)
         conn.add(resource)
+        bump_cache_version(conn, "responses")
         if not try_to_commit(conn):
             warnings.warn("Error committing")
             return ErrorCode.COMMIT_ERROR
+        invalidate_responses()
+        if removed_personnel:
+            invalidate_access_set(*removed_personnel)
+    # subject, grade or visibility may have changed
+    refresh_recommendation("resource", rid)
 
 
 def get_resource_thumbnail(rid):
@@ -687,21 +1215,23 @@ def user_has_access_to_resource(uid, rid):
     :return True/False on success.
             ErrorCode.INVALID_USER/-RESOURCE if uid/rid is incorrect
     """
-    user, resource = get_user_and_resource_instance(uid=uid, rid=rid)
-    if not user:
+    with Session() as conn:
+        # check user and resource in one round trip, is_public is None if rid is invalid
+        user_exists, is_public = conn.query(
+            conn.query(User).filter_by(uid=uid).exists(),
+            conn.query(Resource.is_public).filter_by(rid=rid).scalar_subquery()).one()
+    if not user_exists:
         warnings.warn("uid is invalid")
         return ErrorCode.INVALID_USER
-    elif not resource:
+    elif is_public is None:
         warnings.warn("rid is invalid")
         return ErrorCode.INVALID_RESOURCE
-    if resource.is_public:
+    if is_public:
         # NOTE: Here changed error to True since all users have access to
         # public channels
         return True
 
-    with Session() as conn:
-        return conn.query(PrivateResourcePersonnel).filter_by(uid=uid, rid=rid). \
-                   one_or_none() is not None
+    return int(rid) in get_access_set(uid).rids
 
 
 def get_resource_author(rid):
@@ -728,11 +1258,85 @@ def get_resource_tags(rid):
         return [r[0] for r in res if r is not None]
 
 
+def load_resource_cards(rids: list, with_author: bool = True) -> list:
+    """
+    Load everything needed to display a list of resource cards using a fixed
+    number of queries (one per table) regardless of how many rids are given
+
+    :param rids: The ids of the resources to load. The order is kept, duplicates
+                 and ids that do not exist are skipped
+    :param with_author: Whether to attach the first creater of each resource
+    :return a list of dicts, one per resource, of the form
+            Resource.serialize + {"tags": [tag names],
+                                  "banner": ResourceThumbnail.serialize,
+                                  "author": User.serialize (if with_author)}
+            A resource without thumbnail gets the placeholder banner; a resource
+            without creater gets None as author
+    """
+    rids = list(dict.fromkeys(rids))
+    if not rids:
+        return []
+
+    with Session() as conn:
+        resources = {r.rid: r for r in conn.query(Resource).filter(Resource.rid.in_(rids))}
+
+        tags = defaultdict(list)
+        for rid, tag_name in conn.query(ResourceTagRecord.rid, Tag.tag_name). \
+                join(Tag, Tag.tag_id == ResourceTagRecord.tag_id). \
+                filter(ResourceTagRecord.rid.in_(rids)).order_by(Tag.tag_id):
+            tags[rid].append(tag_name)
+
+        banners = {}
+        for thumbnail in conn.query(ResourceThumbnail). \
+                filter(ResourceThumbnail.rid.in_(rids)).order_by(ResourceThumbnail.thumbnail_link):
+            banners.setdefault(thumbnail.rid, thumbnail.serialize)
+
+        authors = {}
+        if with_author:
+            for rid, user in conn.query(ResourceCreater.rid, User). \
+                    join(User, User.uid == ResourceCreater.uid). \
+                    filter(ResourceCreater.rid.in_(rids)).order_by(User.uid):
+                authors.setdefault(rid, user.serialize)
+
+        cards = []
+        for rid in rids:
+            resource = resources.get(rid)
+            if resource is None:
+                continue
+            card = dict(resource.serialize, tags=tags[rid],
+                        banner=banners.get(rid, {"thumbnail_link": DEFAULT_RESOURCE_THUMBNAIL_LINK}))
+            if with_author:
+                card["author"] = authors.get(rid)
+            cards.append(card)
+        return cards
+
+
+def iter_resource_cards(resources, batch_size: int = STREAM_BATCH_SIZE,
+                        with_author: bool = True):
+    """
+    Lazily hydrate an iterable of resources (e.g. iter_resources()) into cards,
+    calling load_resource_cards() once every batch_size resources
+
+    :param resources: The iterable of Resource instances
+    :param batch_size: The number of resources hydrated at a time
+    :param with_author: see load_resource_cards()
+    """
+    batch = []
+    for resource in resources:
+        batch.append(resource.rid)
+        if len(batch) == batch_size:
+            yield from load_resource_cards(batch, with_author=with_author)
+            batch = []
+    if batch:
+        yield from load_resource_cards(batch, with_author=with_author)
+
+
 def find_resources(title_type="like", title=None,
                    created_type="after", created=EPOCH,
                    difficulty=None, subject=None, tags=None,
                    vote_type="more", votes=None,
-                   grade=None, email=None, sort_by="natural"
+                   grade=None, email=None, sort_by="natural",
+                   limit=None, after=None
                    ):
     """Find a resource using the specific keys.
 
@@ -742,7 +1346,8 @@ def find_resources(title_type="like", title=None,
         If no parameters are passed the method should return all Resources.
 
         :param title_type   : SQL search restriction for the title.
-            Valid values are ["like","exact"]
+            Valid values are ["like","exact","fulltext"]. "fulltext" matches
+            every word of title against the title and description
             Defaults to "like".
         :param title        : title to search for
             Defaults to "".
@@ -773,80 +1378,176 @@ def find_resources(title_type="like", title=None,
         :param sort_by         : The sort by parameter
             Valid values are ["natural","newest","upvotes","trending"].
             Defaults to "natural".
+        :param limit         : The maximum number of resources to return
+            Defaults to None (no limit).
+        :param after         : The sort key of the last resource of the previous
+            page, as returned by decode_resource_cursor().
+            Defaults to None (first page).
+    """
+    with Session() as conn:
+        result = resource_search_query(conn, title_type=title_type, title=title,
+                                       created_type=created_type, created=created,
+                                       difficulty=difficulty, subject=subject, tags=tags,
+                                       vote_type=vote_type, votes=votes, grade=grade,
+                                       email=email, sort_by=sort_by,
+                                       limit=limit, after=after).all()
+    return result
+
+
+def iter_resources(batch_size: int = STREAM_BATCH_SIZE, **kwargs):
+    """
+    Generator version of find_resources(): matching resources are read from
+    the DB batch_size rows at a time instead of loading the full result set.
+
+    Takes the same keyword arguments as find_resources().
+    """
+    with Session() as conn:
+        for resource in resource_search_query(conn, **kwargs).yield_per(batch_size):
+            yield resource
+
+
+def resource_sort_columns(sort_by: str):
+    """
+    Returns the columns find_resources() orders by for a sort mode
+
+    :param sort_by: The sort mode, see find_resources()
+    :return The tuple of form [columns], is_descending. The last column is
+            always rid so the order is total (required for keyset pagination)
+    """
+    if sort_by == "newest":
+        return [Resource.created_at, Resource.rid], True
+    elif sort_by == "upvotes":
+        return [Resource.upvote_count, Resource.rid], True
+    elif sort_by == "trending":
+        return [TRENDING_SORT_SCORE, Resource.rid], True
+    # natural
+    return [Resource.rid], False
+
+
+def resource_page_cursor(resource: Resource, sort_by: str) -> str:
+    """
+    Returns the cursor to request the page after resource
+
+    :param resource: The last resource of the current page
+    :param sort_by: The sort mode the page was found with
+    """
+    if sort_by == "trending":
+        return encode_cursor(sort_by, [get_trending_score("resource", resource.rid), resource.rid])
+    columns, _ = resource_sort_columns(sort_by)
+    return encode_cursor(sort_by, [getattr(resource, c.key) for c in columns])
+
+
+def decode_resource_cursor(cursor: str, sort_by: str):
+    """
+    Decode a cursor created by resource_page_cursor()
+
+    :return The after value to pass to find_resources() on success.
+            None if the cursor is invalid for this sort mode
+    """
+    columns, _ = resource_sort_columns(sort_by)
+    return decode_cursor(cursor, sort_by, columns)
+
+
+def resource_search_query(conn, title_type="like", title=None,
+                          created_type="after", created=EPOCH,
+                          difficulty=None, subject=None, tags=None,
+                          vote_type="more", votes=None,
+                          grade=None, email=None, sort_by="natural",
+                          limit=None, after=None):
+    """
+    Build the single SQL statement behind find_resources()
+
+    Visibility (public OR in the private personnel of the caller) and tag
+    membership (every tag in tags must be applied to the resource) are both
+    evaluated by the database, so the number of queries issued does not grow
+    with the number of matching resources.
+
+    See find_resources() for the parameters.
+
+    :param conn: The Session() initiated
+    :return The Query of matching Resource rows
     """
     # Args Checking
-    if title_type not in ["like", "exact"]:
+    if title_type not in ["like", "exact", "fulltext"]:
         title_type = "like"
     if created_type not in ["after", "before"]:
         created_type = "after"
     if vote_type not in ["more", "less"]:
         vote_type = "more"
-    if sort_by not in ["Natural", "newest", "upvotes", "trending"]:
+    if sort_by not in RESOURCE_SORT_MODES:
         sort_by = "natural"
     if tags is None:
         tags = []
 
-    with Session() as conn:
-        # get User if exists
-        user = conn.query(User).filter_by(email=email).one_or_none()
-
-        resources = conn.query(Resource)
+    resources = conn.query(Resource)
 
-        if title is not None and isinstance(title, str):
-            if title_type == "like":
-                resources = resources.filter(Resource.title.ilike(f'%{title}%'))
-            else:
-                resources = resources.filter_by(title=title)
+    if title is not None and isinstance(title, str):
+        if title_type == "like":
+            resources = resources.filter(Resource.title.ilike(f'%{title}%'))
+        elif title_type == "fulltext":
+            resources = resources.filter(fulltext_clause(conn, "resource", Resource.rid, title))
+        else:
+            resources = resources.filter_by(title=title)
 
-        if created != EPOCH and isinstance(created, datetime.datetime):
-            if created_type == "after":
-                resources = resources.filter(Resource.created_at > created)
-            else:
-                resources = resources.filter(Resource.created_at < created)
+    if created != EPOCH and isinstance(created, datetime.datetime):
+        if created_type == "after":
+            resources = resources.filter(Resource.created_at > created)
+        else:
+            resources = resources.filter(Resource.created_at < created)
 
-        if difficulty is not None and isinstance(difficulty, ResourceDifficulty):
-            resources = resources.filter_by(difficulty=difficulty)
+    if difficulty is not None and isinstance(difficulty, ResourceDifficulty):
+        resources = resources.filter_by(difficulty=difficulty)
 
-        if subject is not None and isinstance(subject, Subject):
-            resources = resources.filter_by(subject=subject)
+    if subject is not None and isinstance(subject, Subject):
+        resources = resources.filter_by(subject=subject)
 
-        if grade is not None and isinstance(grade, Grade):
-            resources = resources.filter_by(grade=grade)
+    if grade is not None and isinstance(grade, Grade):
+        resources = resources.filter_by(grade=grade)
 
-        if votes is not None and isinstance(votes, int):
-            if vote_type == "more":
-                resources = resources.filter(Resource.upvote_count > votes)
-            else:
-                resources = resources.filter(Resource.upvote_count < votes)
-
-        if sort_by != "natural":
-            if sort_by == "newest":
-                resources = resources.order_by(Resource.created_at.desc())
-            elif sort_by == "upvotes":
-                resources = resources.order_by(Resource.upvote_count.desc())
-
-        if user is None and email != 'demo':
-            resources = resources.filter_by(is_public=True)
-            result = resources.all()
-        elif email != 'demo':
-            result = filter(lambda res: user_has_access_to_resource(user.uid, res.rid), resources.all())
+    if votes is not None and isinstance(votes, int):
+        if vote_type == "more":
+            resources = resources.filter(Resource.upvote_count > votes)
         else:
-            result = resources.all()
-
-        for tag in tags:
-            warnings.warn(f"Searching for tag {tag}")
-            result = filter(lambda res: tag in get_resource_tags(res.rid), result)
-        result = list(result)
-        if sort_by == "trending":
-            # trending mode: fake a trend by shuffle
-            random.shuffle(result)
-    return result
+            resources = resources.filter(Resource.upvote_count < votes)
+
+    if email is None:
+        # anonymous caller: public resources only
+        resources = resources.filter_by(is_public=True)
+    elif email != 'demo':
+        # public resources, or private resources whose personnel has the caller.
+        # A caller email that is not registered matches no personnel row
+        caller_uid = conn.query(User.uid).filter_by(email=email).scalar_subquery()
+        in_personnel = conn.query(PrivateResourcePersonnel).filter(
+            PrivateResourcePersonnel.rid == Resource.rid,
+            PrivateResourcePersonnel.uid == caller_uid).exists()
+        resources = resources.filter(or_(Resource.is_public.is_(True), in_personnel))
+
+    tag_names = set(tags) if tags else set()
+    if tag_names:
+        if VERBOSE:
+            warnings.warn(f"Searching for tags {tag_names}")
+        # AND semantics: the resource must carry every requested tag
+        tagged = conn.query(ResourceTagRecord.rid). \
+            join(Tag, Tag.tag_id == ResourceTagRecord.tag_id). \
+            filter(Tag.tag_name.in_(tag_names)). \
+            group_by(ResourceTagRecord.rid). \
+            having(func.count(distinct(ResourceTagRecord.tag_id)) == len(tag_names))
+        resources = resources.filter(Resource.rid.in_(tagged))
+
+    if sort_by == "trending":
+        resources = trending_join(resources, "resource")
+    columns, descending = resource_sort_columns(sort_by)
+    resources = apply_keyset(resources, columns, descending, after)
+    if limit:
+        resources = resources.limit(limit)
+    return resources
 
 
 def find_channels(title_type="like", channel_name=None,
                   subject: Subject = None, is_public: bool = True,
                   grade: Grade = None, caller_uid=None, admin_uid=None, tag_ids: list = None,
-                  sort_by_newest_date: bool = False):
+                  sort_by_newest_date: bool = False, sort_by_trending: bool = False,
+                  limit=None, after=None, with_stats: bool = False):
     """
     find_channels method mainly follows the style of find_resources() and is capable
     of finding channels that match all the conditions specified in parameter values
@@ -861,7 +1562,7 @@ def find_channels(title_type="like", channel_name=None,
     When no parameters are passed to the method, it returns all channels with
     ChannelVisibility == PUBLIC
     :param title_type: SQL search restriction for the title.
-            Valid values are ["like","exact"]
+            Valid values are ["like","exact","fulltext"]
     :param channel_name: The name of the channel to look up
     :param subject: The subject the channel is related to.
     :param is_public: whether a channel is public. When channel public is True,
@@ -872,109 +1573,457 @@ def find_channels(title_type="like", channel_name=None,
     :param admin_uid: The admin id of channel
     :param tag_ids: The list of tag ids the channel is related to
     :param sort_by_newest_date: Whether the result is sorted by latest date
-    :return List of Channel objects
+    :param sort_by_trending: Whether the result is sorted by trending score, ignored
+                             if sort_by_newest_date is True. By oldest date if neither
+    :param limit: The maximum number of channels to return, None for no limit
+    :param after: The sort key of the last channel of the previous page, as
+                  returned by decode_channel_cursor()
+    :param with_stats: Whether to return the ChannelStats of each channel too,
+                       read by the same query
+    :return List of Channel objects, or of (Channel, ChannelStats) tuples if
+            with_stats (ChannelStats is None if the channel has none yet)
+    """
+    with Session() as conn:
+        return channel_search_query(conn, title_type=title_type, channel_name=channel_name,
+                                    subject=subject, is_public=is_public, grade=grade,
+                                    caller_uid=caller_uid, admin_uid=admin_uid, tag_ids=tag_ids,
+                                    sort_by_newest_date=sort_by_newest_date,
+                                    sort_by_trending=sort_by_trending,
+                                    limit=limit, after=after, with_stats=with_stats).all()
+
+
+def iter_channels(batch_size: int = STREAM_BATCH_SIZE, **kwargs):
+    """
+    Generator version of find_channels(): matching channels are read from
+    the DB batch_size rows at a time instead of loading the full result set.
+
+    Takes the same keyword arguments as find_channels().
+    """
+    with Session() as conn:
+        for channel in channel_search_query(conn, **kwargs).yield_per(batch_size):
+            yield channel
+
+
+def channel_sort_columns(sort_by_newest_date: bool, sort_by_trending: bool = False):
+    """
+    Returns the columns find_channels() orders by
+
+    :param sort_by_newest_date: see find_channels()
+    :param sort_by_trending: see find_channels()
+    :return The tuple of form [columns], is_descending
+    """
+    if channel_sort_mode(sort_by_newest_date, sort_by_trending) == "trending":
+        return [TRENDING_SORT_SCORE, Channel.cid], True
+    return [Channel.created_at, Channel.cid], sort_by_newest_date
+
+
+def channel_page_cursor(channel: Channel, sort_by_newest_date: bool,
+                        sort_by_trending: bool = False) -> str:
+    """
+    Returns the cursor to request the page after channel
+
+    :param channel: The last channel of the current page
+    :param sort_by_newest_date: The sort order the page was found with
+    :param sort_by_trending: The sort order the page was found with
+    """
+    mode = channel_sort_mode(sort_by_newest_date, sort_by_trending)
+    if mode == "trending":
+        return encode_cursor(mode, [get_trending_score("channel", channel.cid), channel.cid])
+    columns, _ = channel_sort_columns(sort_by_newest_date)
+    return encode_cursor(mode, [getattr(channel, c.key) for c in columns])
+
+
+def decode_channel_cursor(cursor: str, sort_by_newest_date: bool, sort_by_trending: bool = False):
+    """
+    Decode a cursor created by channel_page_cursor()
+
+    :return The after value to pass to find_channels() on success.
+            None if the cursor is invalid for this sort order
+    """
+    columns, _ = channel_sort_columns(sort_by_newest_date, sort_by_trending)
+    return decode_cursor(cursor, channel_sort_mode(sort_by_newest_date, sort_by_trending), columns)
+
+
+def channel_sort_mode(sort_by_newest_date: bool, sort_by_trending: bool = False) -> str:
+    """Returns the name of a find_channels() sort order, as used in cursors"""
+    if sort_by_newest_date:
+        return "newest"
+    return "trending" if sort_by_trending else "oldest"
+
+
+def channel_search_query(conn, title_type="like", channel_name=None,
+                         subject: Subject = None, is_public: bool = True,
+                         grade: Grade = None, caller_uid=None, admin_uid=None,
+                         tag_ids: list = None, sort_by_newest_date: bool = False,
+                         sort_by_trending: bool = False, limit=None, after=None,
+                         with_stats: bool = False):
+    """
+    Build the query behind find_channels(), see find_channels() for the parameters
+
+    :param conn: The Session() initiated
+    :return The Query of matching Channel rows, or (Channel, ChannelStats) rows if with_stats
     """
     # Args Checking
     if tag_ids is None:
         tag_ids = []
 
-    if title_type not in ["like", "exact"]:
+    if title_type not in ["like", "exact", "fulltext"]:
         title_type = "like"
 
-    with Session() as conn:
-        # list of channel id projects
-        channel_id_obj = []
-        if tag_ids:
-            channel_id_obj = conn.query(ChannelTagRecord).filter(
-                ChannelTagRecord.tag_id.in_(tag_ids)).all()
-        if channel_id_obj:
-            # find channels that match the tags, if any
-            cids = set()
-            for i in channel_id_obj:
-                cids.add(i.cid)
-            cids = tuple(cids)
-            channels = conn.query(Channel).filter(Channel.cid.in_(cids))
+    # list of channel id projects
+    channel_id_obj = []
+    if tag_ids:
+        channel_id_obj = conn.query(ChannelTagRecord).filter(
+            ChannelTagRecord.tag_id.in_(tag_ids)).all()
+    if channel_id_obj:
+        # find channels that match the tags, if any
+        cids = set()
+        for i in channel_id_obj:
+            cids.add(i.cid)
+        cids = tuple(cids)
+        channels = conn.query(Channel).filter(Channel.cid.in_(cids))
+    else:
+        # no tag_id supplied, get all the channels
+        channels = conn.query(Channel)
+
+    if subject:
+        channels = channels.filter_by(subject=subject)
+    if grade:
+        channels = channels.filter_by(grade=grade)
+
+    if not admin_uid:
+        if is_public:
+            channels = channels.filter_by(visibility=ChannelVisibility.PUBLIC)
         else:
-            # no tag_id supplied, get all the channels
-            channels = conn.query(Channel)
+            channels = channels.filter(
+                or_(Channel.visibility == ChannelVisibility.FULLY_PRIVATE,
+                    Channel.visibility == ChannelVisibility.INVITE_ONLY))
+
+    if channel_name:
+        if title_type == "like":
+            channels = channels.filter(Channel.name.ilike(f'%{channel_name}%'))
+        elif title_type == "fulltext":
+            channels = channels.filter(fulltext_clause(conn, "channel", Channel.cid, channel_name))
+        else:
+            # exact match
+            channels = channels.filter_by(name=channel_name)
 
-        if subject:
-            channels = channels.filter_by(subject=subject)
-        if grade:
-            channels = channels.filter_by(grade=grade)
+    if caller_uid and caller_uid != -2:
+        # find all private channels this caller has access to
+        accessible = tuple(get_access_set(caller_uid).cids)
 
-        if not admin_uid:
-            if is_public:
-                channels = channels.filter_by(visibility=ChannelVisibility.PUBLIC)
-            else:
-                channels = channels.filter(
-                    or_(Channel.visibility == ChannelVisibility.FULLY_PRIVATE,
-                        Channel.visibility == ChannelVisibility.INVITE_ONLY))
+        # return channels that this user can access: either public or
+        # private but accessible
+        channels = channels.filter(or_(Channel.visibility == ChannelVisibility.PUBLIC,
+                                       Channel.cid.in_(accessible)))
+    elif admin_uid:
+        channels = channels.filter_by(admin_uid=admin_uid)
 
-        if channel_name:
-            if title_type == "like":
-                channels = channels.filter(Channel.name.ilike(f'%{channel_name}%'))
-            else:
-                # exact match
-                channels = channels.filter_by(name=channel_name)
-
-        if caller_uid and caller_uid != -2:
-            # find all private channels this caller has access to
-            personnel = conn.query(ChannelPersonnel).filter_by(uid=caller_uid).all()
-            accessible = set()
-            for i in personnel:
-                accessible.add(i.cid)
-            accessible = tuple(accessible)
-
-            # return channels that this user can access: either public or
-            # private but accessible
-            channels = channels.filter(or_(Channel.visibility == ChannelVisibility.PUBLIC,
-                                           Channel.cid.in_(accessible)))
-        elif admin_uid:
-            channels = channels.filter_by(admin_uid=admin_uid)
-
-        if sort_by_newest_date:
-            # order by latest date
-            channels = channels.order_by(Channel.created_at.desc())
-        else:
-            channels = channels.order_by(Channel.created_at.asc())
-        return channels.all()
+    if with_stats:
+        channels = channels.add_entity(ChannelStats). \
+            outerjoin(ChannelStats, ChannelStats.cid == Channel.cid)
+
+    columns, descending = channel_sort_columns(sort_by_newest_date, sort_by_trending)
+    if channel_sort_mode(sort_by_newest_date, sort_by_trending) == "trending":
+        channels = trending_join(channels, "channel")
+    channels = apply_keyset(channels, columns, descending, after)
+    if limit:
+        channels = channels.limit(limit)
+    return channels
 
 
-def find_channel_posts(cid: int, sort_algo: str = "date", title_type="like", title=None):
+def find_channel_posts(cid: int, sort_algo: str = "date", title_type="like", title=None,
+                       limit=None, after=None, with_stats: bool = False):
     """
     Returns a list of channel posts in a channel
 
     By default it is sort by latest post date
 
     :param cid: The id of the channel
-    :param sort_algo: "date" - sort by latest date; "upvote" - sort by highest upvote counts
+    :param sort_algo: "date" - sort by latest date; "upvote" - sort by highest upvote counts;
+            "trending" - sort by highest trending score
     :param title: The title of the posts to be found
     :param title_type: SQL search restriction for the title.
-            Valid values are ["like","exact"]
+            Valid values are ["like","exact","fulltext"]
+    :param limit: The maximum number of posts to return, None for no limit
+    :param after: The sort key of the last post of the previous page, as
+                  returned by decode_channel_post_cursor()
+    :param with_stats: Whether to return the poster and the PostStats of each
+                       post too, read by the same query
+    :return List of ChannelPost objects, or of (ChannelPost, User, PostStats)
+            tuples if with_stats (PostStats is None if the post has none yet)
+    """
+    with Session() as conn:
+        return channel_post_search_query(conn, cid, sort_algo=sort_algo, title_type=title_type,
+                                         title=title, limit=limit, after=after,
+                                         with_stats=with_stats).all()
+
+
+def channel_post_sort_columns(sort_algo: str):
+    """
+    Returns the columns find_channel_posts() orders by
+
+    :param sort_algo: see find_channel_posts()
+    :return The tuple of form [columns], is_descending. The last column is
+            always post_id so the order is total (required for keyset pagination)
     """
-    if sort_algo not in ["date", "upvote"]:
+    if sort_algo == "trending":
+        return [TRENDING_SORT_SCORE, ChannelPost.post_id], True
+    elif sort_algo == "upvote":
+        return [ChannelPost.upvote_count, ChannelPost.post_id], True
+    return [ChannelPost.created_at, ChannelPost.post_id], True
+
+
+def channel_post_page_cursor(post: ChannelPost, sort_algo: str) -> str:
+    """
+    Returns the cursor to request the page after post
+
+    :param post: The last post of the current page
+    :param sort_algo: The sort order the page was found with
+    """
+    if sort_algo == "trending":
+        return encode_cursor(sort_algo, [get_trending_score("post", post.post_id), post.post_id])
+    columns, _ = channel_post_sort_columns(sort_algo)
+    return encode_cursor(sort_algo, [getattr(post, c.key) for c in columns])
+
+
+def decode_channel_post_cursor(cursor: str, sort_algo: str):
+    """
+    Decode a cursor created by channel_post_page_cursor()
+
+    :return The after value to pass to find_channel_posts() on success.
+            None if the cursor is invalid for this sort order
+    """
+    columns, _ = channel_post_sort_columns(sort_algo)
+    return decode_cursor(cursor, sort_algo, columns)
+
+
+def channel_post_search_query(conn, cid: int, sort_algo: str = "date", title_type="like",
+                              title=None, limit=None, after=None, with_stats: bool = False):
+    """
+    Build the query behind find_channel_posts(), see find_channel_posts() for the parameters
+
+    :param conn: The Session() initiated
+    :return The Query of matching ChannelPost rows, or (ChannelPost, User, PostStats)
+            rows if with_stats
+    """
+    if sort_algo not in ["date", "upvote", "trending"]:
         sort_algo = "date"
-    if title_type not in ["like", "exact"]:
+    if title_type not in ["like", "exact", "fulltext"]:
         title_type = "like"
 
+    posts = conn.query(ChannelPost).filter_by(cid=cid)
+    if title:
+        if title_type == "like":
+            posts = posts.filter(ChannelPost.title.ilike(f'%{title}%'))
+        elif title_type == "fulltext":
+            posts = posts.filter(fulltext_clause(conn, "post", ChannelPost.post_id, title))
+        else:
+            # exact match
+            posts = posts.filter_by(title=title)
+
+    if with_stats:
+        posts = posts.add_entity(User).join(User, User.uid == ChannelPost.uid). \
+            add_entity(PostStats).outerjoin(PostStats, PostStats.post_id == ChannelPost.post_id)
+
+    if sort_algo == "trending":
+        posts = trending_join(posts, "post")
+    columns, descending = channel_post_sort_columns(sort_algo)
+    posts = apply_keyset(posts, columns, descending, after)
+    if limit:
+        posts = posts.limit(limit)
+    return posts
+
+
+def fulltext_clause(conn, kind: str, key, query: str):
+    """
+    Returns the filter keeping items whose full-text index matches every word of query
+
+    :param conn: The Session() initiated
+    :param kind: The kind of item, one of SEARCH_KINDS
+    :param key: The id column of the item, e.g. Resource.rid
+    :param query: The string to search for
+    :return The filter clause, true() if query has no words to search for
+    """
+    terms = query_terms(query)
+    if not terms:
+        return true()
+    matches = match_query(conn.get_bind().dialect.name, kind, terms).subquery()
+    return key.in_(select(matches.c.id))
+
+
+def channel_access_clause(uid):
+    """
+    Returns the filter keeping channels a user has access to
+
+    :param uid: The id of the user, -1 for anonymous (public channels only)
+                and -2 for the demo user (all channels)
+    """
+    if uid == -2:
+        return true()
+    return or_(Channel.visibility == ChannelVisibility.PUBLIC,
+               Channel.cid.in_(get_access_set(uid).cids))
+
+
+def search(query: str, kinds: list = None, user=None, limit: int = SEARCH_LIMIT,
+           cid: int = None, **resource_filters) -> dict:
+    """
+    Full-text search of resources, channels and channel posts, best match first
+
+    Every word of query must match a word (or the start of one) of the title
+    or the description/text of an item. Items are ranked by text relevance
+    (ts_rank on postgres, bm25 on sqlite), which upvotes can boost up to
+    double. Only items the user has access to are returned.
+
+    :param query: The string to search for
+    :param kinds: The kinds of item to search, from SEARCH_KINDS.
+                  Defaults to all of them
+    :param user: The user searching, e.g. current_user. None for anonymous
+    :param limit: The maximum number of items of each kind to return, None for no limit
+    :param cid: Only search the posts of this channel
+    :param resource_filters: find_resources() filters to apply to resources,
+                             e.g. subject, grade or tags
+    :return dict mapping each kind searched to a list of (item, score) tuples
+    """
+    kinds = [k for k in (kinds or SEARCH_KINDS) if k in SEARCH_KINDS]
+    uid = getattr(user, "uid", -1)
+    email = getattr(user, "email", None)
+
+    out = {kind: [] for kind in kinds}
+    terms = query_terms(query)
+    if not terms:
+        return out
+
     with Session() as conn:
-        # posts = conn.query(ChannelPost)
-        posts = conn.query(ChannelPost).filter_by(cid=cid)
-        if title:
-            if title_type == "like":
-                posts = posts.filter(ChannelPost.title.ilike(f'%{title}%'))
+        dialect = conn.get_bind().dialect.name
+        for kind in kinds:
+            matches = match_query(dialect, kind, terms).subquery()
+            if kind == "resource":
+                items = resource_search_query(conn, email=email, **resource_filters).order_by(None)
+                key, votes = Resource.rid, Resource.upvote_count
+            elif kind == "channel":
+                items = conn.query(Channel).filter(channel_access_clause(uid))
+                key, votes = Channel.cid, None
             else:
-                # exact match
-                posts = posts.filter_by(title=title)
+                items = conn.query(ChannelPost).join(Channel, Channel.cid == ChannelPost.cid). \
+                    filter(channel_access_clause(uid))
+                if cid is not None:
+                    items = items.filter(ChannelPost.cid == cid)
+                key, votes = ChannelPost.post_id, ChannelPost.upvote_count
+
+            score = matches.c.rank
+            if votes is not None:
+                votes = cast(votes, Float)
+                score = score * (1 + votes / (votes + SEARCH_VOTE_SATURATION))
+            score = score.label("score")
+
+            out[kind] = [(item, item_score) for item, item_score in
+                         items.join(matches, matches.c.id == key).add_columns(score).
+                         order_by(score.desc(), key).limit(limit).all()]
+    return out
+
+
+def insert_if_absent(conn, model, values: dict) -> bool:
+    """
+    Insert a row unless one with the same primary key exists, in one statement
 
-        if sort_algo == "date":
-            # order by date
-            posts = posts.order_by(ChannelPost.created_at.desc())
+    :param conn: The Session() initiated
+    :param model: The model of the table to insert into
+    :param values: The column values of the row
+    :return True if the row was inserted, False if it already existed
+    """
+    dialect = conn.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(model).values(**values).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        statement = sqlite.insert(model).values(**values).on_conflict_do_nothing()
+    else:
+        # no upsert syntax, let the primary key reject duplicates
+        try:
+            with conn.begin_nested():
+                conn.execute(model.__table__.insert().values(**values))
+            return True
+        except sqlalchemy.exc.IntegrityError:
+            return False
+    return conn.execute(statement).rowcount == 1
+
+
+def upsert(conn, model, rows: list, columns: list):
+    """
+    Insert rows, or update some columns of the rows with the same primary key,
+    in one statement
+
+    :param conn: The Session() or connection initiated
+    :param model: The model of the table to write to
+    :param rows: The column values of each row
+    :param columns: The names of the columns updated when a row exists
+    """
+    if not rows:
+        return
+    bind = conn.get_bind() if hasattr(conn, "get_bind") else conn
+    dialect = bind.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = (postgresql if dialect == "postgresql" else sqlite).insert(model.__table__)
+        keys = [column.name for column in model.__table__.primary_key]
+        conn.execute(insert.on_conflict_do_update(
+            index_elements=keys, set_={name: insert.excluded[name] for name in columns}), rows)
+        return
+    # no upsert syntax, let the primary key tell which rows exist
+    table = model.__table__
+    for row in rows:
+        try:
+            with conn.begin_nested():
+                conn.execute(table.insert().values(**row))
+        except sqlalchemy.exc.IntegrityError:
+            conn.execute(table.update().where(*[column == row[column.name] for column in table.primary_key]).
+                         values(**{name: row[name] for name in columns}))
+
+
+def record_vote(conn, vote_model, target_model, key: str, item_id: int, uid: int, upvote: bool):
+    """
+    Record the vote of a user on an item and adjust the vote counts of the item
+
+    The vote info row is inserted or switched by the DB (never read first) and
+    the counts are changed by an UPDATE relative to their current value, so
+    concurrent votes on the same item are all counted. A first vote, the most
+    common kind, takes a single statement to record.
+
+    :param conn: The Session() initiated, the caller commits
+    :param vote_model: The vote info model, e.g. ResourceVoteInfo
+    :param target_model: The voted model, e.g. Resource
+    :param key: The name of the id column shared by both models, e.g. "rid"
+    :param item_id: The id of the voted item
+    :param uid: The voter's user id
+    :param upvote: is this is a upvote
+    :return The tuple of form upvote_change, downvote_change.
+            0, 0 if the user gave the same vote to this item before.
+            None if the DB rejected the vote (e.g. a lock timeout), in which case
+            the transaction is rolled back like try_to_commit() does
+    """
+    try:
+        if insert_if_absent(conn, vote_model, {key: item_id, "uid": uid, "is_upvote": upvote}):
+            change = (1, 0) if upvote else (0, 1)
+        elif conn.query(vote_model). \
+                filter(getattr(vote_model, key) == item_id, vote_model.uid == uid,
+                       vote_model.is_upvote != upvote). \
+                update({vote_model.is_upvote: upvote}, synchronize_session=False):
+            change = (1, -1) if upvote else (-1, 1)
         else:
-            # order by upvote_count
-            posts = posts.order_by(ChannelPost.upvote_count.desc())
-        return posts.all()
+            return 0, 0
+
+        with counts_only(conn):
+            conn.query(target_model).filter(getattr(target_model, key) == item_id). \
+                update({target_model.upvote_count: target_model.upvote_count + change[0],
+                        target_model.downvote_count: target_model.downvote_count + change[1]},
+                       synchronize_session=False)
+        return change
+    except sqlalchemy.exc.SQLAlchemyError:
+        if DEBUG_MODE:
+            raise
+        warnings.warn(traceback.format_exc())
+        conn.rollback()
+        warnings.warn("Transaction is roll-backed")
+        return None
 
 
 def vote_resource(uid, rid, upvote=True):
@@ -992,51 +2041,38 @@ def vote_resource(uid, rid, upvote=True):
             resource before.
             ErrorCode.COMMIT_ERROR if cannot commit (used when DEBUG_MODE is False)
     """
-    msg = "created"
-
-    res = check_user_and_resource_validity(uid=uid, rid=rid)
-    if isinstance(res, ErrorCode):
-        return res
-
-    user, resource = res
-
     with Session() as conn:
-        # try to find if there is an entry in vote_info
-        vote_info = conn.query(ResourceVoteInfo).filter_by(uid=uid, rid=rid).one_or_none()
-
-        if vote_info:
-            if vote_info.is_upvote != upvote:
-                # user voted, now change vote
-                vote_info.is_upvote = upvote
-
-                # update resource vote count
-                if upvote:
-                    resource.downvote_count -= 1
-                    resource.upvote_count += 1
-                else:
-                    resource.downvote_count += 1
-                    resource.upvote_count -= 1
-                msg = "updated"
-            else:
-                if VERBOSE:
-                    warnings.warn("user cannot vote the same item twice")
-                return ErrorCode.SAME_VOTE_TWICE
-        else:
-            # new vote
-            vote_info = ResourceVoteInfo(rid=rid, uid=uid, is_upvote=upvote)
-
-            if upvote:
-                resource.upvote_count += 1
-            else:
-                resource.downvote_count += 1
+        user_exists, resource_exists = conn.query(
+            conn.query(User).filter_by(uid=uid).exists(),
+            conn.query(Resource).filter_by(rid=rid).exists()).one()
+        if not resource_exists:
+            warnings.warn("rid is invalid")
+            return ErrorCode.INVALID_RESOURCE
+        elif not user_exists:
+            warnings.warn("uid is invalid")
+            return ErrorCode.INVALID_USER
 
-        conn.add(vote_info)
-        conn.add(resource)
+        change = record_vote(conn, ResourceVoteInfo, Resource, "rid", rid, uid, upvote)
+        if change is None:
+            return ErrorCode.COMMIT_ERROR
+        up, down = change
+        if not (up or down):
+            conn.rollback()
+            if VERBOSE:
+                warnings.warn("user cannot vote the same item twice")
+            return ErrorCode.SAME_VOTE_TWICE
+
+        # keep the rank of the resource in recommendations current
+        conn.query(RecommendationCandidate).filter_by(kind="resource", item_id=rid). \
+            update({RecommendationCandidate.score: RecommendationCandidate.score + up - down},
+                   synchronize_session=False)
+        adjust_trending(conn, {("resource", rid): up - down})
         if not try_to_commit(conn):
             warnings.warn(f"user {uid} vote resource {rid} failed")
             return ErrorCode.COMMIT_ERROR
+        db_writes.inc("vote", "resource")
         if VERBOSE:
-            warnings.warn(f"Vote info {msg} for resource {rid}, user {uid} upvoted = {upvote}")
+            warnings.warn(f"Vote info recorded for resource {rid}, user {uid} upvoted = {upvote}")
 
 
 def get_user_and_resource_instance(uid, rid):
@@ -1073,6 +2109,7 @@ def user_viewed_resource(uid, rid):
     with Session() as conn:
         resource_view = ResourceView(rid=rid, uid=uid)
         conn.add(resource_view)
+        adjust_trending(conn, {("resource", rid): TRENDING_VIEW_WEIGHT})
         if not try_to_commit(conn):
             warnings.warn(f"User {uid} view resource {rid} record cannot be committed")
             return ErrorCode.COMMIT_ERROR
@@ -1117,13 +2154,18 @@ def comment_to_resource(uid, rid, comment):
     with Session() as conn:
         resource_comment = ResourceComment(uid=uid, rid=rid, comment=comment, created_at=created_at)
         conn.add(resource_comment)
+        if not try_to_flush(conn):
+            warnings.warn(f"User {uid} comment resource {rid} failed")
+            return ErrorCode.COMMIT_ERROR
+        resource_comment_id = resource_comment.resource_comment_id
+        adjust_trending(conn, {("resource", rid): TRENDING_COMMENT_WEIGHT})
         if not try_to_commit(conn):
             warnings.warn(f"User {uid} comment resource {rid} failed")
             return ErrorCode.COMMIT_ERROR
+        db_writes.inc("comment", "resource")
     if VERBOSE:
         print(f"user {uid} commented resource {rid}")
-    return conn.query(ResourceComment). \
-        filter_by(uid=uid, rid=rid, created_at=created_at).one().resource_comment_id
+    return resource_comment_id
 
 
 def remove_resource_comment(resource_comment_id: int):
@@ -1133,10 +2175,13 @@ def remove_resource_comment(resource_comment_id: int):
     :param resource_comment_id: The id of the resource comment to be removed
     """
     with Session() as conn:
+        # locked, so the points of a comment removed twice at once are taken once
         comment = conn.query(ResourceComment). \
-            filter_by(resource_comment_id=resource_comment_id).one_or_none()
+            filter_by(resource_comment_id=resource_comment_id).with_for_update().one_or_none()
         if comment:
+            rid = comment.rid
             conn.delete(comment)
+            adjust_trending(conn, {("resource", rid): -TRENDING_COMMENT_WEIGHT})
             try_to_commit(conn)
 
 
@@ -1167,6 +2212,8 @@ def reply_to_resource_comment(uid, resource_comment_id, reply):
         conn.add(reply_to_comment)
         if not try_to_commit(conn):
             warnings.warn(f"user {uid} failed to reply to resource comment {resource_comment_id}")
+        else:
+            db_writes.inc("comment", "resource_comment")
 
         if VERBOSE:
             print(f"user {uid} replied to resource comment {resource_comment_id}")
@@ -1230,6 +2277,64 @@ def get_resource_comment_replies(resource_comment_instance_list: list) -> dict:
         return out
 
 
+# resource comments are listed newest first
+COMMENT_SORT_COLUMNS = [ResourceComment.resource_comment_id]
+
+
+def load_comment_thread(rid: int, limit: int = None, before: list = None):
+    """
+    Load the comments of a resource, their replies and their authors in three
+    queries, whatever the number of comments
+
+    :param rid: The resource id
+    :param limit: The maximum number of comments to load, None for all of them
+    :param before: The sort key of the last comment of the previous page, as
+                   returned by decode_comment_cursor(). Only older comments are loaded
+    :return tuple (comments, replies, authors) of
+            the list of ResourceComment instances, newest first;
+            dict of resource_comment_id -> list of ResourceCommentReply instances, oldest first;
+            dict of uid -> User instance of every comment and reply author
+    """
+    with Session() as conn:
+        comments = apply_keyset(conn.query(ResourceComment).filter_by(rid=rid),
+                                COMMENT_SORT_COLUMNS, True, before)
+        if limit:
+            comments = comments.limit(limit)
+        comments = comments.all()
+
+        replies = defaultdict(list)
+        if comments:
+            for reply in conn.query(ResourceCommentReply).filter(
+                    ResourceCommentReply.resource_comment_id.in_(
+                        [i.resource_comment_id for i in comments])). \
+                    order_by(ResourceCommentReply.created_at):
+                replies[reply.resource_comment_id].append(reply)
+
+        uids = {i.uid for i in comments} | {i.uid for thread in replies.values() for i in thread}
+        authors = {user.uid: user for user in
+                   conn.query(User).filter(User.uid.in_(uids))} if uids else {}
+    return comments, dict(replies), authors
+
+
+def comment_page_cursor(comment: ResourceComment) -> str:
+    """
+    Returns the cursor to request the comments older than comment
+
+    :param comment: The last comment of the current page
+    """
+    return encode_cursor("comment", [getattr(comment, c.key) for c in COMMENT_SORT_COLUMNS])
+
+
+def decode_comment_cursor(cursor: str):
+    """
+    Decode a cursor created by comment_page_cursor()
+
+    :return The before value to pass to load_comment_thread() on success.
+            None if the cursor is invalid
+    """
+    return decode_cursor(cursor, "comment", COMMENT_SORT_COLUMNS)
+
+
 def create_channel(name, visibility: ChannelVisibility, admin_uid, subject: Subject = None,
                    grade: Grade = None, description=None, tags_id: list = None,
                    personnel_id: list = None, avatar_link: str = DEFAULT_CHANNEL_AVATAR_LINK):
@@ -1270,12 +2375,14 @@ def create_channel(name, visibility: ChannelVisibility, admin_uid, subject: Subj
                           subject=subject, grade=grade, description=description,
                           avatar_link=avatar_link, created_at=created_at)
         conn.add(channel)
-        if not try_to_commit(conn):
+        # the channel, its tags, personnel, recommendation candidates and
+        # trending score are added in one transaction, the flush gives the id
+        # of the new channel
+        if not try_to_flush(conn):
             warnings.warn(f"channel {name} cannot be created")
             return ErrorCode.COMMIT_ERROR
+        cid = channel.cid
 
-        # phase 2: use name (unique) to retrieve instance for next step operation
-        channel = conn.query(Channel).filter_by(name=name).one()
         # get rid of duplicate
         if tags_id:
             tags_id = list(set(tags_id))
@@ -1283,28 +2390,35 @@ def create_channel(name, visibility: ChannelVisibility, admin_uid, subject: Subj
             personnel_id = list(set(personnel_id))
 
         for i in tags_id:
-            channel_tag_record = ChannelTagRecord(tag_id=i, cid=channel.cid)
+            channel_tag_record = ChannelTagRecord(tag_id=i, cid=cid)
             conn.add(channel_tag_record)
 
         if visibility != ChannelVisibility.PUBLIC:
             if admin_uid not in personnel_id:
                 # add admin to personnel if not in personnel id yet
-                personnel = ChannelPersonnel(cid=channel.cid, uid=admin_uid)
+                personnel = ChannelPersonnel(cid=cid, uid=admin_uid)
                 conn.add(personnel)
             for i in personnel_id:
-                personnel = ChannelPersonnel(cid=channel.cid, uid=i)
+                personnel = ChannelPersonnel(cid=cid, uid=i)
                 conn.add(personnel)
 
+        if not try_to_flush(conn):
+            warnings.warn(f"channel {name} cannot be created")
+            return ErrorCode.COMMIT_ERROR
+        update_recommendation(conn, "channel", cid)
+        update_trending(conn, "channel", [cid])
+        update_channel_stats(conn, [cid])
+        bump_cache_version(conn, "responses")
         if not try_to_commit(conn):
             warnings.warn(f"channel {name} cannot be created")
-            # delete obsolete channel object
-            conn.delete(channel)
-            conn.commit()
             return ErrorCode.COMMIT_ERROR
+        invalidate_responses()
+        if visibility != ChannelVisibility.PUBLIC:
+            invalidate_access_set(admin_uid, *personnel_id)
 
         if VERBOSE:
             print(f"Channel {name} created")
-        return channel.cid
+        return cid
 
 
 def get_all_tags_for_channel(cid: int) -> list:
@@ -1320,19 +2434,26 @@ def get_all_tags_for_channel(cid: int) -> list:
         if not channel:
             return []
 
-        tags = []
-        if channel.grade:
-            tags.append(enum_to_website_output(channel.grade).replace("_", " ", 1))
-        if channel.subject:
-            tags.append(enum_to_website_output(channel.subject).replace("_", " ", 1))
-
         tag_records = conn.query(ChannelTagRecord).filter_by(cid=cid).all()
 
         tag_map = get_tags(mapping="id2name")
-        for i in tag_records:
-            tags.append(tag_map[i.tag_id].replace("_", " "))
+        return channel_tag_names(channel, [tag_map[i.tag_id] for i in tag_records])
 
-        return tags
+
+def channel_tag_names(channel: Channel, tag_names: list) -> list:
+    """
+    Returns the tags of a channel as shown on the website
+
+    :param channel: The Channel
+    :param tag_names: The names of its tags, e.g. ChannelStats.tags
+    :return a list of tag names (grade + subject + other tags)
+    """
+    tags = []
+    if channel.grade:
+        tags.append(enum_to_website_output(channel.grade).replace("_", " ", 1))
+    if channel.subject:
+        tags.append(enum_to_website_output(channel.subject).replace("_", " ", 1))
+    return tags + [name.replace("_", " ") for name in tag_names]
 
 
 def get_user_and_channel_instance(uid, cid):
@@ -1393,6 +2514,7 @@ def modify_channel_personnel(uid, cid, modification: Modification):
         if not try_to_commit(conn):
             warnings.warn(f"user {uid} is failed to be {msg} from/to personnel of channel {cid}")
             return ErrorCode.COMMIT_ERROR
+        invalidate_access_set(uid)
         if VERBOSE:
             print(f"user {uid} is {msg} from/to personnel of channel {cid}")
 
@@ -1427,6 +2549,8 @@ def modify_channel(cid: int, name=None, visibility: ChannelVisibility = None,
                 ErrorCode.INVALID_CHANNEL if cid is invalid
                 ErrorCode.COMMIT_ERROR if cannot commit (used when DEBUG_MODE is False)
         """
+    # users losing access when the channel is made public
+    removed_personnel = []
     with Session() as conn:
         channel = conn.query(Channel).filter_by(cid=cid).one_or_none()
         if not channel:
@@ -1456,11 +2580,17 @@ def modify_channel(cid: int, name=None, visibility: ChannelVisibility = None,
             for i in new_tags:
                 tag = ChannelTagRecord(cid=cid, tag_id=i)
                 conn.add(tag)
+            if not try_to_flush(conn):
+                warnings.warn("Error committing")
+                return ErrorCode.COMMIT_ERROR
+            update_channel_stats(conn, [cid])
 
         if visibility and visibility != channel.visibility:
             if visibility == ChannelVisibility.PUBLIC:
                 # originally private, now public
                 channel.visibility = visibility
+                removed_personnel = [i.uid for i in
+                                     conn.query(ChannelPersonnel.uid).filter_by(cid=cid)]
                 conn.query(ChannelPersonnel).filter_by(cid=cid).delete()
             elif visibility != ChannelVisibility.PUBLIC:
                 # originally public, now private
@@ -1474,6 +2604,8 @@ def modify_channel(cid: int, name=None, visibility: ChannelVisibility = None,
         if not try_to_commit(conn):
             warnings.warn("Error committing")
             return ErrorCode.COMMIT_ERROR
+        if removed_personnel:
+            invalidate_access_set(*removed_personnel)
 
         # now deal with ids add/delete to/from personnel
         channel = conn.query(Channel).filter_by(cid=cid).one_or_none()
@@ -1488,9 +2620,13 @@ def modify_channel(cid: int, name=None, visibility: ChannelVisibility = None,
             for i in personnel_ids:
                 modify_channel_personnel(uid=i, cid=cid, modification=Modification.MODIFY_ADD)
 
+        bump_cache_version(conn, "responses")
         if not try_to_commit(conn):
             warnings.warn("Error committing")
             return ErrorCode.COMMIT_ERROR
+        invalidate_responses()
+    # subject, grade or visibility may have changed
+    refresh_recommendation("channel", cid)
 
 
 def user_has_access_to_channel(uid, cid):
@@ -1502,19 +2638,19 @@ def user_has_access_to_channel(uid, cid):
     :return True/False on success.
     """
     with Session() as conn:
-        res = get_user_and_channel_instance(uid=uid, cid=cid)
-        if isinstance(res, ErrorCode):
-            # invalid user or channel instance, return False directly
-            return False
-        channel = res[1]
-        if channel.visibility == ChannelVisibility.PUBLIC:
-            # NOTE: Here changed error to True since all users have access to
-            # public channels
-            return True
+        # check user and channel in one round trip, visibility is None if cid is invalid
+        user_exists, visibility = conn.query(
+            conn.query(User).filter_by(uid=uid).exists(),
+            conn.query(Channel.visibility).filter_by(cid=cid).scalar_subquery()).one()
+    if not user_exists or visibility is None:
+        # invalid user or channel instance, return False directly
+        return False
+    if visibility == ChannelVisibility.PUBLIC:
+        # NOTE: Here changed error to True since all users have access to
+        # public channels
+        return True
 
-        personnel = conn.query(ChannelPersonnel).filter_by(uid=uid, cid=cid). \
-            one_or_none()
-        return personnel is not None
+    return int(cid) in get_access_set(uid).cids
 
 
 def post_on_channel(uid, title, text, channel_name=None, cid=None):
@@ -1538,7 +2674,8 @@ def post_on_channel(uid, title, text, channel_name=None, cid=None):
         warnings.warn("Please supply channel name or cid")
         return ErrorCode.INVALID_CHANNEL
     with Session() as conn:
-        if not conn.query(User).filter_by(uid=uid).one_or_none():
+        poster = conn.query(User).filter_by(uid=uid).one_or_none()
+        if not poster:
             warnings.warn("invalid uid")
             return ErrorCode.INVALID_USER
 
@@ -1563,14 +2700,38 @@ def post_on_channel(uid, title, text, channel_name=None, cid=None):
         channel_post = ChannelPost(uid=uid, cid=channel.cid, title=title, init_text=text,
                                    created_at=created_at)
         conn.add(channel_post)
-        if not try_to_commit(conn):
+        if not try_to_flush(conn):
             warnings.warn(f"post {title} by user {uid} failed to be added to {channel.name}")
             return ErrorCode.COMMIT_ERROR
+        post_id, cid, channel_name = channel_post.post_id, channel.cid, channel.name
+
+        # the new post is the latest of its channel, unless a later post committed first
+        stats = ChannelStats.__table__
+        latest = or_(stats.c.last_post_at.is_(None), stats.c.last_post_at < created_at)
+        if not conn.execute(stats.update().where(stats.c.cid == cid).values(
+                post_count=stats.c.post_count + 1,
+                last_post_at=case((latest, created_at), else_=stats.c.last_post_at),
+                last_poster_uid=case((latest, uid), else_=stats.c.last_poster_uid),
+                last_poster_username=case((latest, poster.username),
+                                          else_=stats.c.last_poster_username))).rowcount:
+            update_channel_stats(conn, [cid])
+        conn.execute(PostStats.__table__.insert().values(post_id=post_id, comment_count=0))
+        # channels are ranked by their number of posts
+        update_recommendation(conn, "channel", cid)
+        update_trending(conn, "post", [post_id])
+        # a channel has a point per post and is active as of its latest one
+        adjust_trending(conn, {("channel", cid): 1}, active_at=created_at)
+        # the post count and latest post of the channel are listed
+        bump_cache_version(conn, "responses")
+        if not try_to_commit(conn):
+            warnings.warn(f"post {title} by user {uid} failed to be added to {channel_name}")
+            return ErrorCode.COMMIT_ERROR
+        invalidate_responses()
+        db_writes.inc("post", "channel")
 
-        channel_post = conn.query(ChannelPost).filter_by(cid=channel.cid, title=title).one()
         if VERBOSE:
-            print(f"post {title} by user {uid} is added to {channel.name}")
-        return channel_post.post_id
+            print(f"post {title} by user {uid} is added to {channel_name}")
+    return post_id
 
 
 def modify_channel_post(post_id: int, title: str = None, text: str = None):
@@ -1610,8 +2771,17 @@ def remove_channel_post(post_id: int):
     with Session() as conn:
         post = conn.query(ChannelPost).filter_by(post_id=post_id).one_or_none()
         if post:
+            cid = post.cid
             conn.delete(post)
-            try_to_commit(conn)
+            if not try_to_flush(conn):
+                return
+            update_channel_stats(conn, [cid])
+            update_post_stats(conn, [post_id])
+            bump_cache_version(conn, "responses")
+            if try_to_commit(conn):
+                invalidate_responses()
+                refresh_recommendation("channel", cid)
+                refresh_post_trending(post_id, cid)
 
 
 def comment_on_channel_post(uid, post_id, text):
@@ -1628,26 +2798,45 @@ def comment_on_channel_post(uid, post_id, text):
             ErrorCode.COMMIT_ERROR if cannot commit (used when DEBUG_MODE is False)
     """
     with Session() as conn:
-        if not conn.query(User).filter_by(uid=uid).one_or_none():
+        commenter = conn.query(User).filter_by(uid=uid).one_or_none()
+        if not commenter:
             warnings.warn("uid is invalid")
             return ErrorCode.INVALID_USER
-        elif not conn.query(ChannelPost).filter_by(post_id=post_id).one_or_none():
+        post = conn.query(ChannelPost).filter_by(post_id=post_id).one_or_none()
+        if not post:
             warnings.warn("post_id is invalid")
             return ErrorCode.INVALID_POST
+        cid = post.cid
 
         created_at = datetime.datetime.now(tz=pytz.timezone("Australia/Brisbane"))
         post_comment = PostComment(post_id=post_id, uid=uid, created_at=created_at,
                                    text=text)
         conn.add(post_comment)
+        if not try_to_flush(conn):
+            warnings.warn(f"Comment to post {post_id} by user {uid} failed")
+            return ErrorCode.COMMIT_ERROR
+        post_comment_id = post_comment.post_comment_id
+
+        # the new comment is the latest of its post, unless a later comment committed first
+        stats = PostStats.__table__
+        latest = or_(stats.c.last_comment_at.is_(None), stats.c.last_comment_at < created_at)
+        if not conn.execute(stats.update().where(stats.c.post_id == post_id).values(
+                comment_count=stats.c.comment_count + 1,
+                last_comment_at=case((latest, created_at), else_=stats.c.last_comment_at),
+                last_commenter_uid=case((latest, uid), else_=stats.c.last_commenter_uid),
+                last_commenter_username=case((latest, commenter.username),
+                                             else_=stats.c.last_commenter_username))).rowcount:
+            update_post_stats(conn, [post_id])
+        adjust_trending(conn, {("post", post_id): TRENDING_COMMENT_WEIGHT,
+                               ("channel", cid): TRENDING_COMMENT_WEIGHT})
         if not try_to_commit(conn):
             warnings.warn(f"Comment to post {post_id} by user {uid} failed")
             return ErrorCode.COMMIT_ERROR
+        db_writes.inc("comment", "post")
 
-        post_comment = conn.query(PostComment).filter_by(post_id=post_id, uid=uid,
-                                                         created_at=created_at).one()
         if VERBOSE:
             print(f"Comment to post {post_id} by user {uid} is created")
-        return post_comment.post_comment_id
+        return post_comment_id
 
 
 def remove_channel_post_comment(post_comment_id: int):
@@ -1657,10 +2846,17 @@ def remove_channel_post_comment(post_comment_id: int):
     :param post_comment_id: The id of channel post comment
     """
     with Session() as conn:
+        # locked, so the points of a comment removed twice at once are taken once
         channel_post_comment = conn.query(PostComment). \
-            filter_by(post_comment_id=post_comment_id).one_or_none()
+            filter_by(post_comment_id=post_comment_id).with_for_update().one_or_none()
         if channel_post_comment:
+            post_id, cid = channel_post_comment.post_id, channel_post_comment.thread.cid
             conn.delete(channel_post_comment)
+            if not try_to_flush(conn):
+                return
+            update_post_stats(conn, [post_id])
+            adjust_trending(conn, {("post", post_id): -TRENDING_COMMENT_WEIGHT,
+                                   ("channel", cid): -TRENDING_COMMENT_WEIGHT})
             try_to_commit(conn)
 
 
@@ -1679,46 +2875,33 @@ def vote_channel_post(uid, post_id, upvote=True):
             ErrorCode.COMMIT_ERROR if cannot commit (used when DEBUG_MODE is False)
     """
     with Session() as conn:
-        user = conn.query(User).filter_by(uid=uid).one_or_none()
-        post = conn.query(ChannelPost).filter_by(post_id=post_id).one_or_none()
-        if not user:
+        user_exists, cid = conn.query(
+            conn.query(User).filter_by(uid=uid).exists(),
+            conn.query(ChannelPost.cid).filter_by(post_id=post_id).scalar_subquery()).one()
+        if not user_exists:
             warnings.warn("uid is invalid")
             return ErrorCode.INVALID_USER
-        elif not post:
+        elif cid is None:
             warnings.warn("post id is invalid")
             return ErrorCode.INVALID_POST
 
-        # try to find if there is an entry in vote_info
-        vote = conn.query(ChannelPostVoteInfo).filter_by(uid=uid, post_id=post_id).one_or_none()
-        if vote:
-            if vote.is_upvote != upvote:
-                # user voted, now change vote
-                vote.is_upvote = upvote
-
-                # update resource vote count
-                if upvote:
-                    post.downvote_count -= 1
-                    post.upvote_count += 1
-                else:
-                    post.downvote_count += 1
-                    post.upvote_count -= 1
-            else:
-                if VERBOSE:
-                    warnings.warn("user cannot vote the same item twice")
-                return ErrorCode.SAME_VOTE_TWICE
-        else:
-            # new vote
-            vote = ChannelPostVoteInfo(uid=uid, post_id=post_id, is_upvote=upvote)
-            if upvote:
-                post.upvote_count += 1
-            else:
-                post.downvote_count += 1
+        change = record_vote(conn, ChannelPostVoteInfo, ChannelPost, "post_id", post_id,
+                             uid, upvote)
+        if change is None:
+            return ErrorCode.COMMIT_ERROR
+        if change == (0, 0):
+            conn.rollback()
+            if VERBOSE:
+                warnings.warn("user cannot vote the same item twice")
+            return ErrorCode.SAME_VOTE_TWICE
 
-        conn.add(vote)
-        conn.add(post)
+        # a channel has the points of all its posts
+        adjust_trending(conn, {("post", post_id): change[0] - change[1],
+                               ("channel", cid): change[0] - change[1]})
         if not try_to_commit(conn):
             warnings.warn(f"User {uid} failed vote to post {post_id}")
             return ErrorCode.COMMIT_ERROR
+        db_writes.inc("vote", "post")
         if VERBOSE:
             print(f"User {uid} voted post {post_id}, is_upvote = {upvote}")
 
@@ -1738,49 +2921,30 @@ def vote_channel_post_comment(uid, post_comment_id, upvote=True):
             ErrorCode.COMMIT_ERROR if cannot commit (used when DEBUG_MODE is False)
     """
     with Session() as conn:
-        user = conn.query(User).filter_by(uid=uid).one_or_none()
-        post_comment = conn.query(PostComment).filter_by(post_comment_id=post_comment_id). \
-            one_or_none()
-        if not user:
+        user_exists, post_comment_exists = conn.query(
+            conn.query(User).filter_by(uid=uid).exists(),
+            conn.query(PostComment).filter_by(post_comment_id=post_comment_id).exists()).one()
+        if not user_exists:
             warnings.warn("uid is invalid")
             return ErrorCode.INVALID_USER
-        elif not post_comment:
+        elif not post_comment_exists:
             warnings.warn("post id is invalid")
             return ErrorCode.INVALID_POST
 
-        # try to find if there is an entry in vote_info
-        vote = conn.query(PostCommentVoteInfo).filter_by(
-            uid=uid, post_comment_id=post_comment_id).one_or_none()
-        if vote:
-            if vote.is_upvote != upvote:
-                # user voted, now change vote
-                vote.is_upvote = upvote
-
-                # update resource vote count
-                if upvote:
-                    post_comment.downvote_count -= 1
-                    post_comment.upvote_count += 1
-                else:
-                    post_comment.downvote_count += 1
-                    post_comment.upvote_count -= 1
-            else:
-                if VERBOSE:
-                    warnings.warn("user cannot vote the same item twice")
-                return ErrorCode.SAME_VOTE_TWICE
-        else:
-            # new vote
-            vote = PostCommentVoteInfo(uid=uid, post_comment_id=post_comment_id,
-                                       is_upvote=upvote)
-            if upvote:
-                post_comment.upvote_count += 1
-            else:
-                post_comment.downvote_count += 1
+        change = record_vote(conn, PostCommentVoteInfo, PostComment, "post_comment_id",
+                             post_comment_id, uid, upvote)
+        if change is None:
+            return ErrorCode.COMMIT_ERROR
+        if change == (0, 0):
+            conn.rollback()
+            if VERBOSE:
+                warnings.warn("user cannot vote the same item twice")
+            return ErrorCode.SAME_VOTE_TWICE
 
-        conn.add(vote)
-        conn.add(post_comment)
         if not try_to_commit(conn):
             warnings.warn(f"User {uid} failed to vote post {post_comment_id}")
             return ErrorCode.COMMIT_ERROR
+        db_writes.inc("vote", "comment")
         if VERBOSE:
             print(f"User {uid} voted post {post_comment_id}, is_upvote = {upvote}")
 
@@ -1802,6 +2966,67 @@ def get_channel_post_comments(post_id: int):
             order_by(PostComment.created_at.asc()).all()
 
 
+# a channel post with its channel, its author, a page of its comments and
+# uid -> User of their authors, see load_post_page()
+PostPage = namedtuple("PostPage", ["post", "channel", "author", "comments", "commenters"])
+
+# channel post comments are listed oldest first
+POST_COMMENT_SORT_COLUMNS = [PostComment.created_at, PostComment.post_comment_id]
+
+
+def load_post_page(cid: int, post_id: int, limit: int = None, after: list = None):
+    """
+    Load everything the page of a channel post shows in three queries: the post
+    with its channel and author, a page of its comments, and their authors
+
+    :param cid: The id of the channel the post is in
+    :param post_id: The id of the post
+    :param limit: The maximum number of comments to load, None for all of them
+    :param after: The sort key of the last comment of the previous page, as
+                  returned by decode_post_comment_cursor()
+    :return PostPage on success, comments oldest first.
+            None if there is no such post in channel cid
+    """
+    with Session() as conn:
+        row = conn.query(ChannelPost, Channel, User). \
+            join(Channel, Channel.cid == ChannelPost.cid). \
+            join(User, User.uid == ChannelPost.uid). \
+            filter(ChannelPost.post_id == post_id, ChannelPost.cid == cid).one_or_none()
+        if row is None:
+            return None
+        post, channel, author = row
+
+        comments = apply_keyset(conn.query(PostComment).filter_by(post_id=post_id),
+                                POST_COMMENT_SORT_COLUMNS, False, after)
+        if limit:
+            comments = comments.limit(limit)
+        comments = comments.all()
+
+        uids = {i.uid for i in comments}
+        commenters = {user.uid: user for user in
+                      conn.query(User).filter(User.uid.in_(uids))} if uids else {}
+    return PostPage(post, channel, author, comments, commenters)
+
+
+def post_comment_page_cursor(comment: PostComment) -> str:
+    """
+    Returns the cursor to request the comments after comment
+
+    :param comment: The last comment of the current page
+    """
+    return encode_cursor("post_comment", [getattr(comment, c.key) for c in POST_COMMENT_SORT_COLUMNS])
+
+
+def decode_post_comment_cursor(cursor: str):
+    """
+    Decode a cursor created by post_comment_page_cursor()
+
+    :return The after value to pass to load_post_page() on success.
+            None if the cursor is invalid
+    """
+    return decode_cursor(cursor, "post_comment", POST_COMMENT_SORT_COLUMNS)
+
+
 def get_channel_post(cid: int):
     """
     Returns a list of all posts on a channel
@@ -1812,3 +3037,546 @@ def get_channel_post(cid: int):
     """
     with Session() as conn:
         return conn.query(ChannelPost).filter_by(cid=cid).all()
+
+
+def recommendation_buckets(subject: Subject = None, grade: Grade = None,
+                           with_all: bool = True) -> list:
+    """
+    Returns the recommendation buckets of an item, or of a user teaching area
+
+    :param subject: The subject of the item
+    :param grade: The grade of the item
+    :param with_all: Whether to include RECOMMEND_ALL_BUCKET
+    :return list of bucket names
+    """
+    buckets = [RECOMMEND_ALL_BUCKET] if with_all else []
+    if subject is not None and subject != Subject.NULL:
+        buckets.append(f"subject:{subject.name}")
+    if grade is not None and grade != Grade.NULL:
+        buckets.append(f"grade:{grade.name}")
+    return buckets
+
+
+def _candidate_rows(kind: str, item_id: int, subject, grade, score: int, is_public: bool) -> list:
+    return [dict(bucket=bucket, kind=kind, item_id=item_id, score=score, is_public=is_public)
+            for bucket in recommendation_buckets(subject, grade)]
+
+
+def _resource_candidate_rows(conn, rids=None) -> list:
+    query = select(Resource.rid, Resource.subject, Resource.grade,
+                   Resource.upvote_count - Resource.downvote_count, Resource.is_public)
+    if rids is not None:
+        query = query.where(Resource.rid.in_(rids))
+    return [row for rid, subject, grade, score, is_public in conn.execute(query)
+            for row in _candidate_rows("resource", rid, subject, grade, score, is_public)]
+
+
+def _channel_candidate_rows(conn, cids=None) -> list:
+    # only public channels are recommended, ranked by their number of posts
+    post_counts = select(ChannelPost.cid, func.count().label("post_count")). \
+        group_by(ChannelPost.cid).subquery()
+    query = select(Channel.cid, Channel.subject, Channel.grade,
+                   func.coalesce(post_counts.c.post_count, 0)). \
+        outerjoin(post_counts, post_counts.c.cid == Channel.cid). \
+        where(Channel.visibility == ChannelVisibility.PUBLIC)
+    if cids is not None:
+        query = query.where(Channel.cid.in_(cids))
+    return [row for cid, subject, grade, score in conn.execute(query)
+            for row in _candidate_rows("channel", cid, subject, grade, score, True)]
+
+
+def rebuild_recommendations(conn):
+    """
+    Recompute every recommendation candidate from scratch
+
+    :param conn: The Session() or connection to rebuild with, the caller commits
+    """
+    conn.execute(RecommendationCandidate.__table__.delete())
+    rows = _resource_candidate_rows(conn) + _channel_candidate_rows(conn)
+    if rows:
+        conn.execute(RecommendationCandidate.__table__.insert(), rows)
+
+
+def update_recommendation(conn, kind: str, item_id: int):
+    """
+    Recompute the recommendation candidates of a resource or channel within
+    the transaction of conn, so they change together with the item
+
+    Its candidates are locked before they are recomputed, so the score changes
+    made meanwhile by relative UPDATEs (see vote_resource) apply on top of them
+
+    :param conn: The Session() initiated, the caller commits
+    :param kind: "resource" or "channel"
+    :param item_id: The rid or cid
+    """
+    # ids may come straight from a request
+    item_id = int(item_id)
+    table = RecommendationCandidate.__table__
+    conn.execute(select(table.c.bucket).where(table.c.kind == kind, table.c.item_id == item_id).
+                 order_by(table.c.bucket).with_for_update())
+    if kind == "resource":
+        rows = _resource_candidate_rows(conn, [item_id])
+    else:
+        rows = _channel_candidate_rows(conn, [item_id])
+    upsert(conn, RecommendationCandidate, rows, ["score", "is_public"])
+    # the buckets the item left, e.g. after its subject changed
+    conn.execute(table.delete().where(table.c.kind == kind, table.c.item_id == item_id,
+                                      table.c.bucket.not_in([row["bucket"] for row in rows])))
+
+
+def refresh_recommendation(kind: str, item_id: int):
+    """
+    Recompute the recommendation candidates of a resource or channel
+    after it has been modified or removed
+
+    :param kind: "resource" or "channel"
+    :param item_id: The rid or cid
+    """
+    with Session() as conn:
+        update_recommendation(conn, kind, item_id)
+        try_to_commit(conn)
+
+
+def get_recommendations(uid: int, kind: str, buckets: list, k: int, exclude=()) -> list:
+    """
+    Returns the k best recommendation candidates over some buckets
+
+    Only the top candidates of each bucket are read (one index range scan per
+    bucket), then merged, so the cost does not depend on the catalogue size.
+
+    :param uid: The user to recommend to, -1 for anonymous and -2 for the demo user
+    :param kind: "resource" or "channel"
+    :param buckets: The buckets to merge, see recommendation_buckets()
+    :param k: The number of candidates to return
+    :param exclude: The ids that must not be recommended
+    :return list of at most k rids or cids, best first
+    """
+    buckets = list(dict.fromkeys(buckets))
+    if k <= 0 or not buckets:
+        return []
+    exclude = set(exclude)
+
+    if uid == -2:
+        visible = true()
+    elif kind == "resource":
+        visible = or_(RecommendationCandidate.is_public.is_(True),
+                      RecommendationCandidate.item_id.in_(get_access_set(uid).rids))
+    else:
+        visible = RecommendationCandidate.is_public.is_(True)
+
+    tops = []
+    for bucket in buckets:
+        top = select(RecommendationCandidate.item_id, RecommendationCandidate.score). \
+            where(RecommendationCandidate.kind == kind, RecommendationCandidate.bucket == bucket,
+                  visible). \
+            order_by(RecommendationCandidate.score.desc(), RecommendationCandidate.item_id.desc()). \
+            limit(k + len(exclude)).subquery()
+        tops.append(select(top.c.item_id, top.c.score))
+
+    with Session() as conn:
+        rows = conn.execute(union_all(*tops) if len(tops) > 1 else tops[0]).all()
+
+    # an item is a candidate of several buckets with the same score
+    scores = {item_id: score for item_id, score in rows if item_id not in exclude}
+    best = heapq.nlargest(k, scores.items(), key=lambda x: (x[1], x[0]))
+    return [item_id for item_id, _ in best]
+
+
+def load_channel_cards(cids: list) -> list:
+    """
+    Load everything needed to display a list of channel cards using a fixed
+    number of queries regardless of how many cids are given
+
+    :param cids: The ids of the channels to load. The order is kept, duplicates
+                 and ids that do not exist are skipped
+    :return a list of dicts, one per channel, of the form
+            Channel.serialize + {"admin": User.serialize, "posts": number of posts}
+    """
+    cids = list(dict.fromkeys(cids))
+    if not cids:
+        return []
+
+    with Session() as conn:
+        channels = {c.cid: c for c in conn.query(Channel).filter(Channel.cid.in_(cids))}
+        admins = {u.uid: u for u in conn.query(User).filter(
+            User.uid.in_({c.admin_uid for c in channels.values()}))}
+        post_counts = dict(conn.query(ChannelPost.cid, func.count()).
+                           filter(ChannelPost.cid.in_(cids)).group_by(ChannelPost.cid))
+
+        cards = []
+        for cid in cids:
+            channel = channels.get(cid)
+            if channel is None:
+                continue
+            admin = admins.get(channel.admin_uid)
+            cards.append(dict(channel.serialize, admin=admin.serialize if admin else None,
+                              posts=post_counts.get(cid, 0)))
+        return cards
+
+
+def trending_score(points: float, active_at: datetime.datetime) -> int:
+    """
+    Returns the trending score of an item with points last active at active_at
+
+    The score is log10(points) plus the number of TRENDING_DECAY_SECONDS between
+    TRENDING_EPOCH and active_at, so newer items outrank older ones with a
+    similar number of points. As it does not depend on the current time, the
+    order of scores never changes while items are idle and a score only needs
+    recomputing when the item gets new votes, views or comments
+
+    :param points: The points of the item, negative if downvoted
+    :param active_at: The time the item was created, or last posted in for channels
+    :return The score, in units of 1 / TRENDING_PRECISION
+    """
+    if active_at.tzinfo is None:
+        # sqlite drops the timezone, times are stored in Brisbane time
+        active_at = pytz.timezone("Australia/Brisbane").localize(active_at)
+    order = math.log10(max(abs(points), 1))
+    sign = (points > 0) - (points < 0)
+    age = (active_at - TRENDING_EPOCH).total_seconds()
+    return round((sign * order + age / TRENDING_DECAY_SECONDS) * TRENDING_PRECISION)
+
+
+def _count(model, key, column):
+    # correlated count of the rows of model whose key is column
+    return select(func.count()).select_from(model).where(key == column).scalar_subquery()
+
+
+def _trending_rows(conn, kind: str, ids=None) -> list:
+    if kind == "resource":
+        query = select(Resource.rid, Resource.created_at,
+                       Resource.upvote_count - Resource.downvote_count
+                       + TRENDING_COMMENT_WEIGHT * _count(ResourceComment, ResourceComment.rid,
+                                                          Resource.rid)
+                       + TRENDING_VIEW_WEIGHT * _count(ResourceView, ResourceView.rid,
+                                                       Resource.rid))
+        key = Resource.rid
+    elif kind == "post":
+        query = select(ChannelPost.post_id, ChannelPost.created_at,
+                       ChannelPost.upvote_count - ChannelPost.downvote_count
+                       + TRENDING_COMMENT_WEIGHT * _count(PostComment, PostComment.post_id,
+                                                          ChannelPost.post_id))
+        key = ChannelPost.post_id
+    else:
+        # a channel has the points of all its posts plus one per post, and is
+        # active as of its latest post
+        posts = select(ChannelPost.cid,
+                       func.max(ChannelPost.created_at).label("active_at"),
+                       func.count().label("post_count"),
+                       func.sum(ChannelPost.upvote_count - ChannelPost.downvote_count).label("votes")). \
+            group_by(ChannelPost.cid)
+        comments = select(ChannelPost.cid, func.count().label("comment_count")). \
+            join(PostComment, PostComment.post_id == ChannelPost.post_id). \
+            group_by(ChannelPost.cid)
+        if ids is not None:
+            posts = posts.where(ChannelPost.cid.in_(ids))
+            comments = comments.where(ChannelPost.cid.in_(ids))
+        posts, comments = posts.subquery(), comments.subquery()
+        query = select(Channel.cid, func.coalesce(posts.c.active_at, Channel.created_at),
+                       func.coalesce(posts.c.post_count + posts.c.votes, 0)
+                       + TRENDING_COMMENT_WEIGHT * func.coalesce(comments.c.comment_count, 0)). \
+            outerjoin(posts, posts.c.cid == Channel.cid). \
+            outerjoin(comments, comments.c.cid == Channel.cid)
+        key = Channel.cid
+    if ids is not None:
+        query = query.where(key.in_(ids))
+    return [dict(kind=kind, item_id=item_id, points=float(points), active_at=active_at,
+                 score=trending_score(points, active_at))
+            for item_id, active_at, points in conn.execute(query)]
+
+
+def _trending_ids(conn, kind: str):
+    # the ids of every item of a kind, in order
+    key = TRENDING_KEYS[kind]
+    return conn.execute(select(key).order_by(key)).scalars().all()
+
+
+def _drop_orphan_trending(conn, kind: str):
+    # scores of items removed without the DBFunc functions (e.g. in psql)
+    table = TrendingScore.__table__
+    conn.execute(table.delete().where(table.c.kind == kind,
+                                      table.c.item_id.not_in(select(TRENDING_KEYS[kind]))))
+
+
+def rebuild_trending(conn):
+    """
+    Recompute the trending score of every resource, channel and channel post,
+    TRENDING_REFRESH_BATCH items at a time
+
+    :param conn: The Session() or connection to rebuild with, the caller commits
+    """
+    for kind in TRENDING_KEYS:
+        ids = _trending_ids(conn, kind)
+        for i in range(0, len(ids), TRENDING_REFRESH_BATCH):
+            update_trending(conn, kind, ids[i:i + TRENDING_REFRESH_BATCH])
+        _drop_orphan_trending(conn, kind)
+
+
+def get_trending_score(kind: str, item_id: int) -> int:
+    """
+    Returns the trending score an item is listed by, as TRENDING_SORT_SCORE
+
+    :param kind: "resource", "channel" or "post"
+    :param item_id: The rid, cid or post_id
+    :return The stored score, TRENDING_MISSING_SCORE if it has none yet
+    """
+    with Session() as conn:
+        score = conn.query(TrendingScore.score).filter_by(kind=kind, item_id=item_id).scalar()
+    return TRENDING_MISSING_SCORE if score is None else score
+
+
+def trending_join(query, kind: str):
+    """
+    Join the trending scores of the items of a query, to order it by
+    TRENDING_SORT_SCORE. Items without a stored score are kept
+
+    :param query: The Query of Resource, Channel or ChannelPost rows
+    :param kind: "resource", "channel" or "post"
+    :return The joined Query
+    """
+    return query.outerjoin(TrendingScore, and_(TrendingScore.kind == kind,
+                                               TrendingScore.item_id == TRENDING_KEYS[kind]))
+
+
+def update_trending(conn, kind: str, item_ids: list):
+    """
+    Recompute the trending score of some items from all their votes, views and
+    comments within the transaction of conn, e.g. when they are created or
+    removed. adjust_trending() follows the activity of existing items
+
+    Their scores are locked before their points are counted, so the points
+    added meanwhile by adjust_trending() are added on top of the recomputed
+    ones rather than overwritten by them
+
+    :param conn: The Session() or connection initiated, the caller commits
+    :param kind: "resource", "channel" or "post"
+    :param item_ids: The rids, cids or post_ids
+    """
+    # ids may come straight from a request
+    item_ids = [int(item_id) for item_id in item_ids]
+    table = TrendingScore.__table__
+    conn.execute(select(table.c.item_id).where(table.c.kind == kind, table.c.item_id.in_(item_ids)).
+                 order_by(table.c.item_id).with_for_update())
+    rows = _trending_rows(conn, kind, item_ids)
+    upsert(conn, TrendingScore, rows, ["score", "points", "active_at"])
+    removed = set(item_ids) - {row["item_id"] for row in rows}
+    if removed:
+        conn.execute(table.delete().where(table.c.kind == kind, table.c.item_id.in_(removed)))
+
+
+def adjust_trending(conn, points: dict, active_at=None):
+    """
+    Add points to the trending score of some items within the transaction of
+    conn, so the score changes together with the votes, views or comments it
+    counts
+
+    The points are changed by an UPDATE relative to their current value and
+    the score is computed from the result, so concurrent writers to the same
+    item wait for each other instead of overwriting each other. Items of any
+    kind are adjusted with the same three statements, e.g. a channel post and
+    its channel
+
+    :param conn: The Session() initiated, the caller commits
+    :param points: dict of (kind, item id) -> points to add, e.g.
+                   {("resource", rid): TRENDING_COMMENT_WEIGHT} for a new comment.
+                   kind is "resource", "channel" or "post"
+    :param active_at: The new activity time of the items, e.g. of a channel posted in
+    """
+    # ids may come straight from a request, items gaining no point are left alone
+    points = {(kind, int(item_id)): delta for (kind, item_id), delta in points.items()
+              if delta or active_at is not None}
+    if not points:
+        return
+    table = TrendingScore.__table__
+    keyed = and_(table.c.kind == bindparam("b_kind"), table.c.item_id == bindparam("b_id"))
+    values = dict(points=table.c.points + bindparam("b_points"))
+    if active_at is not None:
+        # never back in time, writers may commit out of order
+        values["active_at"] = case((or_(table.c.active_at.is_(None), table.c.active_at < active_at),
+                                    active_at), else_=table.c.active_at)
+    # in key order so writers to several items lock them in the same order
+    conn.execute(table.update().where(keyed).values(**values),
+                 [{"b_kind": kind, "b_id": item_id, "b_points": points[kind, item_id]}
+                  for kind, item_id in sorted(points)])
+    rows = conn.execute(select(table.c.kind, table.c.item_id, table.c.points, table.c.active_at).
+                        where(tuple_(table.c.kind, table.c.item_id).in_(list(points)))).all()
+    if rows:
+        conn.execute(table.update().where(keyed).values(score=bindparam("b_score")),
+                     [{"b_kind": kind, "b_id": item_id, "b_score": trending_score(total, active)}
+                      for kind, item_id, total, active in rows])
+    missing = set(points) - {(kind, item_id) for kind, item_id, _, _ in rows}
+    for kind in sorted({kind for kind, _ in missing}):
+        # no score stored yet, count every point
+        update_trending(conn, kind, [item_id for k, item_id in missing if k == kind])
+
+
+def refresh_trending(kind: str, item_id: int):
+    """
+    Recompute the trending score of an item after it has been created or removed
+
+    :param kind: "resource", "channel" or "post"
+    :param item_id: The rid, cid or post_id
+    """
+    with Session() as conn:
+        update_trending(conn, kind, [item_id])
+        try_to_commit(conn)
+
+
+def refresh_post_trending(post_id: int, cid: int):
+    """Recompute the trending score of a channel post and of its channel"""
+    with Session() as conn:
+        update_trending(conn, "post", [post_id])
+        update_trending(conn, "channel", [cid])
+        try_to_commit(conn)
+
+
+def refresh_all_trending():
+    """
+    Recompute every trending score, one transaction per TRENDING_REFRESH_BATCH
+    items so no score stays locked for long. Run from cron (`flask
+    refresh-trending`) to pick up changes made without the DBFunc functions
+    (e.g. in psql)
+
+    :return True on success, False if a transaction was rolled back
+    """
+    success = True
+    for kind in TRENDING_KEYS:
+        with Session() as conn:
+            ids = _trending_ids(conn, kind)
+        for i in range(0, len(ids), TRENDING_REFRESH_BATCH):
+            with Session() as conn:
+                update_trending(conn, kind, ids[i:i + TRENDING_REFRESH_BATCH])
+                success = try_to_commit(conn) and success
+        with Session() as conn:
+            _drop_orphan_trending(conn, kind)
+            success = try_to_commit(conn) and success
+    return success
+
+
+def _channel_stats_rows(conn, cids=None) -> list:
+    # the latest post of each channel, with the number of posts of the channel
+    posts = select(ChannelPost.cid, ChannelPost.created_at, ChannelPost.uid, User.username,
+                   func.count().over(partition_by=ChannelPost.cid).label("post_count"),
+                   func.row_number().over(partition_by=ChannelPost.cid,
+                                          order_by=(ChannelPost.created_at.desc(),
+                                                    ChannelPost.post_id.desc())).label("position")). \
+        join(User, User.uid == ChannelPost.uid)
+    tags = select(ChannelTagRecord.cid, Tag.tag_name). \
+        join(Tag, Tag.tag_id == ChannelTagRecord.tag_id).order_by(Tag.tag_id)
+    channels = select(Channel.cid)
+    if cids is not None:
+        posts = posts.where(ChannelPost.cid.in_(cids))
+        tags = tags.where(ChannelTagRecord.cid.in_(cids))
+        channels = channels.where(Channel.cid.in_(cids))
+    posts = posts.subquery()
+
+    rows = {cid: dict(cid=cid, post_count=0, last_post_at=None, last_poster_uid=None,
+                      last_poster_username=None, tag_names=[])
+            for cid in conn.execute(channels).scalars()}
+    for cid, created_at, uid, username, post_count in conn.execute(
+            select(posts.c.cid, posts.c.created_at, posts.c.uid, posts.c.username,
+                   posts.c.post_count).where(posts.c.position == 1)):
+        if cid in rows:
+            rows[cid].update(post_count=post_count, last_post_at=created_at,
+                             last_poster_uid=uid, last_poster_username=username)
+    for cid, tag_name in conn.execute(tags):
+        if cid in rows:
+            rows[cid]["tag_names"].append(tag_name)
+    for row in rows.values():
+        row["tag_names"] = json.dumps(row["tag_names"])
+    return list(rows.values())
+
+
+def update_channel_stats(conn, cids: list):
+    """
+    Recompute the ChannelStats of some channels within the transaction of
+    conn, so they change together with the posts or tags they summarize
+
+    Their rows are locked before they are recomputed, so the changes made
+    meanwhile by relative UPDATEs (see post_on_channel) apply on top of them
+
+    :param conn: The Session() initiated, the caller commits
+    :param cids: The ids of the channels
+    """
+    # ids may come straight from a request
+    cids = [int(cid) for cid in cids]
+    table = ChannelStats.__table__
+    conn.execute(select(table.c.cid).where(table.c.cid.in_(cids)).order_by(table.c.cid).with_for_update())
+    rows = _channel_stats_rows(conn, cids)
+    upsert(conn, ChannelStats, rows, [column.name for column in table.columns if not column.primary_key])
+    removed = set(cids) - {row["cid"] for row in rows}
+    if removed:
+        conn.execute(table.delete().where(table.c.cid.in_(removed)))
+
+
+def rebuild_channel_stats(conn):
+    """
+    Recompute the ChannelStats of every channel
+
+    :param conn: The Session() or connection to rebuild with, the caller commits
+    """
+    conn.execute(ChannelStats.__table__.delete())
+    rows = _channel_stats_rows(conn)
+    if rows:
+        conn.execute(ChannelStats.__table__.insert(), rows)
+
+
+def _post_stats_rows(conn, post_ids=None) -> list:
+    # the latest comment of each post, with the number of comments of the post
+    comments = select(PostComment.post_id, PostComment.created_at, PostComment.uid, User.username,
+                      func.count().over(partition_by=PostComment.post_id).label("comment_count"),
+                      func.row_number().over(partition_by=PostComment.post_id,
+                                             order_by=(PostComment.created_at.desc(),
+                                                       PostComment.post_comment_id.desc())).label("position")). \
+        join(User, User.uid == PostComment.uid)
+    posts = select(ChannelPost.post_id)
+    if post_ids is not None:
+        comments = comments.where(PostComment.post_id.in_(post_ids))
+        posts = posts.where(ChannelPost.post_id.in_(post_ids))
+    comments = comments.subquery()
+
+    rows = {post_id: dict(post_id=post_id, comment_count=0, last_comment_at=None,
+                          last_commenter_uid=None, last_commenter_username=None)
+            for post_id in conn.execute(posts).scalars()}
+    for post_id, created_at, uid, username, comment_count in conn.execute(
+            select(comments.c.post_id, comments.c.created_at, comments.c.uid, comments.c.username,
+                   comments.c.comment_count).where(comments.c.position == 1)):
+        if post_id in rows:
+            rows[post_id].update(comment_count=comment_count, last_comment_at=created_at,
+                                 last_commenter_uid=uid, last_commenter_username=username)
+    return list(rows.values())
+
+
+def update_post_stats(conn, post_ids: list):
+    """
+    Recompute the PostStats of some channel posts within the transaction of
+    conn, so they change together with the comments they summarize
+
+    Their rows are locked before they are recomputed, so the changes made
+    meanwhile by relative UPDATEs (see comment_on_channel_post) apply on top of them
+
+    :param conn: The Session() initiated, the caller commits
+    :param post_ids: The ids of the posts
+    """
+    # ids may come straight from a request
+    post_ids = [int(post_id) for post_id in post_ids]
+    table = PostStats.__table__
+    conn.execute(select(table.c.post_id).where(table.c.post_id.in_(post_ids)).
+                 order_by(table.c.post_id).with_for_update())
+    rows = _post_stats_rows(conn, post_ids)
+    upsert(conn, PostStats, rows, [column.name for column in table.columns if not column.primary_key])
+    removed = set(post_ids) - {row["post_id"] for row in rows}
+    if removed:
+        conn.execute(table.delete().where(table.c.post_id.in_(removed)))
+
+
+def rebuild_post_stats(conn):
+    """
+    Recompute the PostStats of every channel post
+
+    :param conn: The Session() or connection to rebuild with, the caller commits
+    """
+    conn.execute(PostStats.__table__.delete())
+    rows = _post_stats_rows(conn)
+    if rows:
+        conn.execute(PostStats.__table__.insert(), rows)
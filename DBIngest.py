@@ -0,0 +1,433 @@
+###############################################################################
+# This file provides the optional write-behind ingestion of votes and resource
+# views.
+#
+# When enabled, submit_vote() and submit_view() only queue the event (and
+# append it to a log file, see INGEST_DURABILITY) and return at once. A
+# background thread flushes the queue every INGEST_FLUSH_INTERVAL_MS: votes of
+# the same user on the same item are coalesced to the latest one, then written
+# with multi-row INSERT and UPDATE statements per table (one per vote without
+# postgres) and one batched UPDATE of the counts, by what those statements
+# changed.
+#
+# Queued events are states ("user u votes up item i", "user u viewed resource
+# r"), not increments, so replaying a log that was already partly written is
+# harmless. Logs left behind by a process that died are replayed by the next
+# process calling start_ingestion().
+#
+# Use the functions in DBFunc.py instead when the result of the write is needed
+# right away.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import atexit
+import glob
+import json
+import math
+import os
+import re
+import threading
+import time
+import traceback
+import warnings
+
+from sqlalchemy import select, update, bindparam, tuple_
+from sqlalchemy.dialects import postgresql
+
+from DBFunc import Session, ErrorCode, DEBUG_MODE, try_to_commit, \
+    insert_if_absent, adjust_trending, counts_only, TRENDING_VIEW_WEIGHT
+from DBMetrics import db_writes
+from DBStructure import User, Resource, ResourceVoteInfo, ResourceView, ChannelPost, \
+    ChannelPostVoteInfo, PostComment, PostCommentVoteInfo, RecommendationCandidate
+
+# whether the web app ingests votes and views through this module
+INGEST_ENABLED = os.environ.get("INGEST_ENABLED", "false").lower() in ("1", "true", "yes")
+# milliseconds between two flushes of the queue
+INGEST_FLUSH_INTERVAL_MS = int(os.environ.get("INGEST_FLUSH_INTERVAL_MS", 200))
+# what a queued event survives before it is flushed:
+# "memory" - nothing, events are lost if the process dies
+# "log"    - a crash of the process, events are written to the log file
+# "fsync"  - a crash of the machine, the log file is synced to disk on every event
+INGEST_DURABILITY = os.environ.get("INGEST_DURABILITY", "log")
+# directory of the log files, one per process
+INGEST_LOG_DIR = os.environ.get("INGEST_LOG_DIR", "ingest_log")
+# number of queued events that triggers a flush before the interval is over
+INGEST_MAX_PENDING = int(os.environ.get("INGEST_MAX_PENDING", 10000))
+
+# kind of voted item -> (vote info model, voted model, id column name, error if missing)
+VOTE_TARGETS = {
+    "resource": (ResourceVoteInfo, Resource, "rid", ErrorCode.INVALID_RESOURCE),
+    "post": (ChannelPostVoteInfo, ChannelPost, "post_id", ErrorCode.INVALID_POST),
+    "comment": (PostCommentVoteInfo, PostComment, "post_comment_id", ErrorCode.INVALID_POST),
+}
+
+# number of rows per statement when reading the current votes or storing the views of a batch
+_CHUNK_SIZE = 500
+
+# (kind, uid, item_id) -> is_upvote of the latest queued vote
+_votes = {}
+# {(uid, rid)} of queued views
+_views = set()
+# guards _votes, _views and the log file
+_lock = threading.Lock()
+# only one flush at a time per process
+_flush_lock = threading.Lock()
+_log = None
+_log_path = None
+_log_segment = 0
+# when this process started ingesting (set again by start_ingestion() in each
+# forked worker), tells its logs from those of an earlier process that had the
+# same pid, e.g. before a container restart
+_log_token = time.time_ns()
+# log files whose events are queued but not written yet, removed by the next
+# successful flush (which writes those events or newer ones replacing them)
+_unflushed = []
+_worker = None
+_wake = threading.Event()
+
+
+def submit_vote(kind: str, uid: int, item_id: int, upvote: bool = True):
+    """
+    Queue the vote of a user on a resource, channel post or post comment
+
+    :param kind: The kind of item, a key of VOTE_TARGETS
+    :param uid: The voter's user id
+    :param item_id: The rid, post_id or post_comment_id
+    :param upvote: is this is a upvote
+    :return The tuple of form upvote_count, downvote_count the item will have
+            once the vote is written (votes queued by other users not included).
+            ErrorCode.INVALID_RESOURCE/_POST if the item does not exist
+    """
+    vote_model, target_model, key, invalid = VOTE_TARGETS[kind]
+    with Session() as conn:
+        row = conn.query(target_model.upvote_count, target_model.downvote_count,
+                         vote_model.is_upvote). \
+            outerjoin(vote_model, (getattr(vote_model, key) == getattr(target_model, key)) &
+                      (vote_model.uid == uid)). \
+            filter(getattr(target_model, key) == item_id).one_or_none()
+    if row is None:
+        return invalid
+    up, down, voted_up = row
+
+    _queue({"vote": kind, "uid": uid, "id": item_id, "up": upvote})
+    # the counts already include the vote stored for this user, if any
+    if voted_up is not None:
+        up, down = (up - 1, down) if voted_up else (up, down - 1)
+    return (up + 1, down) if upvote else (up, down + 1)
+
+
+def submit_view(uid: int, rid: int):
+    """
+    Queue the record of a user viewing a resource
+
+    :param uid: The user id who viewed the resource
+    :param rid: The id of resource viewed
+    """
+    _queue({"view": "resource", "uid": uid, "id": rid})
+
+
+def _queue(event: dict):
+    with _lock:
+        _apply(event)
+        if INGEST_DURABILITY != "memory" and _log is not None:
+            _log.write(json.dumps(event) + "\n")
+            _log.flush()
+            if INGEST_DURABILITY == "fsync":
+                os.fsync(_log.fileno())
+        pending = len(_votes) + len(_views)
+    if pending >= INGEST_MAX_PENDING:
+        _wake.set()
+
+
+def _apply(event: dict):
+    # add an event to the queue, a later vote replaces an earlier one
+    if "vote" in event:
+        _votes[(event["vote"], event["uid"], event["id"])] = event["up"]
+    else:
+        _views.add((event["uid"], event["id"]))
+
+
+def flush() -> bool:
+    """
+    Write every queued event to the DB in one transaction
+
+    :return True if the queue was written (or empty). False if the transaction
+            failed, in which case the events stay queued for the next flush
+    """
+    global _votes, _views
+    with _flush_lock:
+        with _lock:
+            votes, views = _votes, _views
+            _votes, _views = {}, set()
+            if votes or views:
+                _rotate_log()
+
+        if (not votes and not views) or _write(votes, views):
+            for path in _unflushed:
+                os.remove(path)
+            _unflushed.clear()
+            return True
+
+        # put the events back, behind anything queued meanwhile. Their log
+        # files are kept in case the process dies before the next flush
+        with _lock:
+            for k, upvote in votes.items():
+                _votes.setdefault(k, upvote)
+            _views.update(views)
+        return False
+
+
+def _write(votes: dict, views: set) -> bool:
+    written = {}
+    with Session() as conn:
+        try:
+            for kind in VOTE_TARGETS:
+                batch = {(uid, item_id): upvote
+                         for (k, uid, item_id), upvote in votes.items() if k == kind}
+                if batch:
+                    written[kind] = _write_votes(conn, kind, batch)
+            if views:
+                _write_views(conn, views)
+        except Exception:
+            if DEBUG_MODE:
+                raise
+            warnings.warn(traceback.format_exc())
+            conn.rollback()
+            return False
+        if not try_to_commit(conn):
+            return False
+    for kind, count in written.items():
+        if count:
+            db_writes.inc("vote", kind, amount=count)
+    return True
+
+
+def _existing(conn, column, ids) -> set:
+    # the ids that are still in the DB, events on removed items or users are dropped
+    ids = list(ids)
+    found = set()
+    for i in range(0, len(ids), _CHUNK_SIZE):
+        chunk = ids[i:i + _CHUNK_SIZE]
+        found.update(conn.execute(select(column).where(column.in_(chunk))).scalars())
+    return found
+
+
+def _store_votes(conn, vote_model, key: str, batch: dict) -> list:
+    # insert or switch the votes of a batch, returns (uid, item id, is_upvote,
+    # whether an earlier vote was switched) of the rows the statements changed.
+    # Votes stored meanwhile by another writer (e.g. the same click handled by
+    # two workers) are not returned, that writer counts them
+    table = vote_model.__table__
+    item_column = table.c[key]
+    # in item order so concurrent flushes lock the rows in the same order
+    votes = sorted(batch.items(), key=lambda vote: (vote[0][1], vote[0][0]))
+    stored = []
+    if conn.get_bind().dialect.name != "postgresql":
+        # no RETURNING, one statement per vote and its rowcount tells what it did
+        for (uid, item_id), upvote in votes:
+            if insert_if_absent(conn, vote_model, {key: item_id, "uid": uid, "is_upvote": upvote}):
+                stored.append((uid, item_id, upvote, False))
+            elif conn.execute(update(table).where(table.c.uid == uid, item_column == item_id,
+                                                  table.c.is_upvote != upvote).
+                              values(is_upvote=upvote)).rowcount:
+                stored.append((uid, item_id, upvote, True))
+        return stored
+
+    rows = [{key: item_id, "uid": uid, "is_upvote": upvote} for (uid, item_id), upvote in votes]
+    for i in range(0, len(rows), _CHUNK_SIZE):
+        insert = postgresql.insert(table).values(rows[i:i + _CHUNK_SIZE]).on_conflict_do_nothing()
+        stored += [(uid, item_id, upvote, False) for uid, item_id, upvote in
+                   conn.execute(insert.returning(table.c.uid, item_column, table.c.is_upvote))]
+    inserted = {(uid, item_id) for uid, item_id, _, _ in stored}
+    for upvote in (True, False):
+        pairs = [pair for pair, up in votes if up == upvote and pair not in inserted]
+        for i in range(0, len(pairs), _CHUNK_SIZE):
+            switch = update(table).where(tuple_(table.c.uid, item_column).in_(pairs[i:i + _CHUNK_SIZE]),
+                                         table.c.is_upvote != upvote).values(is_upvote=upvote)
+            stored += [(uid, item_id, upvote, True) for uid, item_id in
+                       conn.execute(switch.returning(table.c.uid, item_column))]
+    return stored
+
+
+def _write_votes(conn, kind: str, batch: dict) -> int:
+    # returns the number of votes stored or switched
+    vote_model, target_model, key, _ = VOTE_TARGETS[kind]
+    items = _existing(conn, getattr(target_model, key), {item_id for _, item_id in batch})
+    users = _existing(conn, User.uid, {uid for uid, _ in batch})
+    batch = {(uid, item_id): upvote for (uid, item_id), upvote in batch.items()
+             if uid in users and item_id in items}
+    stored = _store_votes(conn, vote_model, key, batch)
+    if not stored:
+        return 0
+
+    # the counts change by what the statements did, not by what was read before
+    changes = {}
+    for _, item_id, upvote, switched in stored:
+        up, down = changes.get(item_id, (0, 0))
+        up += (1 if upvote else 0) - (1 if switched and not upvote else 0)
+        down += (0 if upvote else 1) - (1 if switched and upvote else 0)
+        changes[item_id] = (up, down)
+    # one statement executed with the parameters of every item
+    counts = target_model.__table__
+    with counts_only(conn):
+        conn.execute(update(counts).where(counts.c[key] == bindparam("b_id")).values(
+            upvote_count=counts.c.upvote_count + bindparam("b_up"),
+            downvote_count=counts.c.downvote_count + bindparam("b_down")),
+            [{"b_id": i, "b_up": up, "b_down": down} for i, (up, down) in sorted(changes.items())])
+    if kind == "resource":
+        candidates = RecommendationCandidate.__table__
+        conn.execute(update(candidates).where(
+            candidates.c.kind == "resource", candidates.c.item_id == bindparam("b_id")).values(
+            score=candidates.c.score + bindparam("b_net")),
+            [{"b_id": i, "b_net": up - down} for i, (up, down) in sorted(changes.items())])
+    _update_ranks(conn, kind, changes)
+    return len(stored)
+
+
+def _update_ranks(conn, kind: str, changes: dict):
+    # changes is a dict of item id -> (upvote change, downvote change)
+    net = {item_id: up - down for item_id, (up, down) in changes.items()}
+    if kind == "resource":
+        adjust_trending(conn, {("resource", rid): points for rid, points in net.items()})
+    elif kind == "post":
+        points = {("post", post_id): post_points for post_id, post_points in net.items()}
+        # a channel has the points of all its posts
+        for post_id, cid in conn.execute(select(ChannelPost.post_id, ChannelPost.cid).
+                                         where(ChannelPost.post_id.in_(list(net)))):
+            points["channel", cid] = points.get(("channel", cid), 0) + net[post_id]
+        adjust_trending(conn, points)
+
+
+def _write_views(conn, views: set):
+    resources = _existing(conn, Resource.rid, {rid for _, rid in views})
+    users = _existing(conn, User.uid, {uid for uid, _ in views})
+    rows = [{"rid": rid, "uid": uid} for uid, rid in views if uid in users and rid in resources]
+    if not rows:
+        return
+    # the resources of the views that were not stored yet
+    viewed = []
+    if conn.get_bind().dialect.name == "postgresql":
+        for i in range(0, len(rows), _CHUNK_SIZE):
+            insert = postgresql.insert(ResourceView.__table__).values(rows[i:i + _CHUNK_SIZE])
+            viewed += conn.execute(insert.on_conflict_do_nothing().
+                                   returning(ResourceView.rid)).scalars().all()
+    else:
+        viewed = [row["rid"] for row in rows if insert_if_absent(conn, ResourceView, row)]
+    points = {}
+    for rid in viewed:
+        points["resource", rid] = points.get(("resource", rid), 0) + TRENDING_VIEW_WEIGHT
+    adjust_trending(conn, points)
+
+
+def _rotate_log():
+    # close the log of the queued events and start a new one. Must hold _lock
+    global _log, _log_segment
+    if _log is None:
+        return
+    _log.close()
+    segment = f"{_log_path}.{_log_segment}"
+    os.replace(_log_path, segment)
+    _unflushed.append(segment)
+    _log_segment += 1
+    _log = open(_log_path, "a")
+
+
+# logs are named ingest-<pid>-<token>.log, rotated to ingest-<pid>-<token>.log.<n>
+# and renamed to <name>.replay<pid>-<token> by the process replaying them. Logs
+# written before the token existed have none
+_LOG_NAME = re.compile(r"ingest-(\d+)(?:-(\d+))?\.log(?:\.(\d+))?(?:\.replay(\d+)(?:-(\d+))?)?$")
+
+
+def _log_order(match):
+    # oldest process first, then its oldest segment
+    return int(match.group(2) or 0), int(match.group(1)), \
+        int(match.group(3)) if match.group(3) else math.inf
+
+
+def _process_alive(pid: int, token: int) -> bool:
+    if pid == os.getpid():
+        # an earlier process had this pid, unless the token is ours
+        return token == _log_token
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def replay_logs() -> int:
+    """
+    Queue the events of the logs left by processes that are no longer running,
+    then flush them. Called by start_ingestion()
+
+    :return The number of events replayed
+    """
+    count = 0
+    with _flush_lock:
+        logs = []
+        for path in glob.glob(os.path.join(INGEST_LOG_DIR, "ingest-*.log*")):
+            match = _LOG_NAME.match(os.path.basename(path))
+            if match:
+                logs.append((_log_order(match), path, match))
+        for _, path, match in sorted(logs):
+            if match.group(4):
+                # being replayed, skip it unless the replaying process died too
+                owner = int(match.group(4)), int(match.group(5) or 0)
+            else:
+                owner = int(match.group(1)), int(match.group(2) or 0)
+            if _process_alive(*owner):
+                continue
+
+            # claim the log, another process replaying at the same time loses the rename
+            claimed = f"{path.split('.replay')[0]}.replay{os.getpid()}-{_log_token}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed) as log, _lock:
+                for line in log:
+                    try:
+                        _apply(json.loads(line))
+                        count += 1
+                    except (ValueError, KeyError):
+                        # the last line of a log cut short by the crash
+                        continue
+            _unflushed.append(claimed)
+    flush()
+    return count
+
+
+def start_ingestion(interval_ms: int = INGEST_FLUSH_INTERVAL_MS):
+    """
+    Open the log of this process, replay the logs of dead processes and start
+    the background thread flushing the queue. Does nothing if already started
+
+    :param interval_ms: The milliseconds between two flushes
+    """
+    global _worker, _log, _log_path, _log_token
+    with _lock:
+        if _worker is not None:
+            return
+        # never the name of a log left by an earlier process with the same pid
+        _log_token = time.time_ns()
+        if INGEST_DURABILITY != "memory":
+            os.makedirs(INGEST_LOG_DIR, exist_ok=True)
+            _log_path = os.path.join(INGEST_LOG_DIR, f"ingest-{os.getpid()}-{_log_token}.log")
+            _log = open(_log_path, "a")
+
+        def run():
+            while True:
+                _wake.wait(interval_ms / 1000)
+                _wake.clear()
+                try:
+                    flush()
+                except Exception:
+                    warnings.warn(traceback.format_exc())
+
+        _worker = threading.Thread(target=run, name="ingest-flush", daemon=True)
+    replay_logs()
+    _worker.start()
+    # write what is still queued on a clean shutdown
+    atexit.register(flush)
@@ -0,0 +1,275 @@
+###############################################################################
+# This file keeps the counters and histograms served at /metrics, in the
+# Prometheus text exposition format.
+#
+# Recording a sample only touches a dict owned by the calling thread, so it
+# never waits on a lock held by another request; /metrics adds up the dicts of
+# all threads when it is scraped. The dicts of finished threads are folded
+# into one, so a server starting a thread per request does not grow them.
+#
+# Values read when /metrics is scraped (the connection pool of the shared
+# engine) are served by Gauge and _PoolCollector.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import bisect
+import math
+import os
+import threading
+
+from DBStructure import engine, pool_stats
+
+# whether /metrics is served and requests are counted and timed
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# prefix of the name of every metric
+METRICS_PREFIX = "doctrina_"
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds (in bytes) of the upload size histogram buckets
+SIZE_BUCKETS = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# metrics in the order they are exposed
+_registry = []
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    """
+    A metric whose samples are recorded per thread and added up when exposed
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        # guards _shards and _retired, taken once per thread and per scrape
+        self._lock = threading.Lock()
+        # (thread, dict of label values -> value) of every thread that recorded a sample
+        self._shards = []
+        # the samples of finished threads
+        self._retired = {}
+        _registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _merge(self, total: dict, shard: dict):
+        raise NotImplementedError
+
+    def _collect(self) -> dict:
+        """
+        :return dict of label values -> value, added up over all threads
+        """
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    # nothing records in this shard anymore
+                    self._merge(self._retired, shard)
+            self._shards = alive
+            total = {}
+            self._merge(total, self._retired)
+        for _, shard in alive:
+            # copy() is atomic, the owner thread may be adding keys
+            self._merge(total, shard.copy())
+        return total
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def expose(self) -> list:
+        """
+        :return the lines of this metric in the text exposition format
+        """
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type}"] + \
+               [f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}"
+                for suffix, names, values, value in self._samples()]
+
+
+class Counter(_Metric):
+    """
+    A number that only goes up, e.g. requests served
+    """
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        """
+        :param labels: The value of each label of the metric, in order
+        :param amount: How much to add
+        """
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, total: dict, shard: dict):
+        for labels, value in shard.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def _samples(self):
+        for labels, value in sorted(self._collect().items()):
+            yield "", self.labels, labels, value
+
+
+class Histogram(_Metric):
+    """
+    Counts of observed values per bucket, e.g. request latencies
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        """
+        :param value: The value observed, e.g. seconds
+        :param labels: The value of each label of the metric, in order
+        """
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            # the count of each bucket (not cumulative), of values above them, then the sum
+            cell = shard[labels] = [0] * (len(self.buckets) + 2)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def _merge(self, total: dict, shard: dict):
+        for labels, cell in shard.items():
+            cell = list(cell)
+            if labels in total:
+                total[labels] = [a + b for a, b in zip(total[labels], cell)]
+            else:
+                total[labels] = cell
+
+    def _samples(self):
+        names = self.labels + ("le",)
+        for labels, cell in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), cell):
+                cumulative += count
+                yield "_bucket", names, labels + (_format_value(float(bound)),), cumulative
+            # the count is derived from the buckets so it always matches +Inf
+            yield "_count", self.labels, labels, cumulative
+            yield "_sum", self.labels, labels, cell[-1]
+
+
+class Gauge(_Metric):
+    """
+    A value read when the metrics are exposed, e.g. connections in use
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, function, labels: tuple = ()):
+        """
+        :param function: Called with no argument when exposed, returns the value,
+                or a dict of label values -> value if the gauge has labels
+        """
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def _samples(self):
+        values = self.function()
+        if not self.labels:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            if value is not None:
+                yield "", self.labels, labels, value
+
+
+class _PoolCollector:
+    """
+    The checkout statistics of the connection pool of the shared engine
+    """
+
+    def expose(self) -> list:
+        stats = pool_stats(engine)
+        if "checkouts" not in stats:
+            # the pool does not track them, see TimedQueuePool
+            return []
+        name = METRICS_PREFIX + "db_pool_wait_seconds"
+        lines = [f"# HELP {name} Time spent waiting for the DB connections checked out",
+                 f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in stats["wait_seconds_buckets"].items():
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{_format_value(float(bound))}"}} {cumulative}')
+        lines.append(f"{name}_count {cumulative}")
+        lines.append(f"{name}_sum {_format_value(stats['wait_seconds_total'])}")
+        name = METRICS_PREFIX + "db_pool_timeouts_total"
+        lines += [f"# HELP {name} DB connection checkouts that timed out",
+                  f"# TYPE {name} counter",
+                  f"{name} {stats['timeouts']}"]
+        return lines
+
+
+def _pool_gauge(key: str):
+    def read():
+        return pool_stats(engine).get(key)
+    return read
+
+
+http_requests = Counter("http_requests_total", "HTTP requests served",
+                        ("endpoint", "method", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "Time to serve an HTTP request",
+                                  ("endpoint", "method"))
+db_writes = Counter("db_writes_total", "Votes, comments and posts written to the DB",
+                    ("kind", "target"))
+cache_requests = Counter("cache_requests_total", "Lookups of in-memory caches, by result (hit or miss)",
+                         ("cache", "result"))
+upload_bytes = Histogram("upload_bytes", "Size of the files uploaded", ("endpoint",), SIZE_BUCKETS)
+upload_duration = Histogram("upload_duration_seconds", "Time to store an uploaded file", ("endpoint",))
+Gauge("db_pool_size", "Connections the pool keeps open", _pool_gauge("pool_size"))
+Gauge("db_pool_checked_out", "Connections in use", _pool_gauge("checked_out"))
+Gauge("db_pool_checked_in", "Idle connections in the pool", _pool_gauge("checked_in"))
+Gauge("db_pool_overflow", "Connections open beyond the pool size", _pool_gauge("overflow"))
+_registry.append(_PoolCollector())
+
+
+def count_cache(cache: str, hit: bool):
+    """
+    Count a lookup of an in-memory cache, the hit ratio is hits / (hits + misses)
+
+    :param cache: The name of the cache
+    :param hit: if the value was served from the cache
+    """
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+
+def exposition() -> str:
+    """
+    Returns every metric in the Prometheus text exposition format, for /metrics
+
+    :return the text of the metrics
+    """
+    lines = []
+    for metric in _registry:
+        lines += metric.expose()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,301 @@
+###############################################################################
+# This file keeps track of the version of our DB schema.
+#
+# Each migration brings the schema from the previous version to its own, the
+# versions a DB has gone through are recorded in the schema_version table.
+# To change the schema, update the models in DBStructure.py and append a
+# migration doing the same change to MIGRATIONS. Never edit a migration that
+# has been released, as DBs which already ran it will not run it again.
+#
+# Run this script (or `flask init-db`) to bring a DB up to date.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import datetime
+
+import pytz
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, select, func, text, inspect, \
+    Boolean, Enum, ForeignKey, Numeric, Text
+
+from DBStructure import engine, STANDARD_STRING_LENGTH, TRIGRAM_INDEXES, PG_TRGM_DDL, \
+    trigram_index_ddl, CacheVersion, RecommendationCandidate, TrendingScore, ChannelStats, \
+    PostStats
+from DBSearch import create_search_indexes
+from DBFunc import rebuild_recommendations, rebuild_trending, rebuild_channel_stats, rebuild_post_stats, \
+    DATA_KINDS, DATA_VERSION_PREFIX
+
+# table recording which migrations have been applied to this DB
+schema_version = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(STANDARD_STRING_LENGTH), nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+
+# the tables of the schema as migrations started, copied from DBStructure.py at
+# that time. Migration 1 creates these rather than the current models, so it
+# keeps creating the same schema whatever DBStructure.py turns into
+_baseline = MetaData()
+_subject = Enum("ENGLISH", "MATHS_A", "MATHS_B", "MATHS_C", "BIOLOGY", "GEOGRAPHY", "CHEMISTRY", "PHYSICS",
+                "ACCOUNTING", "ECONOMICS", "ANCIENT_HISTORY", "LEGAL_STUDIES", "BUSINESS_STUDIES",
+                "SOCIAL_STUDIES", "DANCE", "DRAMA", "IT", "MUSIC", "DESIGN", "PE", "CHINESE", "SPANISH",
+                "GERMAN", "JAPANESE", "OTHER", "NULL", name="subject")
+_grade = Enum("KINDERGARTEN", "YEAR_1", "YEAR_2", "YEAR_3", "YEAR_4", "YEAR_5", "YEAR_6", "YEAR_7", "YEAR_8",
+              "YEAR_9", "YEAR_10", "YEAR_11", "YEAR_12", "TERTIARY", "NULL", name="grade")
+_difficulty = Enum("EASY", "MODERATE", "HARD", "SPECIALIST", name="resourcedifficulty")
+_visibility = Enum("INVITE_ONLY", "FULLY_PRIVATE", "PUBLIC", name="channelvisibility")
+_name = String(STANDARD_STRING_LENGTH)
+_time = DateTime(timezone=True)
+
+Table("user", _baseline,
+      Column("uid", Integer, primary_key=True, autoincrement=True),
+      Column("username", _name, nullable=False),
+      Column("avatar_link", _name),
+      Column("profile_background_link", _name),
+      Column("created_at", _time, nullable=False),
+      Column("hash_password", Text, nullable=False),
+      Column("user_rating", Numeric),
+      Column("email", String, nullable=False, unique=True),
+      Column("bio", Text),
+      Column("authenticated", Boolean, nullable=False))
+Table("user_teaching_areas", _baseline,
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True),
+      Column("teaching_area", _subject, primary_key=True),
+      Column("teaching_grade", _grade),
+      Column("is_public", Boolean, nullable=False))
+Table("resource", _baseline,
+      Column("rid", Integer, primary_key=True, autoincrement=True),
+      Column("title", _name, nullable=False),
+      Column("resource_link", _name, nullable=False),
+      Column("created_at", _time, nullable=False),
+      Column("difficulty", _difficulty, nullable=False),
+      Column("subject", _subject, nullable=False),
+      Column("grade", _grade, nullable=False),
+      Column("upvote_count", Integer, nullable=False),
+      Column("downvote_count", Integer, nullable=False),
+      Column("is_public", Boolean, nullable=False),
+      Column("description", Text))
+Table("resource_view", _baseline,
+      Column("rid", Integer, ForeignKey("resource.rid"), primary_key=True),
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True),
+      Column("created_at", _time, nullable=False))
+Table("resource_thumbnail", _baseline,
+      Column("rid", Integer, ForeignKey("resource.rid"), primary_key=True),
+      Column("thumbnail_link", Text, primary_key=True))
+Table("resource_vote_info", _baseline,
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True),
+      Column("rid", Integer, ForeignKey("resource.rid"), primary_key=True),
+      Column("is_upvote", Boolean, nullable=False))
+Table("resource_creater", _baseline,
+      Column("rid", Integer, ForeignKey("resource.rid"), primary_key=True),
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True))
+Table("resource_comment", _baseline,
+      Column("resource_comment_id", Integer, primary_key=True, autoincrement=True),
+      Column("uid", Integer, ForeignKey("user.uid"), nullable=False),
+      Column("created_at", _time, nullable=False),
+      Column("rid", Integer, ForeignKey("resource.rid"), nullable=False),
+      Column("comment", Text, nullable=False))
+Table("resource_comment_reply", _baseline,
+      Column("resource_comment_id", Integer, ForeignKey("resource_comment.resource_comment_id"),
+             primary_key=True),
+      Column("reply", Text, nullable=False),
+      Column("created_at", _time, primary_key=True),
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True))
+Table("private_resource_personnel", _baseline,
+      Column("rid", Integer, ForeignKey("resource.rid"), primary_key=True),
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True))
+Table("tag", _baseline,
+      Column("tag_id", Integer, primary_key=True, autoincrement=True),
+      Column("tag_name", _name, nullable=False, unique=True),
+      Column("tag_description", Text))
+Table("resource_tag_record", _baseline,
+      Column("tag_id", Integer, ForeignKey("tag.tag_id"), primary_key=True),
+      Column("rid", Integer, ForeignKey("resource.rid"), primary_key=True))
+Table("channel", _baseline,
+      Column("cid", Integer, primary_key=True, autoincrement=True),
+      Column("created_at", _time, nullable=False),
+      Column("subject", _subject),
+      Column("grade", _grade),
+      Column("visibility", _visibility, nullable=False),
+      Column("name", _name, nullable=False, unique=True),
+      Column("admin_uid", Integer, ForeignKey("user.uid"), nullable=False),
+      Column("description", Text),
+      Column("avatar_link", Text, nullable=False))
+Table("channel_personnel", _baseline,
+      Column("cid", Integer, ForeignKey("channel.cid"), primary_key=True),
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True))
+Table("channel_tag_record", _baseline,
+      Column("tag_id", Integer, ForeignKey("tag.tag_id"), primary_key=True),
+      Column("cid", Integer, ForeignKey("channel.cid"), primary_key=True))
+Table("channel_post", _baseline,
+      Column("post_id", Integer, primary_key=True, autoincrement=True),
+      Column("uid", Integer, ForeignKey("user.uid"), nullable=False),
+      Column("cid", Integer, ForeignKey("channel.cid"), nullable=False),
+      Column("title", _name, nullable=False),
+      Column("upvote_count", Integer, nullable=False),
+      Column("downvote_count", Integer, nullable=False),
+      Column("init_text", Text, nullable=False),
+      Column("created_at", _time, nullable=False))
+Table("channel_post_vote_info", _baseline,
+      Column("post_id", Integer, ForeignKey("channel_post.post_id"), primary_key=True),
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True),
+      Column("is_upvote", Boolean, nullable=False))
+Table("post_comment", _baseline,
+      Column("post_comment_id", Integer, primary_key=True, autoincrement=True),
+      Column("post_id", Integer, ForeignKey("channel_post.post_id"), nullable=False),
+      Column("created_at", _time, nullable=False),
+      Column("uid", Integer, ForeignKey("user.uid"), nullable=False),
+      Column("text", Text, nullable=False),
+      Column("upvote_count", Integer, nullable=False),
+      Column("downvote_count", Integer, nullable=False))
+Table("post_comment_vote_info", _baseline,
+      Column("post_comment_id", Integer, ForeignKey("post_comment.post_comment_id"), primary_key=True),
+      Column("uid", Integer, ForeignKey("user.uid"), primary_key=True),
+      Column("is_upvote", Boolean, nullable=False))
+
+
+def _create_tables(conn):
+    # does nothing to DBs created before migrations existed
+    _baseline.create_all(conn)
+
+
+# (index name, table, columns) of the indexes on hot lookup columns
+LOOKUP_INDEXES = [
+    ("ix_resource_created_at_rid", "resource", "created_at, rid"),
+    ("ix_resource_upvote_count_rid", "resource", "upvote_count, rid"),
+    ("ix_resource_creater_uid", "resource_creater", "uid"),
+    ("ix_resource_comment_rid_created_at", "resource_comment", "rid, created_at"),
+    ("ix_private_resource_personnel_uid", "private_resource_personnel", "uid"),
+    ("ix_resource_tag_record_rid", "resource_tag_record", "rid"),
+    ("ix_channel_personnel_uid", "channel_personnel", "uid"),
+    ("ix_channel_tag_record_cid", "channel_tag_record", "cid"),
+    ("ix_channel_post_cid_created_at", "channel_post", "cid, created_at"),
+    ("ix_post_comment_post_id_created_at", "post_comment", "post_id, created_at"),
+]
+
+
+def _add_lookup_indexes(conn):
+    for name, table, columns in LOOKUP_INDEXES:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def _add_trigram_indexes(conn):
+    if conn.dialect.name != "postgresql":
+        # ilike '%...%' cannot use an index on other DBs
+        return
+    conn.execute(PG_TRGM_DDL)
+    for name in TRIGRAM_INDEXES:
+        conn.execute(trigram_index_ddl(name))
+
+
+def _seed_cache_version(conn, name: str):
+    # the row exists up front, so concurrent writers only ever update it
+    if not conn.execute(select(CacheVersion.name).where(CacheVersion.name == name)).first():
+        conn.execute(CacheVersion.__table__.insert().values(name=name, version=0))
+
+
+def _add_cache_version(conn):
+    CacheVersion.__table__.create(conn, checkfirst=True)
+    _seed_cache_version(conn, "tags")
+
+
+def _add_recommendations(conn):
+    RecommendationCandidate.__table__.create(conn, checkfirst=True)
+    rebuild_recommendations(conn)
+
+
+def _add_trending_scores(conn):
+    TrendingScore.__table__.create(conn, checkfirst=True)
+    rebuild_trending(conn)
+
+
+def _add_recommendation_item_index(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_recommendation_candidate_item "
+                      "ON recommendation_candidate (kind, item_id)"))
+
+
+def _add_channel_stats(conn):
+    ChannelStats.__table__.create(conn, checkfirst=True)
+    rebuild_channel_stats(conn)
+
+
+def _add_post_stats(conn):
+    PostStats.__table__.create(conn, checkfirst=True)
+    rebuild_post_stats(conn)
+
+
+def _add_data_versions(conn):
+    for kind in DATA_KINDS:
+        _seed_cache_version(conn, DATA_VERSION_PREFIX + kind)
+
+
+def _add_trending_points(conn):
+    # tables created by migration 7 before the points were stored
+    columns = {column["name"] for column in inspect(conn).get_columns(TrendingScore.__tablename__)}
+    if "points" in columns:
+        return
+    active_at = DateTime(timezone=True).compile(dialect=conn.dialect)
+    conn.execute(text("ALTER TABLE trending_score ADD COLUMN points FLOAT NOT NULL DEFAULT 0"))
+    conn.execute(text(f"ALTER TABLE trending_score ADD COLUMN active_at {active_at}"))
+    rebuild_trending(conn)
+
+
+def _add_response_version(conn):
+    _seed_cache_version(conn, "responses")
+
+
+# (version, description, upgrade function) of all migrations, in order
+MIGRATIONS = [
+    (1, "create tables", _create_tables),
+    (2, "indexes on hot lookup columns", _add_lookup_indexes),
+    (3, "trigram indexes for title and name searches", _add_trigram_indexes),
+    (4, "full-text search indexes", create_search_indexes),
+    (5, "cache versions", _add_cache_version),
+    (6, "recommendation candidates", _add_recommendations),
+    (7, "trending scores", _add_trending_scores),
+    (8, "index on recommendation candidate items", _add_recommendation_item_index),
+    (9, "channel stats", _add_channel_stats),
+    (10, "post stats", _add_post_stats),
+    (11, "data versions", _add_data_versions),
+    (12, "trending points", _add_trending_points),
+    (13, "response cache version", _add_response_version),
+]
+
+
+def current_version(bind=None):
+    """
+    Returns the schema version of a DB
+
+    :param bind: The engine of the DB, default to the shared engine
+    :return the version of the latest migration applied, 0 if none
+    """
+    with (bind or engine).begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def migrate(bind=None, target=None):
+    """
+    Apply all pending migrations to a DB, each in a transaction of its own
+
+    :param bind: The engine of the DB, default to the shared engine
+    :param target: The version to stop at, default to the latest one
+    :return the schema version of the DB after migration
+    """
+    bind = bind or engine
+    version = current_version(bind)
+    for number, description, upgrade in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        with bind.begin() as conn:
+            upgrade(conn)
+            conn.execute(schema_version.insert().values(
+                version=number, description=description,
+                applied_at=datetime.datetime.now(tz=pytz.timezone("Australia/Brisbane"))))
+        version = number
+    return version
+
+
+if __name__ == "__main__":
+    print(f"DB schema is at version {migrate()}")
@@ -0,0 +1,229 @@
+###############################################################################
+# This file counts and times the SQL statements run by the shared engine, per
+# web request.
+#
+# The web app calls begin_profile() when a request starts and end_profile()
+# when it is torn down; every statement run by the same thread in between is
+# added to that request's QueryProfile. end_profile() writes one JSON log line
+# per request (logger "doctrina.queries") and adds the request to the totals
+# of its endpoint, which /debug/queries shows. A statement run many times by
+# the same request (the same SQL with other parameters, i.e. an N+1 pattern)
+# is reported with its count.
+#
+# Statements slower than QUERY_SLOW_MS are logged whether or not they are run
+# by a request.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import collections
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from DBStructure import engine
+
+# whether statements are counted and timed at all
+QUERY_PROFILING = os.environ.get("QUERY_PROFILING", "true").lower() in ("1", "true", "yes")
+# milliseconds a statement takes to be logged as slow
+QUERY_SLOW_MS = float(os.environ.get("QUERY_SLOW_MS", 100))
+# number of slowest statements kept per request
+QUERY_PROFILE_TOP = int(os.environ.get("QUERY_PROFILE_TOP", 5))
+# number of times a request runs the same statement to be reported as an N+1 pattern
+QUERY_REPEAT_THRESHOLD = int(os.environ.get("QUERY_REPEAT_THRESHOLD", 5))
+# number of recent requests kept for /debug/queries
+QUERY_PROFILE_HISTORY = int(os.environ.get("QUERY_PROFILE_HISTORY", 100))
+
+logger = logging.getLogger("doctrina.queries")
+
+# characters of a statement kept in logs and profiles
+_STATEMENT_LENGTH = 500
+
+
+class QueryProfile:
+    """
+    The statements run by one request
+    """
+
+    def __init__(self, endpoint: str, method: str = None, path: str = None):
+        self.endpoint, self.method, self.path = endpoint, method, path
+        self.status = None
+        self.started = time.perf_counter()
+        self.total_ms = None
+        self.queries = 0
+        self.db_ms = 0.0
+        # (ms, statement) of the QUERY_PROFILE_TOP slowest statements, as a min heap
+        self.slowest = []
+        # statement -> number of times it was run
+        self.counts = collections.Counter()
+
+    def add(self, statement: str, ms: float):
+        self.queries += 1
+        self.db_ms += ms
+        self.counts[statement] += 1
+        if len(self.slowest) < QUERY_PROFILE_TOP:
+            heapq.heappush(self.slowest, (ms, statement))
+        elif ms > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (ms, statement))
+
+    @property
+    def repeated(self) -> list:
+        """
+        Returns the statements run at least QUERY_REPEAT_THRESHOLD times, most run first
+
+        :return list of (statement, count)
+        """
+        return [(statement, count) for statement, count in self.counts.most_common()
+                if count >= QUERY_REPEAT_THRESHOLD]
+
+    @property
+    def serialize(self):
+        return {
+            "endpoint": self.endpoint,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "ms": round(self.total_ms if self.total_ms is not None else self.elapsed_ms, 2),
+            "queries": self.queries,
+            "db_ms": round(self.db_ms, 2),
+            "slowest": [{"ms": round(ms, 2), "statement": statement[:_STATEMENT_LENGTH]}
+                        for ms, statement in sorted(self.slowest, reverse=True)],
+            "repeated": [{"count": count, "statement": statement[:_STATEMENT_LENGTH]}
+                         for statement, count in self.repeated],
+        }
+
+    @property
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+
+_state = threading.local()
+# guards _history and _endpoints
+_lock = threading.Lock()
+# profiles of the latest requests, newest last
+_history = collections.deque(maxlen=QUERY_PROFILE_HISTORY)
+# endpoint -> totals of its requests
+_endpoints = {}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("query_started")
+    if not started:
+        return
+    ms = (time.perf_counter() - started.pop()) * 1000
+    profile = getattr(_state, "profile", None)
+    if profile is not None:
+        profile.add(statement, ms)
+    if ms >= QUERY_SLOW_MS:
+        logger.warning(json.dumps({"event": "slow_query", "ms": round(ms, 2),
+                                   "endpoint": profile.endpoint if profile else None,
+                                   "statement": statement[:_STATEMENT_LENGTH]}))
+
+
+def _handle_error(context):
+    # the statement failed, after_cursor_execute is not called
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+if QUERY_PROFILING:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def begin_profile(endpoint: str, method: str = None, path: str = None):
+    """
+    Add the statements run by this thread to a new profile, until end_profile()
+
+    :param endpoint: The name of the endpoint handling the request
+    :param method: The HTTP method of the request
+    :param path: The path of the request
+    """
+    _state.profile = QueryProfile(endpoint, method, path) if QUERY_PROFILING else None
+
+
+def current_profile():
+    """
+    Returns the profile of the request handled by this thread
+
+    :return the QueryProfile, None if no request is profiled
+    """
+    return getattr(_state, "profile", None)
+
+
+def end_profile():
+    """
+    Stop profiling the request of this thread, log it and add it to the totals of its endpoint
+
+    :return the QueryProfile, None if no request was profiled
+    """
+    profile = getattr(_state, "profile", None)
+    _state.profile = None
+    if profile is None:
+        return None
+    profile.total_ms = profile.elapsed_ms
+    repeated = profile.repeated
+    # requests with N+1 patterns stand out in the log
+    level = logging.WARNING if repeated else logging.INFO
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({"event": "request", **profile.serialize}))
+    with _lock:
+        _history.append(profile)
+        totals = _endpoints.setdefault(profile.endpoint, {
+            "requests": 0, "queries": 0, "max_queries": 0, "db_ms": 0.0, "ms": 0.0, "repeated": {}})
+        totals["requests"] += 1
+        totals["queries"] += profile.queries
+        totals["max_queries"] = max(totals["max_queries"], profile.queries)
+        totals["db_ms"] += profile.db_ms
+        totals["ms"] += profile.total_ms
+        for statement, count in repeated:
+            statement = statement[:_STATEMENT_LENGTH]
+            totals["repeated"][statement] = max(totals["repeated"].get(statement, 0), count)
+    return profile
+
+
+def profile_stats() -> dict:
+    """
+    Returns what the profiled requests did, for /debug/queries
+
+    :return dict with "endpoints": list of dicts of the totals and averages
+            of each endpoint, most queries per request first, and "recent":
+            the serialized profiles of the latest requests, newest first
+    """
+    with _lock:
+        endpoints = []
+        for endpoint, totals in _endpoints.items():
+            requests = totals["requests"]
+            endpoints.append({
+                "endpoint": endpoint,
+                "requests": requests,
+                "avg_queries": round(totals["queries"] / requests, 1),
+                "max_queries": totals["max_queries"],
+                "avg_db_ms": round(totals["db_ms"] / requests, 2),
+                "avg_ms": round(totals["ms"] / requests, 2),
+                "repeated": sorted(({"count": count, "statement": statement}
+                                    for statement, count in totals["repeated"].items()),
+                                   key=lambda item: -item["count"]),
+            })
+        recent = [profile.serialize for profile in reversed(_history)]
+    endpoints.sort(key=lambda item: -item["avg_queries"])
+    return {"endpoints": endpoints, "recent": recent}
+
+
+def reset_profile_stats():
+    """
+    Forget the totals and the recent requests shown by /debug/queries
+    """
+    with _lock:
+        _history.clear()
+        _endpoints.clear()
@@ -0,0 +1,121 @@
+###############################################################################
+# This file defines the full-text search indexes of resources, channels and
+# channel posts, and how to query them on each DB we support.
+#
+# On postgres every searchable table gets a generated tsvector column with a
+# GIN index; on sqlite (local runs) an external content FTS5 table kept in sync
+# by triggers. Both are created by a migration in DBMigration.py and kept
+# current by the DB itself on insert, update and delete.
+#
+# Use DBFunc.search() rather than the functions here directly.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import re
+
+from sqlalchemy import select, func, text, table, column, or_, literal
+
+# kind of searchable item -> (table, id column, searchable text columns by weight)
+SEARCH_SOURCES = {
+    "resource": ("resource", "rid", ("title", "description")),
+    "channel": ("channel", "cid", ("name", "description")),
+    "post": ("channel_post", "post_id", ("title", "init_text")),
+}
+SEARCH_KINDS = list(SEARCH_SOURCES)
+
+# postgres text search configuration used to build and query the tsvector columns
+TS_CONFIG = "english"
+
+# tsvector weights given to the text columns, in order
+TS_WEIGHTS = ("A", "B")
+
+
+def query_terms(query: str) -> list:
+    """
+    Split a user search string into terms, dropping any search operator syntax
+
+    :param query: The string typed in by the user
+    :return list of lowercase word terms
+    """
+    if not query:
+        return []
+    return re.findall(r"[^\W_]+", query.lower())
+
+
+def create_search_indexes(conn):
+    """
+    Create the full-text search index of every kind in SEARCH_SOURCES
+
+    :param conn: The connection to create indexes with
+    """
+    for kind in SEARCH_SOURCES:
+        if conn.dialect.name == "postgresql":
+            _create_tsvector_column(conn, kind)
+        elif conn.dialect.name == "sqlite":
+            _create_fts5_table(conn, kind)
+
+
+def _create_tsvector_column(conn, kind):
+    name, _, columns = SEARCH_SOURCES[kind]
+    document = " || ".join(
+        f"setweight(to_tsvector('{TS_CONFIG}', coalesce({c}, '')), '{w}')"
+        for c, w in zip(columns, TS_WEIGHTS))
+    conn.execute(text(f"ALTER TABLE {name} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                      f"GENERATED ALWAYS AS ({document}) STORED"))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{name}_search_vector "
+                      f"ON {name} USING gin (search_vector)"))
+
+
+def _create_fts5_table(conn, kind):
+    name, key, columns = SEARCH_SOURCES[kind]
+    fts = f"{name}_fts"
+    cols = ", ".join(columns)
+    new_values = ", ".join(f"new.{c}" for c in columns)
+    old_values = ", ".join(f"old.{c}" for c in columns)
+
+    conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, "
+                      f"content='{name}', content_rowid='{key}', tokenize='porter unicode61')"))
+    conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {name} BEGIN "
+                      f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.{key}, {new_values}); END"))
+    conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {name} BEGIN "
+                      f"INSERT INTO {fts}({fts}, rowid, {cols}) "
+                      f"VALUES ('delete', old.{key}, {old_values}); END"))
+    conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {cols} ON {name} "
+                      f"BEGIN "
+                      f"INSERT INTO {fts}({fts}, rowid, {cols}) "
+                      f"VALUES ('delete', old.{key}, {old_values}); "
+                      f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.{key}, {new_values}); END"))
+    # index the rows that already exist
+    conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+
+def match_query(dialect: str, kind: str, terms: list):
+    """
+    Returns the SELECT of items of a kind matching every term (as a word prefix)
+
+    :param dialect: The name of the DB dialect, e.g. conn.get_bind().dialect.name
+    :param kind: The kind of item, a key of SEARCH_SOURCES
+    :param terms: The terms from query_terms(), must not be empty
+    :return Select with columns "id" and "rank" (higher is more relevant)
+    """
+    name, key, columns = SEARCH_SOURCES[kind]
+
+    if dialect == "postgresql":
+        source = table(name, column(key), column("search_vector"))
+        ts_query = func.to_tsquery(TS_CONFIG, " & ".join(f"{t}:*" for t in terms))
+        return select(source.c[key].label("id"),
+                      func.ts_rank(source.c.search_vector, ts_query).label("rank")). \
+            where(source.c.search_vector.op("@@")(ts_query))
+
+    if dialect == "sqlite":
+        fts = table(f"{name}_fts", column("rowid"), column(f"{name}_fts"))
+        fts_query = " ".join(f'"{t}"*' for t in terms)
+        # bm25() is lower for better matches
+        return select(fts.c.rowid.label("id"),
+                      (-func.bm25(fts.c[f"{name}_fts"])).label("rank")). \
+            where(fts.c[f"{name}_fts"].op("MATCH")(fts_query))
+
+    # no full-text index on other DBs, fall back to substring matching
+    source = table(name, column(key), *[column(c) for c in columns])
+    matches = [or_(*[source.c[c].ilike(f"%{t}%") for c in columns]) for t in terms]
+    return select(source.c[key].label("id"), literal(1.0).label("rank")).where(*matches)
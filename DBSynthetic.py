@@ -0,0 +1,444 @@
+###############################################################################
+# This file generates synthetic datasets of any size for load testing.
+#
+# Unlike Dummies.py, which adds a handful of hand written users, resources and
+# channels through DBFunc.py, the rows here are generated table by table and
+# streamed into the bulk loader of DBBulk.py, so 1M rows load in minutes.
+#
+# Every row is a function of the seed and its own id only (each item draws
+# from a random generator seeded with the seed, its kind and its id), so the
+# same seed and sizes always give the same dataset, and the rows of a table
+# can be generated without keeping the rows of the other tables in memory.
+# How popular an item is (how many votes, views and comments it gets) follows
+# a Zipf distribution, as it does on the live site.
+#
+# Use load_synthetic() from benchmarks and tests, or `flask generate-data`.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import bisect
+import datetime
+import hmac
+import itertools
+import os
+import random
+
+import pytz
+
+from DBBulk import BULK_BATCH_SIZE, import_rows, rebuild_derived, write_rows
+from DBFunc import DEFAULT_USER_AVATAR_LINK, DEFAULT_PROFILE_BACKGROUND_LINK, DEFAULT_CHANNEL_AVATAR_LINK
+from DBStructure import User, UserTeachingAreas, Tag, Resource, ResourceCreater, \
+    PrivateResourcePersonnel, ResourceTagRecord, ResourceVoteInfo, ResourceView, ResourceComment, \
+    Channel, ChannelPersonnel, ChannelTagRecord, ChannelPost, ChannelPostVoteInfo, PostComment, \
+    PostCommentVoteInfo, ResourceDifficulty, Subject, Grade, ChannelVisibility
+
+# password of every generated user
+SYNTHETIC_PASSWORD = "123456"
+
+# generated items are created between these dates
+SYNTHETIC_START = datetime.datetime(2021, 1, 1, tzinfo=pytz.utc)
+SYNTHETIC_END = datetime.datetime(2023, 1, 1, tzinfo=pytz.utc)
+
+# sizes of the datasets benchmarks run at, by their approximate number of rows
+SYNTHETIC_SCALES = {
+    "10k": dict(users=500, resources=1000, channels=50, posts=1000, comments=2000,
+                votes=4000, views=1000, tags=50),
+    "100k": dict(users=5000, resources=10000, channels=500, posts=10000, comments=20000,
+                 votes=40000, views=10000, tags=200),
+    "1m": dict(users=50000, resources=100000, channels=5000, posts=100000, comments=200000,
+               votes=400000, views=100000, tags=1000),
+}
+
+# sentences the titles and texts are made of, shared with Dummies.py
+SENTENCES_PATH = "./static/files_for_testing/harvard-sentences.txt"
+
+_SUBJECTS = [e for e in Subject if e != Subject.NULL]
+_GRADES = [e for e in Grade if e != Grade.NULL]
+_PRIVATE_VISIBILITIES = [ChannelVisibility.INVITE_ONLY, ChannelVisibility.FULLY_PRIVATE]
+
+
+def _sentences() -> list:
+    with open(SENTENCES_PATH, "r") as fp:
+        return [line.rstrip("\n") for line in fp if line.strip() and not line.startswith("#")]
+
+
+def _split(total: int, sizes: list) -> list:
+    # share total between item kinds in proportion to their number of items
+    weight = sum(sizes) or 1
+    shares = [total * size // weight for size in sizes]
+    shares[0] += total - sum(shares)
+    return shares
+
+
+class SyntheticData:
+    """
+    A synthetic dataset, generated on demand
+
+    Comments are shared between resources and channel posts, and votes
+    between resources, posts and post comments, in proportion to their
+    numbers. Private resources and private channels only get votes, views,
+    posts and comments from their personnel.
+    """
+
+    def __init__(self, seed: int = 0, users: int = 100, resources: int = 200, channels: int = 10,
+                 posts: int = 200, comments: int = 400, votes: int = 800, views: int = 200,
+                 tags: int = 20, private_ratio: float = 0.1, zipf_exponent: float = 1.1,
+                 max_tags: int = 3, max_personnel: int = 20):
+        """
+        :param seed: The seed the whole dataset is generated from
+        :param users: The number of users
+        :param resources: The number of resources
+        :param channels: The number of channels
+        :param posts: The number of channel posts
+        :param comments: The number of resource comments and post comments together
+        :param votes: The number of votes on resources, posts and post comments together
+        :param views: The number of resource views
+        :param tags: The number of tags
+        :param private_ratio: The share of private resources and channels
+        :param zipf_exponent: How skewed popularity is, 0 for uniform
+        :param max_tags: The maximum number of tags of a resource or channel
+        :param max_personnel: The maximum number of users in the personnel of
+                              a private resource or channel
+        """
+        self.seed = seed
+        # posts need a channel
+        self.users, self.resources, self.channels, self.posts = users, resources, channels, \
+            posts if channels else 0
+        self.tags, self.private_ratio, self.zipf_exponent = tags, private_ratio, zipf_exponent
+        self.max_tags, self.max_personnel = max_tags, max_personnel
+        self.views = views
+        self.resource_comments, self.post_comments = _split(comments, [resources, self.posts])
+        # votes on post comments are shared before the number of comments per post is drawn,
+        # so that it does not depend on it
+        self.resource_votes, self.post_votes, self.comment_votes = \
+            _split(votes, [resources, self.posts, self.post_comments])
+        self.sentences = _sentences()
+        # what generate_password_hash(SYNTHETIC_PASSWORD, "sha256") gives, with a salt from the seed
+        salt = "%016x" % self._random("user", "salt").getrandbits(64)
+        self.hash_password = f"sha256${salt}$" + \
+            hmac.new(salt.encode(), SYNTHETIC_PASSWORD.encode(), "sha256").hexdigest()
+        self._weights = {}
+        self._channel_personnel = {}
+
+    def _random(self, kind: str, item_id, purpose: str = "") -> random.Random:
+        # generator of one item, so that an item is the same whatever else is generated
+        return random.Random(f"{self.seed}/{kind}/{item_id}/{purpose}")
+
+    def _zipf(self, kind: str, n: int):
+        """
+        Returns the popularity of the items of a kind
+
+        :return (list of item id - 1 -> weight, list of cumulated weights by id) the
+                weights of all items sum to 1, ranks are shuffled so that popular
+                items are spread over the ids
+        """
+        if kind not in self._weights:
+            ranks = list(range(1, n + 1))
+            self._random(kind, "ranks").shuffle(ranks)
+            weights = [rank ** -self.zipf_exponent for rank in ranks]
+            total = sum(weights) or 1
+            weights = [weight / total for weight in weights]
+            self._weights[kind] = (weights, list(itertools.accumulate(weights)))
+        return self._weights[kind]
+
+    def _count(self, kind: str, item_id: int, n: int, total: int, purpose: str, limit: int) -> int:
+        # number of events of an item, total events shared between n items by popularity
+        weights, _ = self._zipf(kind, n)
+        expected = total * weights[item_id - 1]
+        count = int(expected)
+        if self._random(kind, item_id, purpose).random() < expected - count:
+            count += 1
+        return min(count, limit)
+
+    def _pick(self, kind: str, n: int, rng: random.Random) -> int:
+        # id of an item drawn by popularity
+        _, cumulated = self._zipf(kind, n)
+        return min(bisect.bisect(cumulated, rng.random() * cumulated[-1]), n - 1) + 1
+
+    def _created_at(self, kind: str, item_id: int, n: int) -> datetime.datetime:
+        # items are created in the order of their ids
+        rng = self._random(kind, item_id, "time")
+        return SYNTHETIC_START + (SYNTHETIC_END - SYNTHETIC_START) * ((item_id - 1 + rng.random()) / n)
+
+    @staticmethod
+    def _later(after: datetime.datetime, rng: random.Random) -> datetime.datetime:
+        # time of a view, post or comment on something created at after
+        return after + (SYNTHETIC_END - after) * rng.random()
+
+    def _text(self, rng: random.Random, most: int = 5) -> str:
+        return " ".join(rng.sample(self.sentences, k=rng.randint(1, most)))
+
+    def _users(self, rng: random.Random, k: int, among: list = None) -> list:
+        # k distinct user ids, among a personnel if given
+        if among is not None:
+            return rng.sample(among, k=min(k, len(among)))
+        return rng.sample(range(1, self.users + 1), k=min(k, self.users))
+
+    # -----{ USERS AND TAGS }---
+
+    def user_rows(self):
+        for uid in range(1, self.users + 1):
+            rng = self._random("user", uid)
+            yield {"uid": uid, "username": f"{rng.choice(self.sentences).split()[0]} {uid}",
+                   "email": f"user{uid}@example.com", "hash_password": self.hash_password,
+                   "avatar_link": DEFAULT_USER_AVATAR_LINK, "profile_background_link": DEFAULT_PROFILE_BACKGROUND_LINK,
+                   "created_at": self._created_at("user", uid, self.users),
+                   "bio": self._text(rng, 3) if rng.random() < 0.5 else None}
+
+    def user_teaching_area_rows(self):
+        for uid in range(1, self.users + 1):
+            rng = self._random("user", uid, "areas")
+            for subject in rng.sample(_SUBJECTS, k=rng.randint(1, 3)):
+                yield {"uid": uid, "teaching_area": subject, "teaching_grade": None, "is_public": True}
+
+    def tag_rows(self):
+        for tag_id in range(1, self.tags + 1):
+            rng = self._random("tag", tag_id)
+            yield {"tag_id": tag_id, "tag_name": f"{rng.choice(self.sentences).split()[-1].strip('.')}_{tag_id}"}
+
+    def _tag_ids(self, kind: str, item_id: int) -> list:
+        # tags of an item, popular tags are on more items
+        if not self.tags:
+            return []
+        rng = self._random(kind, item_id, "tags")
+        return sorted({self._pick("tag", self.tags, rng) for _ in range(rng.randint(1, self.max_tags))})
+
+    # -----{ RESOURCES }---
+
+    def _resource(self, rid: int) -> dict:
+        # creater, privacy and personnel of a resource
+        rng = self._random("resource", rid, "people")
+        creater = rng.randint(1, self.users)
+        if rng.random() >= self.private_ratio:
+            return {"creater": creater, "personnel": None}
+        others = self._users(rng, rng.randint(0, self.max_personnel - 1))
+        return {"creater": creater, "personnel": sorted({creater, *others})}
+
+    def _resource_voters(self, rid: int, personnel) -> list:
+        count = self._count("resource", rid, self.resources, self.resource_votes, "votes",
+                            len(personnel) if personnel else self.users)
+        rng = self._random("resource", rid, "voters")
+        return [(uid, rng.random() < 0.8) for uid in self._users(rng, count, personnel)]
+
+    def resource_rows(self):
+        for rid in range(1, self.resources + 1):
+            rng = self._random("resource", rid)
+            personnel = self._resource(rid)["personnel"]
+            votes = self._resource_voters(rid, personnel)
+            upvotes = sum(upvote for _, upvote in votes)
+            yield {"rid": rid, "title": rng.choice(self.sentences),
+                   "resource_link": f"resource/synthetic_{rid}.pdf",
+                   "created_at": self._created_at("resource", rid, self.resources),
+                   "difficulty": rng.choice(list(ResourceDifficulty)), "subject": rng.choice(_SUBJECTS),
+                   "grade": rng.choice(_GRADES), "upvote_count": upvotes,
+                   "downvote_count": len(votes) - upvotes, "is_public": personnel is None,
+                   "description": self._text(rng)}
+
+    def resource_creater_rows(self):
+        for rid in range(1, self.resources + 1):
+            yield {"rid": rid, "uid": self._resource(rid)["creater"]}
+
+    def private_resource_personnel_rows(self):
+        for rid in range(1, self.resources + 1):
+            for uid in self._resource(rid)["personnel"] or ():
+                yield {"rid": rid, "uid": uid}
+
+    def resource_tag_record_rows(self):
+        for rid in range(1, self.resources + 1):
+            for tag_id in self._tag_ids("resource", rid):
+                yield {"rid": rid, "tag_id": tag_id}
+
+    def resource_vote_info_rows(self):
+        for rid in range(1, self.resources + 1):
+            for uid, upvote in self._resource_voters(rid, self._resource(rid)["personnel"]):
+                yield {"rid": rid, "uid": uid, "is_upvote": upvote}
+
+    def resource_view_rows(self):
+        for rid in range(1, self.resources + 1):
+            personnel = self._resource(rid)["personnel"]
+            count = self._count("resource", rid, self.resources, self.views, "views",
+                                len(personnel) if personnel else self.users)
+            rng = self._random("resource", rid, "viewers")
+            after = self._created_at("resource", rid, self.resources)
+            for uid in self._users(rng, count, personnel):
+                yield {"rid": rid, "uid": uid, "created_at": self._later(after, rng)}
+
+    def resource_comment_rows(self):
+        comment_id = 0
+        for rid in range(1, self.resources + 1):
+            personnel = self._resource(rid)["personnel"]
+            count = self._count("resource", rid, self.resources, self.resource_comments, "comments",
+                                self.resource_comments)
+            rng = self._random("resource", rid, "comments")
+            after = self._created_at("resource", rid, self.resources)
+            for _ in range(count):
+                comment_id += 1
+                yield {"resource_comment_id": comment_id, "rid": rid,
+                       "uid": self._users(rng, 1, personnel)[0], "comment": self._text(rng, 2),
+                       "created_at": self._later(after, rng)}
+
+    # -----{ CHANNELS }---
+
+    def _channel(self, cid: int) -> dict:
+        # admin, visibility and personnel of a channel
+        if cid not in self._channel_personnel:
+            rng = self._random("channel", cid, "people")
+            admin = rng.randint(1, self.users)
+            channel = {"admin": admin, "visibility": ChannelVisibility.PUBLIC, "personnel": None}
+            if rng.random() < self.private_ratio:
+                others = self._users(rng, rng.randint(0, self.max_personnel - 1))
+                channel.update(visibility=rng.choice(_PRIVATE_VISIBILITIES), personnel=sorted({admin, *others}))
+            self._channel_personnel[cid] = channel
+        return self._channel_personnel[cid]
+
+    def channel_rows(self):
+        for cid in range(1, self.channels + 1):
+            rng = self._random("channel", cid)
+            channel = self._channel(cid)
+            yield {"cid": cid, "name": f"{rng.choice(self.sentences).rstrip('.')} ({cid})",
+                   "created_at": self._created_at("channel", cid, self.channels),
+                   "subject": rng.choice(_SUBJECTS) if rng.random() < 0.5 else None,
+                   "grade": rng.choice(_GRADES) if rng.random() < 0.5 else None,
+                   "visibility": channel["visibility"], "admin_uid": channel["admin"],
+                   "description": self._text(rng, 3), "avatar_link": DEFAULT_CHANNEL_AVATAR_LINK}
+
+    def channel_personnel_rows(self):
+        for cid in range(1, self.channels + 1):
+            for uid in self._channel(cid)["personnel"] or ():
+                yield {"cid": cid, "uid": uid}
+
+    def channel_tag_record_rows(self):
+        for cid in range(1, self.channels + 1):
+            for tag_id in self._tag_ids("channel", cid):
+                yield {"cid": cid, "tag_id": tag_id}
+
+    def _post(self, post_id: int) -> dict:
+        # channel and poster of a post, popular channels get more posts
+        rng = self._random("post", post_id, "people")
+        cid = self._pick("channel", self.channels, rng)
+        personnel = self._channel(cid)["personnel"]
+        return {"cid": cid, "uid": self._users(rng, 1, personnel)[0], "personnel": personnel}
+
+    def _post_created_at(self, post_id: int, cid: int) -> datetime.datetime:
+        return self._later(self._created_at("channel", cid, self.channels), self._random("post", post_id, "time"))
+
+    def _voters(self, kind: str, item_id: int, n: int, total: int, personnel) -> list:
+        count = self._count(kind, item_id, n, total, "votes", len(personnel) if personnel else self.users)
+        rng = self._random(kind, item_id, "voters")
+        return [(uid, rng.random() < 0.7) for uid in self._users(rng, count, personnel)]
+
+    def _post_comment_count(self, post_id: int) -> int:
+        return self._count("post", post_id, self.posts, self.post_comments, "comments", self.post_comments)
+
+    def _post_comment_total(self) -> int:
+        # number of post comments generated, close to but not exactly self.post_comments
+        if "comment" not in self._weights:
+            self._zipf("comment", sum(self._post_comment_count(post_id) for post_id in range(1, self.posts + 1)))
+        return len(self._weights["comment"][0])
+
+    def _post_comments(self):
+        # (post comment id, post id, post) of every post comment, in id order
+        comment_id = 0
+        for post_id in range(1, self.posts + 1):
+            count = self._post_comment_count(post_id)
+            post = self._post(post_id) if count else None
+            for _ in range(count):
+                comment_id += 1
+                yield comment_id, post_id, post
+
+    def channel_post_rows(self):
+        for post_id in range(1, self.posts + 1):
+            rng = self._random("post", post_id)
+            post = self._post(post_id)
+            votes = self._voters("post", post_id, self.posts, self.post_votes, post["personnel"])
+            upvotes = sum(upvote for _, upvote in votes)
+            yield {"post_id": post_id, "uid": post["uid"], "cid": post["cid"], "title": rng.choice(self.sentences),
+                   "init_text": self._text(rng), "upvote_count": upvotes, "downvote_count": len(votes) - upvotes,
+                   "created_at": self._post_created_at(post_id, post["cid"])}
+
+    def channel_post_vote_info_rows(self):
+        for post_id in range(1, self.posts + 1):
+            for uid, upvote in self._voters("post", post_id, self.posts, self.post_votes,
+                                            self._post(post_id)["personnel"]):
+                yield {"post_id": post_id, "uid": uid, "is_upvote": upvote}
+
+    def post_comment_rows(self):
+        comments = self._post_comment_total()
+        for comment_id, post_id, post in self._post_comments():
+            rng = self._random("comment", comment_id)
+            votes = self._voters("comment", comment_id, comments, self.comment_votes, post["personnel"])
+            upvotes = sum(upvote for _, upvote in votes)
+            yield {"post_comment_id": comment_id, "post_id": post_id,
+                   "uid": self._users(rng, 1, post["personnel"])[0], "text": self._text(rng, 3),
+                   "upvote_count": upvotes, "downvote_count": len(votes) - upvotes,
+                   "created_at": self._later(self._post_created_at(post_id, post["cid"]), rng)}
+
+    def post_comment_vote_info_rows(self):
+        comments = self._post_comment_total()
+        for comment_id, _, post in self._post_comments():
+            for uid, upvote in self._voters("comment", comment_id, comments, self.comment_votes,
+                                            post["personnel"]):
+                yield {"post_comment_id": comment_id, "uid": uid, "is_upvote": upvote}
+
+    def tables(self):
+        """
+        Returns the rows of every generated table, referenced tables first
+
+        :return list of (Table, generator of dicts of column name -> value)
+        """
+        generators = [
+            (User, self.user_rows), (UserTeachingAreas, self.user_teaching_area_rows), (Tag, self.tag_rows),
+            (Resource, self.resource_rows), (ResourceCreater, self.resource_creater_rows),
+            (PrivateResourcePersonnel, self.private_resource_personnel_rows),
+            (ResourceTagRecord, self.resource_tag_record_rows), (ResourceVoteInfo, self.resource_vote_info_rows),
+            (ResourceView, self.resource_view_rows), (ResourceComment, self.resource_comment_rows),
+            (Channel, self.channel_rows), (ChannelPersonnel, self.channel_personnel_rows),
+            (ChannelTagRecord, self.channel_tag_record_rows), (ChannelPost, self.channel_post_rows),
+            (ChannelPostVoteInfo, self.channel_post_vote_info_rows), (PostComment, self.post_comment_rows),
+            (PostCommentVoteInfo, self.post_comment_vote_info_rows),
+        ]
+        return [(model.__table__, rows()) for model, rows in generators]
+
+
+def synthetic_data(scale: str = None, seed: int = 0, **sizes) -> SyntheticData:
+    """
+    Returns a synthetic dataset
+
+    :param scale: One of SYNTHETIC_SCALES, default to the defaults of SyntheticData
+    :param seed: The seed the dataset is generated from
+    :param sizes: Parameters of SyntheticData, overriding those of the scale
+    """
+    return SyntheticData(seed=seed, **{**SYNTHETIC_SCALES.get(scale, {}), **sizes})
+
+
+def load_synthetic(data: SyntheticData, bind=None, batch_size: int = BULK_BATCH_SIZE) -> list:
+    """
+    Load a synthetic dataset into a DB, through the bulk loader
+
+    The DB is expected to be migrated and empty.
+
+    :param data: The dataset, see synthetic_data()
+    :param bind: The engine of the DB, default to the shared engine
+    :param batch_size: The number of rows per transaction
+    :return list of reports of DBBulk.import_rows(), one per table
+    """
+    reports = [import_rows(table, rows, bind, batch_size) for table, rows in data.tables()]
+    rebuild_derived(bind)
+    return reports
+
+
+def write_synthetic(data: SyntheticData, directory: str, file_type: str = "jsonl") -> dict:
+    """
+    Write a synthetic dataset to bulk files, for `flask import-data`
+
+    :param data: The dataset, see synthetic_data()
+    :param directory: The directory of the files, created if missing
+    :param file_type: One of DBBulk.BULK_FORMATS
+    :return dict of file path -> number of rows written
+    """
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table, rows in data.tables():
+        path = os.path.join(directory, f"{table.name}.{file_type}")
+        counts[path] = write_rows(table, rows, path)
+    return counts
@@ -10,9 +10,8 @@ from random import choice, sample, randint
 from faker import Faker
 import pagan
 
-engine = create_engine(DBPATH)
-
-Session = sessionmaker(engine)
+# make sure all tables exist before adding dummies
+init_db()
 
 # instance to create random personal info
 random_person = Faker()
@@ -0,0 +1,273 @@
+###############################################################################
+# This script checks the query plans of the find_* functions of DBFunc.py
+# against a synthetic dataset (see DBSynthetic.py), to show that the indexes
+# declared in DBStructure.py are used.
+#
+# Each query is built the way the listing endpoints build it (one page of
+# CHECK_PAGE items) and explained by the DB: EXPLAIN QUERY PLAN on sqlite,
+# EXPLAIN on postgres. A query fails the check when its plan reads a table of
+# more than LARGE_TABLE_ROWS rows in full, rather than through an index or in
+# the order of the page. The script prints every plan with --verbose.
+#
+# It then counts the SQL statements of a few find_resources() calls, through
+# DBProfile.py, and compares them with the counts of the same calls on a new
+# sqlite DB of the --compare-scale dataset: the counts must not grow with the
+# data. The script exits with 1 if a query fails either check.
+#
+#   python QueryCheck.py
+#   python QueryCheck.py --db postgresql://... --verbose
+#
+# The trending sorts keep the items that have no trending score yet, ordering
+# by coalesce(score, TRENDING_MISSING_SCORE): no index has that order, so they
+# sort every listed item and are reported without failing the check.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+# tables with more rows than this must not be read in full
+LARGE_TABLE_ROWS = 1000
+
+# number of items a checked query returns, as a page of the listing endpoints
+CHECK_PAGE = 20
+
+# size of the dataset the statement counts are compared with, see SYNTHETIC_SCALES
+COMPARE_SCALE = "10k"
+
+# a table read in full, in the plan of each dialect
+_SQLITE_SCAN = re.compile(r"^SCAN (\w+)$")
+_POSTGRES_SCAN = re.compile(r"Seq Scan on \"?(\w+)\"?")
+
+
+def checked_queries(conn) -> list:
+    """
+    Build the queries of the find_* functions checked, on ids of the loaded dataset
+
+    :param conn: The Session() initiated
+    :return list of (name, Query, whether the query is sorted by an index)
+    """
+    from sqlalchemy import func
+    import DBFunc
+    from DBStructure import User, Tag, ChannelPost, ChannelPersonnel
+
+    cid, = conn.query(ChannelPost.cid).group_by(ChannelPost.cid).order_by(func.count().desc()).first()
+    uid, = conn.query(ChannelPersonnel.uid).order_by(ChannelPersonnel.uid).first()
+    email = conn.query(User.email).filter_by(uid=uid).scalar()
+    tag = conn.query(Tag.tag_name).order_by(Tag.tag_id).limit(1).scalar()
+
+    def resources(**kwargs):
+        return DBFunc.resource_search_query(conn, limit=CHECK_PAGE, **kwargs)
+
+    def channels(**kwargs):
+        return DBFunc.channel_search_query(conn, limit=CHECK_PAGE, **kwargs)
+
+    def posts(**kwargs):
+        return DBFunc.channel_post_search_query(conn, cid, limit=CHECK_PAGE, **kwargs)
+
+    return [
+        ("find_resources natural", resources(), True),
+        ("find_resources newest private", resources(sort_by="newest", email=email), True),
+        ("find_resources upvotes", resources(sort_by="upvotes"), True),
+        ("find_resources trending", resources(sort_by="trending"), False),
+        ("find_resources tag", resources(tags=[tag], email=email), True),
+        ("find_resources title", resources(title="red"), True),
+        ("find_channels", channels(), True),
+        ("find_channels trending", channels(sort_by_trending=True), False),
+        ("find_channels member", channels(is_public=False, caller_uid=uid), True),
+        ("find_channels admin", channels(is_public=False, admin_uid=uid), True),
+        ("find_channels name", channels(channel_name="the"), True),
+        ("find_channel_posts date", posts(with_stats=True), True),
+        ("find_channel_posts upvote", posts(sort_algo="upvote"), True),
+        ("find_channel_posts trending", posts(sort_algo="trending"), False),
+        ("find_channel_posts title", posts(title="red"), True),
+    ]
+
+
+def query_plan(conn, query) -> list:
+    """
+    Explain a query
+
+    :param conn: The Session() initiated
+    :param query: The Query to explain
+    :return list of the lines of its plan
+    """
+    dialect = conn.get_bind().dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    # the DBAPI cursor undoes the escaping of % by the compiler, once given parameters
+    cursor = conn.connection().connection.cursor()
+    try:
+        if dialect.name == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, ())
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute("EXPLAIN " + sql, ())
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def full_scans(plan: list, dialect: str, sizes: dict) -> list:
+    """
+    Find the large tables a plan reads in full
+
+    On sqlite a plain SCAN walks the table in rowid order, which only reads it
+    in full when the rows are sorted afterwards.
+
+    :param plan: The lines of the plan, see query_plan()
+    :param dialect: The name of the dialect of the DB
+    :param sizes: dict of table name -> number of rows
+    :return list of the names of the tables read in full
+    """
+    if dialect == "sqlite":
+        if not any(line.startswith("USE TEMP B-TREE FOR") for line in plan):
+            return []
+        scanned = [match.group(1) for match in map(_SQLITE_SCAN.match, plan) if match]
+    else:
+        scanned = [match.group(1) for line in plan for match in _POSTGRES_SCAN.finditer(line)]
+    return [table for table in scanned if sizes.get(table, 0) > LARGE_TABLE_ROWS]
+
+
+def find_resources_calls(conn) -> list:
+    """
+    Pick the find_resources() calls whose statements are counted, on ids of the loaded dataset
+
+    :param conn: The Session() initiated
+    :return list of (name, keyword arguments)
+    """
+    from DBStructure import User, Tag, PrivateResourcePersonnel
+
+    uid, = conn.query(PrivateResourcePersonnel.uid).order_by(PrivateResourcePersonnel.uid).first()
+    email = conn.query(User.email).filter_by(uid=uid).scalar()
+    tags = [name for name, in conn.query(Tag.tag_name).order_by(Tag.tag_id).limit(2)]
+
+    return [
+        ("all", {}),
+        ("all logged in", dict(email=email)),
+        ("newest page", dict(sort_by="newest", email=email, limit=CHECK_PAGE)),
+        ("trending page", dict(sort_by="trending", limit=CHECK_PAGE)),
+        ("tag", dict(tags=tags[:1], email=email)),
+        ("two tags upvotes", dict(tags=tags, sort_by="upvotes", email=email)),
+        ("title", dict(title="the", email=email)),
+    ]
+
+
+def count_statements(calls: list) -> dict:
+    """
+    Count the SQL statements of find_resources() calls
+
+    Each call is made once before it is counted, so that the caches it fills
+    are not counted.
+
+    :param calls: list of (name, keyword arguments), see find_resources_calls()
+    :return dict of name -> number of statements
+    """
+    from DBFunc import find_resources
+    from DBProfile import begin_profile, end_profile
+
+    counts = {}
+    for name, kwargs in calls:
+        find_resources(**kwargs)
+        begin_profile("find_resources " + name)
+        try:
+            find_resources(**kwargs)
+        finally:
+            profile = end_profile()
+        counts[name] = profile.queries
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the query plans of the find_* functions")
+    parser.add_argument("--db", help="URL of the DB to run against, default to a new sqlite DB")
+    parser.add_argument("--scale", default="100k", help="Size of the dataset generated, see SYNTHETIC_SCALES")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dataset")
+    parser.add_argument("--verbose", action="store_true", help="Print the plan of every query")
+    parser.add_argument("--compare-scale", default=COMPARE_SCALE,
+                        help="Size of the dataset the statement counts are compared with")
+    parser.add_argument("--counts", action="store_true",
+                        help="Only print the statement counts of find_resources(), as JSON")
+    args = parser.parse_args()
+
+    directory = None
+    if args.db is None:
+        directory = tempfile.mkdtemp(prefix="doctrina-querycheck-")
+        args.db = f"sqlite:///{os.path.join(directory, 'querycheck.db')}"
+    # the engine is created from these when DBStructure is first imported
+    os.environ["DOCTRINA_DBPATH"] = args.db
+    os.environ["QUERY_PROFILING"] = "true"
+    warnings.simplefilter("ignore")
+
+    from sqlalchemy import select, func, text
+    from DBMigration import migrate
+    from DBStructure import engine, Base, User
+    from DBFunc import Session
+    from DBSynthetic import synthetic_data, load_synthetic
+
+    results, counts = [], {}
+    try:
+        migrate()
+        with Session() as conn:
+            empty = conn.query(User.uid).first() is None
+        if empty:
+            start = time.perf_counter()
+            load_synthetic(synthetic_data(args.scale, args.seed))
+            print(f"loaded the {args.scale} dataset in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+        with Session() as conn:
+            calls = find_resources_calls(conn)
+            if not args.counts:
+                if engine.dialect.name == "postgresql":
+                    # plan on the statistics of the loaded rows, as autovacuum would
+                    conn.execute(text("ANALYZE"))
+                sizes = {name: conn.execute(select(func.count()).select_from(table)).scalar()
+                         for name, table in Base.metadata.tables.items()}
+                for name, query, indexed in checked_queries(conn):
+                    plan = query_plan(conn, query)
+                    results.append((name, plan, indexed, full_scans(plan, engine.dialect.name, sizes)))
+        counts = count_statements(calls)
+    finally:
+        engine.dispose()
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.counts:
+        print(json.dumps(counts))
+        return
+
+    # the same calls on a dataset of another size, in a process with its own engine
+    compared = json.loads(subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--scale", args.compare_scale, "--seed", str(args.seed),
+         "--counts"], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout)
+
+    failed = False
+    for name, plan, indexed, scans in results:
+        if not scans:
+            status = "ok"
+        elif indexed:
+            status = "FULL SCAN of " + ", ".join(scans)
+            failed = True
+        else:
+            status = "sorts in full (" + ", ".join(scans) + ")"
+        print(f"{name:36s} {status}")
+        if args.verbose or (scans and indexed):
+            print("    " + "\n    ".join(plan))
+    for name, count in counts.items():
+        status = "ok" if count == compared.get(name) else "GROWS WITH THE DATA"
+        failed = failed or status != "ok"
+        print(f"{'find_resources ' + name:36s} {count:3d} statements, {compared.get(name)} on the "
+              f"{args.compare_scale} dataset  {status}")
+    if failed:
+        sys.exit(1)
+    print("every indexed query uses an index, and no statement count grows with the data")
+
+
+if __name__ == "__main__":
+    main()
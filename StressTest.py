@@ -0,0 +1,276 @@
+###############################################################################
+# This script checks that concurrent writers keep the counters and derived
+# tables of DBFunc.py consistent, against a synthetic dataset (see
+# DBSynthetic.py).
+#
+# --threads threads each run --ops random votes, views, comments, comment
+# removals, resource changes and posts on a few hot items, so that they keep
+# contending for the same rows, while the first thread also refreshes every
+# trending score now and then. Afterwards the vote counts are compared with the vote info rows,
+# and the recommendation candidates, trending scores, channel stats and post
+# stats with a full recompute. The script exits with 1 if anything differs or
+# if a call raised instead of returning an ErrorCode.
+#
+#   python StressTest.py
+#   python StressTest.py --db postgresql://... --threads 24 --ops 80
+#
+# Run it against postgres to test the row locks. sqlite serializes writers and
+# its driver reads outside of transactions, so concurrent calls there fail with
+# "database is locked" or lose updates: on sqlite the threads default to 1,
+# which still checks every write path against a full recompute.
+#
+# works of OfficialTeamName (con.d). All rights reserved.
+###############################################################################
+import argparse
+import collections
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+import warnings
+
+# number of items of each kind the threads write to
+HOT_ITEMS = 3
+
+# default number of threads on postgres, a single one runs on sqlite
+STRESS_THREADS = 16
+
+# the first thread refreshes every trending score once per this many calls
+REFRESH_EVERY = 10
+
+# size of the dataset generated for a new sqlite DB, see SyntheticData
+STRESS_DATASET = {"users": 200, "resources": 100, "channels": 10, "posts": 100, "comments": 200,
+                  "votes": 500, "views": 100, "tags": 10}
+
+# calls made by the threads
+OPERATIONS = ["vote resource", "view resource", "comment resource", "remove resource comment",
+              "modify resource", "vote post", "vote post comment", "comment post", "remove post comment",
+              "post"]
+
+
+def hot_items() -> dict:
+    """
+    Pick the users and the items the threads write to
+
+    :return dict of kind -> list of ids
+    """
+    from DBFunc import Session
+    from DBStructure import User, Resource, Channel, ChannelPost
+
+    with Session() as conn:
+        cid = conn.query(Channel.cid).order_by(Channel.cid).limit(1).scalar()
+        if cid is None:
+            raise ValueError("the DB has no channels, load a dataset first")
+        return {
+            "uid": [uid for uid, in conn.query(User.uid).order_by(User.uid)],
+            "rid": [rid for rid, in conn.query(Resource.rid).order_by(Resource.rid).limit(HOT_ITEMS)],
+            "cid": cid,
+            "post": [post_id for post_id, in conn.query(ChannelPost.post_id).filter_by(cid=cid).
+                     order_by(ChannelPost.post_id).limit(HOT_ITEMS)],
+        }
+
+
+def _pick_comment(model, key, column, ids, rng):
+    # a comment on one of the hot items, None if they have none
+    from DBFunc import Session
+
+    with Session() as conn:
+        comments = [i for i, in conn.query(key).filter(column.in_(ids))]
+    return rng.choice(comments) if comments else None
+
+
+def _call(operation: str, hot: dict, rng: random.Random):
+    # run one operation on random hot items, returns its result
+    import DBFunc
+    from DBStructure import ResourceComment, PostComment, Subject
+
+    uid = rng.choice(hot["uid"])
+    if operation == "vote resource":
+        return DBFunc.vote_resource(uid, rng.choice(hot["rid"]), rng.random() < .5)
+    if operation == "view resource":
+        return DBFunc.user_viewed_resource(uid, rng.choice(hot["rid"]))
+    if operation == "comment resource":
+        return DBFunc.comment_to_resource(uid, rng.choice(hot["rid"]), "stress")
+    if operation == "remove resource comment":
+        comment = _pick_comment(ResourceComment, ResourceComment.resource_comment_id,
+                                ResourceComment.rid, hot["rid"], rng)
+        return DBFunc.remove_resource_comment(comment) if comment else None
+    if operation == "modify resource":
+        # moves the resource to other recommendation buckets
+        return DBFunc.modify_resource(rng.choice(hot["rid"]), subject=rng.choice(list(Subject)[:3]))
+    if operation == "vote post":
+        return DBFunc.vote_channel_post(uid, rng.choice(hot["post"]), rng.random() < .5)
+    if operation == "vote post comment":
+        comment = _pick_comment(PostComment, PostComment.post_comment_id, PostComment.post_id,
+                                hot["post"], rng)
+        return DBFunc.vote_channel_post_comment(uid, comment, rng.random() < .5) if comment else None
+    if operation == "comment post":
+        return DBFunc.comment_on_channel_post(uid, rng.choice(hot["post"]), "stress")
+    if operation == "remove post comment":
+        comment = _pick_comment(PostComment, PostComment.post_comment_id, PostComment.post_id,
+                                hot["post"], rng)
+        return DBFunc.remove_channel_post_comment(comment) if comment else None
+    return DBFunc.post_on_channel(hot["uid"][0], "stress", "stress", cid=hot["cid"])
+
+
+def run_stress(threads: int = 16, ops: int = 60, seed: int = 0) -> tuple:
+    """
+    Run random writes from several threads at once
+
+    :param threads: The number of threads
+    :param ops: The number of calls per thread
+    :param seed: The seed of the calls
+    :return tuple of form outcomes, exceptions: Counters of (operation, ErrorCode
+            name or "ok") and of (operation, exception line)
+    """
+    from DBFunc import ErrorCode, refresh_all_trending
+
+    hot = hot_items()
+    outcomes, exceptions = collections.Counter(), collections.Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def work(n):
+        rng = random.Random(f"{seed}/{n}")
+        barrier.wait()
+        for step in range(ops):
+            if n == 0 and step % REFRESH_EVERY == 0:
+                operation = "refresh trending"
+                result = None if refresh_all_trending() else ErrorCode.COMMIT_ERROR
+            else:
+                operation = rng.choice(OPERATIONS)
+                try:
+                    result = _call(operation, hot, rng)
+                except Exception as e:
+                    with lock:
+                        exceptions[operation, traceback.format_exception_only(type(e), e)[0].strip()[:200]] += 1
+                    continue
+            with lock:
+                outcomes[operation, result.name if isinstance(result, ErrorCode) else "ok"] += 1
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return outcomes, exceptions
+
+
+def _comparable(row: dict) -> dict:
+    # sqlite drops the timezone of stored times, the recomputed ones may keep it
+    return {name: value.replace(tzinfo=None) if isinstance(value, datetime.datetime) else value
+            for name, value in row.items()}
+
+
+def _differences(name: str, stored: list, expected: list, key: tuple) -> list:
+    # compare stored rows with recomputed ones, on the columns recomputed
+    stored = {tuple(row[k] for k in key): _comparable(row) for row in stored}
+    expected = {tuple(row[k] for k in key): _comparable(row) for row in expected}
+    lines = []
+    for item in sorted(set(stored) | set(expected)):
+        want = expected.get(item)
+        got = stored.get(item)
+        if want is None or got is None or any(got[column] != value for column, value in want.items()):
+            lines.append(f"{name} {item}: stored {got}, expected {want}")
+    return lines
+
+
+def check_consistency() -> list:
+    """
+    Compare the counters and derived tables with the rows they are derived from
+
+    :return list of the differences found, as readable lines
+    """
+    from sqlalchemy import select, func
+    import DBFunc
+    from DBFunc import Session
+    from DBStructure import Resource, ResourceVoteInfo, ChannelPost, ChannelPostVoteInfo, PostComment, \
+        PostCommentVoteInfo, RecommendationCandidate, TrendingScore, ChannelStats, PostStats
+
+    def table_rows(conn, model):
+        return [dict(row._mapping) for row in conn.execute(select(model.__table__))]
+
+    lines = []
+    with Session() as conn:
+        for model, vote_model, key in [(Resource, ResourceVoteInfo, "rid"),
+                                       (ChannelPost, ChannelPostVoteInfo, "post_id"),
+                                       (PostComment, PostCommentVoteInfo, "post_comment_id")]:
+            votes = collections.Counter()
+            for item_id, upvote, count in conn.execute(
+                    select(getattr(vote_model, key), vote_model.is_upvote, func.count()).
+                    group_by(getattr(vote_model, key), vote_model.is_upvote)):
+                votes[item_id, upvote] = count
+            stored = [dict(item_id=item_id, up=up, down=down) for item_id, up, down in
+                      conn.execute(select(getattr(model, key), model.upvote_count, model.downvote_count))]
+            expected = [dict(item_id=row["item_id"], up=votes[row["item_id"], True],
+                             down=votes[row["item_id"], False]) for row in stored]
+            lines += _differences(f"{model.__tablename__} votes", stored, expected, ("item_id",))
+
+        lines += _differences("recommendation", table_rows(conn, RecommendationCandidate),
+                              DBFunc._resource_candidate_rows(conn) + DBFunc._channel_candidate_rows(conn),
+                              ("bucket", "kind", "item_id"))
+        lines += _differences("trending", table_rows(conn, TrendingScore),
+                              [row for kind in DBFunc.TRENDING_KEYS for row in DBFunc._trending_rows(conn, kind)],
+                              ("kind", "item_id"))
+        lines += _differences("channel stats", table_rows(conn, ChannelStats),
+                              DBFunc._channel_stats_rows(conn), ("cid",))
+        lines += _differences("post stats", table_rows(conn, PostStats),
+                              DBFunc._post_stats_rows(conn), ("post_id",))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check DBFunc.py under concurrent writes")
+    parser.add_argument("--db", help="URL of the DB to run against, default to a new sqlite DB")
+    parser.add_argument("--threads", type=int,
+                        help=f"Number of concurrent threads, default to {STRESS_THREADS} (1 on sqlite)")
+    parser.add_argument("--ops", type=int, default=60, help="Calls per thread")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dataset and of the calls")
+    args = parser.parse_args()
+
+    directory = None
+    if args.db is None:
+        directory = tempfile.mkdtemp(prefix="doctrina-stress-")
+        args.db = f"sqlite:///{os.path.join(directory, 'stress.db')}"
+    if args.threads is None:
+        args.threads = 1 if args.db.startswith("sqlite") else STRESS_THREADS
+    # the engine is created from these when DBStructure is first imported
+    os.environ["DOCTRINA_DBPATH"] = args.db
+    os.environ.setdefault("DB_POOL_SIZE", str(args.threads))
+    warnings.simplefilter("ignore")
+
+    from DBMigration import migrate
+    from DBStructure import engine, User
+    from DBFunc import Session
+    from DBSynthetic import synthetic_data, load_synthetic
+
+    try:
+        migrate()
+        with Session() as conn:
+            empty = conn.query(User.uid).first() is None
+        if empty:
+            load_synthetic(synthetic_data(seed=args.seed, **STRESS_DATASET))
+        outcomes, exceptions = run_stress(args.threads, args.ops, args.seed)
+        differences = check_consistency()
+    finally:
+        engine.dispose()
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for (operation, outcome), count in sorted(outcomes.items()):
+        print(f"{operation:24s} {outcome:16s} {count:6d}")
+    for (operation, line), count in exceptions.most_common():
+        print(f"EXCEPTION {operation}: {line} ({count} times)")
+    for line in differences:
+        print(f"MISMATCH {line}")
+    if exceptions or differences:
+        sys.exit(1)
+    print("all counts and derived tables match")
+
+
+if __name__ == "__main__":
+    main()
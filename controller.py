@@ -4,20 +4,32 @@
 #
 # works of OfficialTeamName (con.d). All rights reserved.
 ##################################################################################
-from flask import Flask, request, render_template, redirect, url_for, abort, flash, Response, jsonify
+from flask import Flask, request, render_template, redirect, url_for, abort, flash, Response, jsonify, \
+    stream_with_context, g, session, make_response
+from flask import json as flask_json
 from sqlalchemy.sql.expression import func
 import os
 import json
-import random
 import warnings
 import os
 import posixpath
+import time
+import functools
+import hashlib
 from flask_login import LoginManager, login_required, login_user, logout_user, current_user, AnonymousUserMixin
 from werkzeug.security import check_password_hash
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import HTTPException, InternalServerError
 from re import search as re_search
+import click
 from DBFunc import *
+from DBIngest import INGEST_ENABLED, start_ingestion, submit_vote, submit_view
+from DBBulk import BULK_BATCH_SIZE, BULK_FORMATS, import_files, export_tables
+from DBSynthetic import SYNTHETIC_SCALES, synthetic_data, load_synthetic, write_synthetic
+from DBProfile import begin_profile, current_profile, end_profile, profile_stats, reset_profile_stats
+from DBMetrics import METRICS_ENABLED, CONTENT_TYPE, exposition, http_requests, http_request_duration, \
+    upload_bytes, upload_duration
+from DBCache import response_backend, response_key, get_response, store_response
 from forms import LoginForm, RegisterForm, ResourceForm
 
 # -----{ INIT }----------------------------------------------------------------
@@ -39,6 +51,26 @@ app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
 app.config['MAX_CONTENT_PATH'] = 50  # 50 chars long
 
+# largest page a client can request from a paginated listing
+MAX_PAGE_LIMIT = 500
+
+# comments shown per page of a channel post
+POST_COMMENT_PAGE_SIZE = 100
+
+# seconds the votes, views and trending order of a listing answered with a 304
+# may be behind, they do not change the data versions its ETag is derived from
+LISTING_COUNTS_MAX_AGE = int(os.environ.get("LISTING_COUNTS_MAX_AGE", 10))
+
+if INGEST_ENABLED:
+    # votes and views are queued and written in batches
+    start_ingestion()
+
+
+def is_ingested(uid) -> bool:
+    """Whether the votes and views of a user are written behind through DBIngest,
+    only registered users have any"""
+    return INGEST_ENABLED and uid > 0
+
 
 # -----{ LOGIN }---------------------------------------------------------------
 
@@ -143,6 +175,303 @@ def load_user(user_id):
     return get_user(user_id)
 
 
+# -----{ PROFILING }-----------------------------------------------------------
+
+
+@app.before_request
+def start_query_profile():
+    """Count and time the DB statements of this request, see DBProfile.py"""
+    begin_profile(request.endpoint, request.method, request.path)
+
+
+@app.after_request
+def add_server_timing(response):
+    """Report the DB time and statements of this request in the Server-Timing header"""
+    profile = current_profile()
+    if profile is not None:
+        profile.status = response.status_code
+        response.headers.add("Server-Timing", f'db;dur={profile.db_ms:.2f};desc="{profile.queries} queries"')
+        response.headers.add("Server-Timing", f"app;dur={profile.elapsed_ms:.2f}")
+    return response
+
+
+@app.teardown_request
+def finish_query_profile(exc=None):
+    """Log the statements of this request and add them to the totals of /debug/queries"""
+    end_profile()
+
+
+# -----{ METRICS }-------------------------------------------------------------
+#
+# Request counts and latencies per endpoint, DB pool, write and cache metrics
+# are served at /metrics for Prometheus, see DBMetrics.py
+
+
+@app.before_request
+def start_request_timer():
+    """Note when this request started, for the latency histogram of /metrics"""
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def count_request(response):
+    """Count this request and its latency per endpoint"""
+    started = g.get("request_started")
+    if METRICS_ENABLED and started is not None:
+        endpoint = request.endpoint or "none"
+        http_requests.inc(endpoint, request.method, str(response.status_code))
+        http_request_duration.observe(time.perf_counter() - started, endpoint, request.method)
+    return response
+
+
+def save_upload(file, path: str):
+    """Save an uploaded file, counting its size and the time taken per endpoint in /metrics
+
+    :param file: The FileStorage from request.files
+    :param path: Where to save the file
+    """
+    started = time.perf_counter()
+    file.save(path)
+    upload_duration.observe(time.perf_counter() - started, request.endpoint)
+    upload_bytes.observe(os.path.getsize(path), request.endpoint)
+
+
+@app.route('/metrics')
+def metrics():
+    """The metrics of this process in the Prometheus text format"""
+    if not METRICS_ENABLED:
+        abort(404)
+    return Response(exposition(), content_type=CONTENT_TYPE)
+
+
+# -----{ DB SESSION }----------------------------------------------------------
+
+
+@app.before_request
+def open_request_session():
+    """Let all DB calls of this request share one session and connection"""
+    begin_request_session()
+
+
+@app.teardown_request
+def close_request_session(exc=None):
+    """Return the connection of this request to the pool"""
+    end_request_session()
+
+
+# -----{ RESPONSE CACHE }------------------------------------------------------
+#
+# Anonymous and demo users get the same response to the same request, the
+# views decorated with cached_for_anonymous serve them from the response cache
+# (see DBCache.py) with an ETag, so browsers revalidate and get a 304 when
+# nothing changed.
+
+
+def response_user_class():
+    """Returns the kind of user whose responses are shared, None for a registered user
+
+    Read from the session, current_user would load a registered user from the DB
+    """
+    user_id = session.get("_user_id")
+    if user_id is None:
+        return "anonymous"
+    if DEMO and user_id == "demo":
+        return "demo"
+    return None
+
+
+def cached_for_anonymous(view):
+    """
+    Serve the responses of a view to anonymous and demo users from the response cache
+
+    Only complete 200 responses are cached. Streamed responses and pages
+    showing flashed messages are always rendered.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if response_backend is None or request.method != "GET" \
+                or request.args.get('stream') or session.get("_flashes"):
+            return view(*args, **kwargs)
+        user_class = response_user_class()
+        if user_class is None:
+            return view(*args, **kwargs)
+
+        key = response_key(request.path, [[name, value] for name, value in request.args.items(multi=True)],
+                           user_class, get_response_version())
+        cached = get_response(key)
+        if cached is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            headers = [[name, value] for name, value in response.headers if name != "Content-Length"]
+            cached = store_response(key, response.status_code, headers, response.get_data())
+
+        response = Response(cached.body, status=cached.status, headers=[tuple(i) for i in cached.headers])
+        return set_validator(response, cached.etag).make_conditional(request)
+
+    return wrapper
+
+
+def set_validator(response, etag: str):
+    """Set the ETag of a response, which browsers keep but revalidate before every use
+
+    :return the response
+    """
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+# -----{ CONDITIONAL GET }-----------------------------------------------------
+#
+# The listings decorated with conditional_listing send an ETag derived from the
+# versions of the kinds of data they show (see DBFunc.DATA_KINDS), which every
+# write bumps except votes, views and trending scores. Those change the ETag
+# every LISTING_COUNTS_MAX_AGE seconds instead. A request whose If-None-Match
+# holds the current ETag is answered with a 304 before the listing is queried,
+# so clients polling an unchanged listing cost one small query. Responses
+# served from the response cache carry the ETag of their body instead.
+
+
+def listing_etag(kinds, viewer=None) -> str:
+    """
+    Returns the ETag of the listing requested, from the versions of its data
+
+    :param kinds: The kinds of data the listing shows, see DBFunc.DATA_KINDS
+    :param viewer: see conditional_listing()
+    """
+    user_id = session.get("_user_id")
+    uid = None
+    if viewer == "current_user":
+        uid = current_user.uid if user_id is not None else None
+    elif viewer:
+        uid = request.args.get(viewer, type=int)
+    access = None
+    if uid is not None and uid > 0:
+        # the private items a user sees are cached apart from the data versions
+        access = get_access_set(uid)
+        access = [sorted(access.rids), sorted(access.cids)]
+    # counts are not versioned, they show up once the period changes
+    period = int(time.time() // LISTING_COUNTS_MAX_AGE)
+    raw = flask_json.dumps([request.full_path, user_id, get_data_versions(kinds), access, period])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def conditional_listing(*kinds, viewer=None, unless=None):
+    """
+    Answer If-None-Match with a 304 while the data of a listing is unchanged
+
+    :param kinds: The kinds of data the listing shows, see DBFunc.DATA_KINDS
+    :param viewer: Whose access to private items the listing depends on:
+                   "current_user", the name of the query argument holding the
+                   uid, or None if it is the same for everyone
+    :param unless: A query argument making the request write, such requests
+                   are always answered in full
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if unless and unless in request.args:
+                return view(*args, **kwargs)
+            # read before the listing, so a write in between makes the ETag stale, not the body
+            etag = listing_etag(kinds, viewer)
+            if request.if_none_match.contains(etag):
+                return set_validator(Response(status=304), etag)
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_validator(response, etag)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+# -----{ PAGINATION }----------------------------------------------------------
+#
+# Listing endpoints accept ?limit=N&after=<cursor> for keyset pagination. The
+# cursor of the next page is returned in the X-Next-Cursor header so the body
+# stays a plain JSON array. ?stream=json or ?stream=ndjson streams the body.
+# Comment threads are listed newest first and take ?before=<cursor> instead.
+# Channel post pages show POST_COMMENT_PAGE_SIZE comments, oldest first, and
+# link to the next ones with ?after=<cursor>.
+
+
+def get_page_limit():
+    """Returns the page size requested with ?limit=, None if the request is not paginated"""
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return None
+    if limit <= 0:
+        abort(400, description="limit must be a positive integer")
+    return min(limit, MAX_PAGE_LIMIT)
+
+
+def get_page_after(decoder, *args):
+    """
+    Returns the decoded ?after= cursor, None if the first page is requested
+
+    :param decoder: The DBFunc cursor decoder of the listing, e.g. decode_resource_cursor
+    :param args: The sort arguments passed on to the decoder
+    """
+    cursor = request.args.get('after')
+    if not cursor:
+        return None
+    after = decoder(cursor, *args)
+    if after is None:
+        abort(400, description="Invalid page cursor")
+    return after
+
+
+def json_list_response(items, next_cursor=None):
+    """
+    Respond with items as a JSON array
+
+    With ?stream=json the array is written element by element and with
+    ?stream=ndjson one JSON document is written per line, so items can be a
+    generator that is consumed while the response is sent.
+
+    :param items: An iterable of JSON serializable objects
+    :param next_cursor: The cursor of the next page, if any
+    """
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    stream = request.args.get('stream')
+
+    if stream == "ndjson":
+        def generate():
+            for item in items:
+                yield flask_json.dumps(item) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                        headers=headers)
+    elif stream == "json":
+        def generate():
+            yield "["
+            for i, item in enumerate(items):
+                yield ("," if i else "") + flask_json.dumps(item)
+            yield "]"
+
+        return Response(stream_with_context(generate()), mimetype="application/json",
+                        headers=headers)
+
+    response = jsonify(list(items))
+    response.headers.extend(headers)
+    return response
+
+
+# -----{ FORMS }---------------------------------------------------------------
+
+
+def get_form_tag_ids():
+    """Returns the ids of the tags checked in the submitted form"""
+    tag_map = get_tags()
+    return [tag_map[t] for t in request.form if t == request.form.get(t) and t in tag_map]
+
+
 # -----{ PAGES }---------------------------------------------------------------
 #
 # This section contains the different landing pages for the web page
@@ -176,69 +505,26 @@ def home():
 
 
 @app.route('/AJAX/homeAJAX')
+@cached_for_anonymous
 def homeAJAX():
     """The endpoint for the AJAX search for resources using a get request
     returns it in json format
     """
     areas = get_user_teaching_areas(current_user.uid)
-    grades = [ta.grade for ta in areas if ta.grade is not None]
-    subjects = [ta.teaching_area for ta in areas if ta.teaching_area is not None]
-
-    resources = [dict(r.serialize, author=get_resource_author(r.rid)[0].serialize, tags=get_resource_tags(r.rid),
-                      banner=get_resource_thumbnail(r.rid).serialize if get_resource_thumbnail(
-                          r.rid) != ErrorCode.INVALID_RESOURCE else {'thumbnail_link': 'img/placeholder.png'}) for l in
-                 [find_resources(email=current_user.email, grade=g) for g in grades] for r in l]
-    resources += [dict(r.serialize, author=get_resource_author(r.rid)[0].serialize, tags=get_resource_tags(r.rid),
-                       banner=get_resource_thumbnail(r.rid).serialize if get_resource_thumbnail(
-                           r.rid) != ErrorCode.INVALID_RESOURCE else {'thumbnail_link': 'img/placeholder.png'}) for l in
-                  [find_resources(email=current_user.email, subject=s) for s in subjects] for r in l]
-    a = []
-    b = []
-    for r in resources:
-        if r['rid'] not in b:
-            a.append(r)
-            b.append(r['rid'])
-    resources = a
-    if len(resources) < 3:
-        rec = [dict(r.serialize, author=get_resource_author(r.rid)[0].serialize, tags=get_resource_tags(r.rid),
-                    banner=get_resource_thumbnail(r.rid).serialize if get_resource_thumbnail(
-                        r.rid) != ErrorCode.INVALID_RESOURCE else {'thumbnail_link': 'img/placeholder.png'}) for r in
-               find_resources()]
-        while len(resources) != 3:
-            random.shuffle(rec)
-            if rec[0]['rid'] in b:
-                continue
-            resources += [rec[0]]
-            b.append(rec[0]['rid'])
-
-    elif len(resources) > 3:
-        resources = resources[:3]
-
-    channels = []
-    channels = [dict(r.serialize, admin=get_user_and_resource_instance(r.admin_uid, -1)[0].serialize,
-                     posts=len(get_channel_post(r.cid))) for l in
-                [find_channels(caller_uid=current_user.uid, grade=g) for g in grades] for r in l]
-    channels += [dict(r.serialize, admin=get_user_and_resource_instance(r.admin_uid, -1)[0].serialize,
-                      posts=len(get_channel_post(r.cid))) for l in
-                 [find_channels(caller_uid=current_user.uid, subject=s) for s in subjects] for r in l]
-    a = []
-    b = []
-    for r in channels:
-        if r['cid'] not in b:
-            a.append(r)
-            b.append(r['cid'])
-    channels = a
-    if len(channels) < 2:
-        cen = [dict(r.serialize, admin=get_user_and_resource_instance(r.admin_uid, -1)[0].serialize,
-                    posts=len(get_channel_post(r.cid))) for r in find_channels()]
-        while len(channels) != 2:
-            random.shuffle(cen)
-            if cen[0]['cid'] in b:
-                continue
-            channels += [cen[0]]
-            b.append(cen[0]['cid'])
-    elif len(channels) > 2:
-        channels = channels[:2]
+    buckets = [b for ta in areas for b in
+               recommendation_buckets(subject=ta.teaching_area, grade=ta.grade, with_all=False)]
+
+    # best candidates of the user's teaching areas, topped up with the best overall
+    rids = get_recommendations(current_user.uid, "resource", buckets, 3)
+    rids += get_recommendations(current_user.uid, "resource", [RECOMMEND_ALL_BUCKET],
+                                3 - len(rids), exclude=rids)
+    resources = load_resource_cards(rids)
+
+    cids = get_recommendations(current_user.uid, "channel", buckets, 2)
+    cids += get_recommendations(current_user.uid, "channel", [RECOMMEND_ALL_BUCKET],
+                                2 - len(cids), exclude=cids)
+    channels = load_channel_cards(cids)
+
     results = {
         "resources": resources,
         "channels": channels
@@ -385,6 +671,9 @@ def resource(rid=None):
               description=f"You ({current_user.username}) do not have permission to access the resource : {res.title}" +
                           "\nIf you think this is incorrect contact the resource owner")
 
+    if is_ingested(uid):
+        submit_view(uid, rid)
+
     if res.resource_link.startswith('resource/'):
         res.resource_link = url_for('static', filename=res.resource_link)
 
@@ -450,7 +739,7 @@ def resource_new():
                                 get_user(email) != ErrorCode.INVALID_USER]
         is_public = len(private_personnel_id) == 0
 
-        tags_id = [get_tags()[t] for t in request.form if t == request.form.get(t) and t in get_tags(t)]
+        tags_id = get_form_tag_ids()
         description = form.description.data
 
         if resource_url == "":
@@ -459,7 +748,7 @@ def resource_new():
                 root, ext = os.path.splitext(resource_link)
                 resource_link = root + '_' + str(i) + ext
                 i += 1
-            resource_file.save(os.path.join(app.config['UPLOAD_FOLDER'], 'resource', secure_filename(resource_link)))
+            save_upload(resource_file, os.path.join(app.config['UPLOAD_FOLDER'], 'resource', secure_filename(resource_link)))
 
         i = 0
         while os.path.isfile(
@@ -468,8 +757,8 @@ def resource_new():
             resource_thumbnail_links = root + '_' + str(i) + ext
             i += 1
 
-        resource_thumbnail_file.save(
-            os.path.join(app.config['UPLOAD_FOLDER'], 'thumbnail', secure_filename(resource_thumbnail_links)))
+        save_upload(resource_thumbnail_file,
+                    os.path.join(app.config['UPLOAD_FOLDER'], 'thumbnail', secure_filename(resource_thumbnail_links)))
 
         if resource_url == "":
             rid = add_resource(title, os.path.join('resource', secure_filename(resource_link)), difficulty, subject,
@@ -571,13 +860,13 @@ def resource_edit(rid=None):
         grade = website_input_to_enum(request.form.get('grades'), Grade)
         description = form.description.data
         is_public = True if request.form.get("visibility_choice") == 'Public' else False
-        tags_id = [get_tags()[t] for t in request.form if t == request.form.get(t) and t in get_tags(t)]
+        tags_id = get_form_tag_ids()
 
         thumbnail_path = None
         if resource_thumbnail_file and resource_thumbnail_file.filename != "":
             thumbnail_path = posixpath.join("thumbnail", secure_filename(
                 resource_thumbnail_file.filename))
-            resource_thumbnail_file.save(posixpath.join(
+            save_upload(resource_thumbnail_file, posixpath.join(
                 app.config['UPLOAD_FOLDER'], thumbnail_path))
         thumbnail_path = [thumbnail_path] if thumbnail_path else []
 
@@ -602,6 +891,8 @@ def resource_edit(rid=None):
 # -----{ PAGES.RESOURCE.AJAX }-------------------------------------------------
 
 @app.route('/AJAX/resourceAJAX')
+@cached_for_anonymous
+@conditional_listing("resource", viewer="current_user")
 def resourceAJAX():
     """The endpoint for the AJAX search for resources using a get request
     returns it in json format
@@ -612,6 +903,8 @@ def resourceAJAX():
     tags = request.args.getlist('tags[]') if 'tags[]' in request.args else None
     tags = list(filter(lambda x: x != '', tags)) if tags is not None else None
     sort = request.args.get('sort') if 'sort' in request.args else "natural"
+    if sort not in RESOURCE_SORT_MODES:
+        sort = "natural"
     try:
         subject = Subject[subject]
     except KeyError:
@@ -622,11 +915,28 @@ def resourceAJAX():
         year = None
     if title == '':
         title = None
-    return jsonify([dict(i.serialize, tags=get_resource_tags(i.rid),
-                         banner=get_resource_thumbnail(i.rid).serialize if get_resource_thumbnail(
-                             i.rid) != ErrorCode.INVALID_RESOURCE else {'thumbnail_link': 'img/placeholder.png'}) for i
-                    in find_resources(title=title, subject=subject, grade=year, tags=tags, sort_by=sort,
-                                      email=current_user.email)])
+
+    limit = get_page_limit()
+    if title is not None and sort == "natural":
+        # best matches first, relevance ranked results are not paginated: every
+        # match is returned unless the request asks for a limit
+        hits = search(title, kinds=["resource"], user=current_user, limit=limit,
+                      subject=subject, grade=year, tags=tags)["resource"]
+        return json_list_response(load_resource_cards([i.rid for i, _ in hits], with_author=False))
+
+    filters = dict(title_type="fulltext", title=title, subject=subject, grade=year, tags=tags,
+                   sort_by=sort, email=current_user.email,
+                   after=get_page_after(decode_resource_cursor, sort))
+    if limit is None and request.args.get('stream'):
+        # unbounded stream: read and hydrate the result set batch by batch
+        return json_list_response(iter_resource_cards(iter_resources(**filters), with_author=False))
+
+    resources = find_resources(limit=limit, **filters)
+    next_cursor = None
+    if limit and len(resources) == limit:
+        next_cursor = resource_page_cursor(resources[-1], sort)
+    return json_list_response(load_resource_cards([i.rid for i in resources], with_author=False),
+                              next_cursor)
 
 
 @app.route('/AJAX/resourceVote')
@@ -641,22 +951,30 @@ def resourceVote():
         abort(404)
     if up is None or down is None:
         abort(404)
+    if is_ingested(current_user.uid) and rid.isdigit():
+        # answer with the counts the vote will lead to, it is written later
+        counts = submit_vote("resource", current_user.uid, int(rid), upvote=up == '1')
+        if isinstance(counts, ErrorCode):
+            abort(404)
+        return jsonify({'up': counts[0], 'down': counts[1]})
     vote_res = vote_resource(uid=current_user.uid, rid=rid, upvote=up == '1')
-    _, res = get_user_and_resource_instance(-1, rid)
-    if res is None:
+    with Session() as conn:
+        counts = conn.query(Resource.upvote_count, Resource.downvote_count).filter_by(rid=rid).one_or_none()
+    if counts is None:
         abort(404)
     return jsonify({
-        'up': res.upvote_count,
-        'down': res.downvote_count
+        'up': counts.upvote_count,
+        'down': counts.downvote_count
     })
 
 
 @app.route('/AJAX/resourceComment')
+@conditional_listing("resource_comment", unless="type")
 def resourceComment():
     """The endpoint for the AJAX search for resource comments a get request
     returns it in json format
     """
-    rid = request.args.get('rid') if 'rid' in request.args else None
+    rid = request.args.get('rid', type=int)
     if rid is None:
         abort(404)
     postType = request.args.get('type') if 'type' in request.args else None
@@ -679,27 +997,56 @@ def resourceComment():
         else:
             abort(404)
 
-    # individual resource page
-    _, res = get_user_and_resource_instance(uid=-1, rid=rid)
-    comms = get_resource_comments(res.rid)
+    # individual resource page, newest comments first. ?limit=N&before=<cursor>
+    # loads the thread a page at a time, the cursor of the older comments is
+    # returned in the X-Next-Cursor header
+    limit = get_page_limit()
+    before = None
+    if request.args.get('before'):
+        before = decode_comment_cursor(request.args.get('before'))
+        if before is None:
+            abort(400, description="Invalid page cursor")
+    comms, replies, authors = load_comment_thread(rid, limit, before)
+    if not comms and is_resource_public(rid) == ErrorCode.INVALID_RESOURCE:
+        abort(404)
+
+    def author(uid):
+        user = authors.get(uid)
+        return user.serialize if user else None
+
     comments = []
     for comment in comms:
-        replies = get_resource_comment_replies([comment])
-        rep = []
-        if comment in replies:
-            for reply in replies[comment]:
-                rep.append({
-                    "reply": reply.serialize,
-                    "author": get_user_and_resource_instance(reply.uid, -1)[0].serialize
-                })
-
         comments.append({
             "comment": comment.serialize,
             "resource_comment_id": comment.resource_comment_id,
-            "replies": rep,
-            "author": get_user_and_resource_instance(comment.uid, -1)[0].serialize
+            "replies": [{"reply": reply.serialize, "author": author(reply.uid)}
+                        for reply in replies.get(comment.resource_comment_id, [])],
+            "author": author(comment.uid)
         })
-    return jsonify(comments[::-1])
+    next_cursor = None
+    if limit and len(comms) == limit:
+        next_cursor = comment_page_cursor(comms[-1])
+    return json_list_response(comments, next_cursor)
+
+
+# -----{ PAGES.SEARCH.AJAX }---------------------------------------------------
+
+@app.route('/AJAX/searchAJAX')
+def searchAJAX():
+    """The endpoint for the AJAX full-text search of resources, channels and posts
+    the current user has access to, best match first. returns it in json format
+    """
+    query = request.args.get('q') if 'q' in request.args else None
+    kinds = request.args.getlist('kinds[]') if 'kinds[]' in request.args else None
+    limit = get_page_limit()
+    if not query:
+        abort(400, description="Nothing to search for")
+
+    hits = search(query, kinds=kinds, user=current_user, limit=limit or SEARCH_LIMIT)
+    out = {}
+    for kind, items in hits.items():
+        out[kind] = [dict(item.serialize, score=float(score)) for item, score in items]
+    return jsonify(out)
 
 
 # -----{ PAGES.PROFILE }-------------------------------------------------------
@@ -741,6 +1088,7 @@ def profile(uid=None):
 
 
 @app.route("/profile/studio_contents", methods=["GET"])
+@conditional_listing("resource", "channel", viewer="uid")
 def load_studio_contents():
     """
     Load the entries for user edit studio. Entries here can be channel or resource
@@ -778,39 +1126,35 @@ def load_studio_contents():
     out = []
     if is_resource:
         # deal with resource
-        qualified_ids = []
         with Session() as conn:
+            created_ids = {t[0] for t in conn.query(ResourceCreater.rid).filter_by(uid=uid)}
             if is_create:
                 # resources created by user
-                for temp in conn.query(ResourceCreater).filter_by(uid=uid).all():
-                    qualified_ids.append(temp.rid)
+                qualified_ids = created_ids
             else:
                 # resources user has access to
-                for temp in conn.query(PrivateResourcePersonnel).filter_by(uid=uid).all():
-                    qualified_ids.append(temp.rid)
-            res = conn.query(Resource).filter(Resource.rid.in_(qualified_ids))
-        if title:
-            res = res.filter(Resource.title.ilike(f"%{title}%"))
-        if sort_algo == "ascending":
-            res = res.order_by(Resource.created_at.asc()).all()
-        else:
-            res = res.order_by(Resource.created_at.desc()).all()
-        for item in res:
-            info = item.serialize
+                qualified_ids = get_access_set(uid).rids
+            res = conn.query(Resource.rid).filter(Resource.rid.in_(qualified_ids))
+            if title:
+                res = res.filter(Resource.title.ilike(f"%{title}%"))
+            if sort_algo == "ascending":
+                res = res.order_by(Resource.created_at.asc())
+            else:
+                res = res.order_by(Resource.created_at.desc())
+            rids = [t[0] for t in res.all()]
 
-            with Session() as conn:
-                creater = conn.query(ResourceCreater).filter_by(rid=item.rid, uid=uid).first()
+        for info in load_resource_cards(rids, with_author=False):
+            del info["tags"]
+            banner = info.pop("banner")
 
-            if not creater:
+            if info["rid"] not in created_ids:
                 # fill manage link to null
                 info["manage_link"] = None
             else:
-                info["manage_link"] = url_for("resource_edit", rid=item.rid)
+                info["manage_link"] = url_for("resource_edit", rid=info["rid"])
 
-            info["avatar_link"] = get_resource_thumbnail(item.rid).serialize["thumbnail_link"] \
-                if get_resource_thumbnail(item.rid) != ErrorCode.INVALID_RESOURCE \
-                else 'img/placeholder.png'
-            info["view_link"] = url_for("resource", rid=item.rid)
+            info["avatar_link"] = banner["thumbnail_link"]
+            info["view_link"] = url_for("resource", rid=info["rid"])
             info["is_public"] = "Public" if info["is_public"] else "Private"
 
             out.append(info)
@@ -885,13 +1229,13 @@ def settings():
         avatar_path, profile_background_path = "NULL", "NULL"
         if avatar and avatar.filename != "":
             avatar_path = os.path.join("avatar", secure_filename(avatar.filename))
-            avatar.save(os.path.join("static", avatar_path))
+            save_upload(avatar, os.path.join("static", avatar_path))
 
         if profile_background and profile_background.filename != "":
             profile_background_path = os.path.join("profile_background",
                                                    secure_filename(
                                                        profile_background.filename))
-            profile_background.save(os.path.join("static", profile_background_path))
+            save_upload(profile_background, os.path.join("static", profile_background_path))
 
         user, _ = get_user_and_resource_instance(uid=current_user.uid, rid=-1)
 
@@ -916,6 +1260,7 @@ def settings():
 # -----{ PAGES.GENERIC }-------------------------------------------------------
 
 @app.route('/about')
+@cached_for_anonymous
 def about():
     """A brief page descibing what the website is about"""
     # FAQs can contain html code to run on page
@@ -1047,7 +1392,7 @@ def create_or_modify_channel(cid=None):
         thumbnail_path = None
         if thumbnail.filename != "":
             thumbnail_path = posixpath.join("channel_avatar", secure_filename(thumbnail.filename))
-            thumbnail.save(posixpath.join("static", thumbnail_path))
+            save_upload(thumbnail, posixpath.join("static", thumbnail_path))
 
         visibility = website_input_to_enum(readable_string=visibility,
                                            enum_class=ChannelVisibility)
@@ -1056,7 +1401,7 @@ def create_or_modify_channel(cid=None):
 
         grade = website_input_to_enum(readable_string=grade, enum_class=Grade)
 
-        tags_id = [get_tags()[t] for t in request.form if t == request.form.get(t) and t in get_tags(t)]
+        tags_id = get_form_tag_ids()
 
         # convert personnel emails to personnel ids
         personnel_ids = []
@@ -1142,6 +1487,8 @@ def view_channel(cid=None):
 
 
 @app.route('/search/channel')
+@cached_for_anonymous
+@conditional_listing("channel", viewer="uid")
 def search_channel():
     """
     Returns json object of all qualified channels
@@ -1150,56 +1497,62 @@ def search_channel():
     is_public = request.args.get("is_public")
     is_public = True if (is_public == 'true' or is_public is True) else False
     sort_by_date = True if request.args.get("sort_by_date") == "newest" else False
+    # channels are listed by trending score unless sorted by date
+    sort_by_trending = not sort_by_date
     uid = int(request.args.get("uid"))
     tags = request.args.getlist('tags[]') if 'tags[]' in request.args else None
     tags = list(filter(lambda x: x != '', tags)) if tags is not None else None
-    tags = [get_tags()[t] for t in tags if t in get_tags()] if tags is not None else None
+    tag_map = get_tags()
+    tags = [tag_map[t] for t in tags if t in tag_map] if tags is not None else None
     subject = request.args.get('subject').upper() if 'subject' in request.args else None
     year = request.args.get('year').upper() if 'year' in request.args else None
 
-    out = []
+    limit = get_page_limit()
+    filters = dict(title_type="fulltext", channel_name=name, is_public=is_public,
+                   sort_by_newest_date=sort_by_date, sort_by_trending=sort_by_trending,
+                   tag_ids=tags, subject=subject, grade=year,
+                   after=get_page_after(decode_channel_cursor, sort_by_date, sort_by_trending))
+    if uid != -2:
+        with Session() as conn:
+            if not conn.query(User.uid).filter_by(uid=uid).first():
+                # unknown user does not have access to any channel
+                return json_list_response([])
+        # only return channels this user has access to
+        filters["caller_uid"] = uid
 
-    with Session() as conn:
-        for i in find_channels(channel_name=name, is_public=is_public,
-                               sort_by_newest_date=sort_by_date, tag_ids=tags, subject=subject, grade=year):
-            if uid != -2 and not user_has_access_to_channel(uid=uid, cid=i.cid):
-                # user does not have access to channel
-                continue
-            info = i.serialize
+    # post statistics and tags are read with the channels, see ChannelStats
+    filters["with_stats"] = True
 
-            # assign tag names of this channel
-            info["all_tags"] = get_all_tags_for_channel(cid=i.cid)
+    def channel_infos(rows):
+        for channel, stats in rows:
+            info = channel.serialize
 
-            posts = conn.query(ChannelPost).filter_by(cid=i.cid)
+            # assign tag names of this channel
+            info["all_tags"] = channel_tag_names(channel, stats.tags if stats else [])
 
-            post_count = posts.count()
+            # most recent post time (in local time) and poster's username
+            info["most_recent_post_time"] = dump_datetime(stats.last_post_at) if stats else None
+            info["recent_poster_username"] = stats.last_poster_username if stats else None
+            info["post_count"] = stats.post_count if stats else 0
 
-            recent_post_time, poster_name = None, None
-            if post_count != 0:
-                # get most recent post time and poster's username
-                most_recent_post = posts.order_by(ChannelPost.created_at.desc()).first()
-                recent_post_time = most_recent_post.created_at
-                # change to local time
-                recent_post_time = dump_datetime(recent_post_time)
-                poster_name = conn.query(User).filter_by(
-                    uid=most_recent_post.uid).first().username
+            yield info
 
-            info["most_recent_post_time"] = recent_post_time
-            info["recent_poster_username"] = poster_name
-            info["post_count"] = post_count
-            # info["channel_tags"] = channel_tags
+    if limit is None and request.args.get('stream'):
+        # unbounded stream: read channels batch by batch
+        return json_list_response(channel_infos(iter_channels(**filters)))
 
-            out.append(info)
-    if not sort_by_date:
-        # trending mode: fake a trend by shuffle
-        random.shuffle(out)
-    return jsonify(out)
+    rows = find_channels(limit=limit, **filters)
+    next_cursor = None
+    if limit and len(rows) == limit:
+        next_cursor = channel_page_cursor(rows[-1][0], sort_by_date, sort_by_trending)
+    return json_list_response(list(channel_infos(rows)), next_cursor)
 
 
 # --------------------------{ PAGES.CHANNEL_POST }---------------------------------------
 
 
 @app.route("/search/channel/<cid>/post")
+@conditional_listing("post")
 def search_channel_post(cid=None):
     """
     Returns json object of posts of a specific channel
@@ -1207,46 +1560,39 @@ def search_channel_post(cid=None):
     title = request.args.get("title")
     sort_algo = request.args.get("sort_algo").lower()
     cid = int(cid)
-
-    out = []
     if sort_algo == "newest":
-        posts = find_channel_posts(cid=cid, title=title, sort_algo='date')
-    else:
-        posts = find_channel_posts(cid=cid, title=title, sort_algo="upvote")
+        sort_algo = "date"
+    elif sort_algo != "trending":
+        sort_algo = "upvote"
 
-    with Session() as conn:
-        for i in posts:
-            info = i.serialize
-
-            poster = conn.query(User).filter_by(uid=i.uid).first()
-            poster_avatar_link = poster.avatar_link
-            poster_username = poster.username
-
-            post_comments = get_channel_post_comments(post_id=i.post_id)
-            comments_count = len(post_comments)
-
-            recent_comment_time, recent_commenter_name = None, None
-            if comments_count != 0:
-                most_recent_comment = conn.query(PostComment).filter_by(post_id=i.post_id). \
-                    order_by(PostComment.created_at.desc()).first()
-                recent_comment_time = most_recent_comment.created_at
-                # convert to local time
-                recent_comment_time = \
-                    recent_comment_time.astimezone(pytz.timezone("Australia/Brisbane")). \
-                        strftime("%d/%m/%Y, %H:%M:%S")
-                recent_commenter_name = conn.query(User). \
-                    filter_by(uid=most_recent_comment.uid).first().username
-            info["comment_count"] = comments_count
-            info["recent_comment_time"] = recent_comment_time
-            info["recent_commenter_name"] = recent_commenter_name
-            info["poster_avatar_link"] = url_for("static", filename=poster_avatar_link)
-            info["poster_username"] = poster_username
-            out.append(info)
+    limit = get_page_limit()
+    # the poster and comment statistics are read with the posts, see PostStats
+    rows = find_channel_posts(cid=cid, title=title, title_type="fulltext", sort_algo=sort_algo,
+                              limit=limit, after=get_page_after(decode_channel_post_cursor, sort_algo),
+                              with_stats=True)
 
-    if sort_algo == "trending":
-        # shuffle output to fake trending
-        random.shuffle(out)
-    return jsonify(out)
+    out = []
+    for post, poster, stats in rows:
+        info = post.serialize
+
+        recent_comment_time, recent_commenter_name = None, None
+        if stats and stats.comment_count:
+            # convert to local time
+            recent_comment_time = \
+                stats.last_comment_at.astimezone(pytz.timezone("Australia/Brisbane")). \
+                    strftime("%d/%m/%Y, %H:%M:%S")
+            recent_commenter_name = stats.last_commenter_username
+        info["comment_count"] = stats.comment_count if stats else 0
+        info["recent_comment_time"] = recent_comment_time
+        info["recent_commenter_name"] = recent_commenter_name
+        info["poster_avatar_link"] = url_for("static", filename=poster.avatar_link)
+        info["poster_username"] = poster.username
+        out.append(info)
+
+    next_cursor = None
+    if limit and len(rows) == limit:
+        next_cursor = channel_post_page_cursor(rows[-1][0], sort_algo)
+    return json_list_response(out, next_cursor)
 
 
 @app.route('/channel/<cid>/post/<post_id>')
@@ -1271,39 +1617,40 @@ def view_channel_post(cid=None, post_id=None):
         flash("You do not have permission to visit this page")
         return redirect(url_for("view_channel"))
 
-    with Session() as conn:
-        post = conn.query(ChannelPost).filter_by(post_id=post_id).one_or_none()
-        channel = conn.query(Channel).filter_by(cid=cid).one_or_none()
-        if not post or not channel:
-            # post or channel does not exist, go back to current channel page
-            flash("Post does not exists")
-            return redirect(url_for("view_channel", cid=cid))
-
-        # info of a post, include all items of a post and author's name
-        post_info = post.serialize
-        # get author of this post
-        author = conn.query(User).filter_by(uid=post.uid).first()
-        post_info["username"] = author.username + " (Author)"
-        post_info["author_avatar_link"] = author.avatar_link
-
-    # list of all post comments info, each element is a dict including all attributes
+    # comments are shown POST_COMMENT_PAGE_SIZE at a time, ?after=<cursor> shows the next ones
+    limit = get_page_limit() or POST_COMMENT_PAGE_SIZE
+    page = load_post_page(cid, post_id, limit, get_page_after(decode_post_comment_cursor))
+    if page is None:
+        # post does not exist in this channel, go back to current channel page
+        flash("Post does not exists")
+        return redirect(url_for("view_channel", cid=cid))
+    post, channel, author = page.post, page.channel, page.author
+
+    # info of a post, include all items of a post and author's name
+    post_info = post.serialize
+    post_info["username"] = author.username + " (Author)"
+    post_info["author_avatar_link"] = author.avatar_link
+
+    # list of post comments info, each element is a dict including all attributes
     # of a post comment as well as the username and link to user avatar of the commenter
     post_comments_info = []
-    # get list of all comments related to that post
-    post_comments = get_channel_post_comments(post_id=post_id)
-    for i in post_comments:
-        commenter = conn.query(User).filter_by(uid=i.uid).first()
+    for i in page.comments:
+        commenter = page.commenters[i.uid]
         comment_info = i.serialize
         comment_info["username"] = commenter.username + " (Author)" \
-            if commenter.username == author.username else commenter.username
+            if commenter.uid == author.uid else commenter.username
         comment_info["commenter_avatar_link"] = commenter.avatar_link
         post_comments_info.append(comment_info)
+    next_comments = None
+    if len(page.comments) == limit:
+        next_comments = post_comment_page_cursor(page.comments[-1])
 
     # check if current user is admin of the channel or owner of this post
     has_edit_privilege = post.uid == current_user.uid or channel.admin_uid == current_user.uid
 
     return render_template("post.html", title=f"Channel Post #{post.post_id}",
                            post_info=post_info, comments_info=post_comments_info,
+                           next_comments=next_comments,
                            has_edit_privilege=has_edit_privilege, channel=channel,
                            current_user=current_user)
 
@@ -1385,6 +1732,17 @@ def vote_channel_post_or_comment():
     is_upvote = True if request.args.get("upvote") == "true" else False
     post_or_comment = request.args.get("post_or_comment")
 
+    if is_ingested(voter_id):
+        # answer with the counts the vote will lead to, it is written later
+        counts = submit_vote("post" if post_or_comment == "post" else "comment",
+                             voter_id, post_id_or_comment_id, upvote=is_upvote)
+        if isinstance(counts, ErrorCode):
+            abort(404)
+        return jsonify({
+            "upvote_count": counts[0],
+            "downvote_count": counts[1]
+        })
+
     if post_or_comment == "post":
         # vote a channel post
         vote_res = vote_channel_post(uid=voter_id, post_id=post_id_or_comment_id, upvote=is_upvote)
@@ -1432,15 +1790,25 @@ def add_new_post_comment(cid=None, post_id=None):
 # -----{ PAGES.DEBUG }---------------------------------------------------------
 
 @app.route('/debug')
+@app.route('/debug/queries')
 def debug():
-    """A debugging page
+    """A debugging page showing the DB statements run by each endpoint
     not to be used in production
+
+    ?error=<code> renders the error page of that code instead, ?reset=1 clears the totals
     """
+    if not DEBUG:
+        abort(404)
     error = request.args.get('error') if 'error' in request.args else None
     if error is not None:
         abort(int(error))
-
-    return render_template('debug.html', title='DEBUG', variable=f"{1}")
+    if request.args.get('reset'):
+        reset_profile_stats()
+        return redirect(url_for('debug'))
+    stats = profile_stats()
+    if request.args.get('format') == 'json':
+        return jsonify(stats)
+    return render_template('debug.html', title='DEBUG', stats=stats)
 
 
 # -----{ ERRORS }--------------------------------------------------------------
@@ -1484,3 +1852,58 @@ def defaults():
                 subjects=[e.name.lower() for e in Subject if e.name != "NULL"],
                 grades=[e.name.lower() for e in Grade if e.name != "NULL"],
                 tags=[e.replace(' ', '_') for e in get_tags().keys()])
+
+
+# -----{ COMMANDS }------------------------------------------------------------
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Bring the DB schema up to date by running the pending migrations of DBMigration.py"""
+    init_db()
+
+
+@app.cli.command("refresh-trending")
+def refresh_trending_command():
+    """Recompute every trending score, for running from cron instead of in process"""
+    refresh_all_trending()
+
+
+@app.cli.command("import-data")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--batch-size", default=BULK_BATCH_SIZE, show_default=True, help="Rows per transaction")
+@click.option("--no-rebuild", is_flag=True, help="Do not rebuild trending scores and recommendations")
+def import_data_command(paths, batch_size, no_rebuild):
+    """Bulk load .jsonl/.csv files named after their table, or directories of them"""
+    for report in import_files(list(paths), batch_size=batch_size, rebuild=not no_rebuild):
+        click.echo(f"{report['file']}: {report['inserted']} inserted, {report['rejected']} rejected")
+        for error in report["errors"]:
+            click.echo(f"  {error}")
+
+
+@app.cli.command("export-data")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--format", "file_type", type=click.Choice(BULK_FORMATS), default="jsonl", show_default=True)
+@click.option("--table", "tables", multiple=True, help="Table to export, default to all")
+def export_data_command(directory, file_type, tables):
+    """Write every table to a file named after it, which import-data loads back"""
+    for path, count in export_tables(directory, file_type, list(tables) or None).items():
+        click.echo(f"{path}: {count} rows")
+
+
+@app.cli.command("generate-data")
+@click.option("--scale", type=click.Choice(SYNTHETIC_SCALES), default="10k", show_default=True)
+@click.option("--seed", default=0, show_default=True)
+@click.option("--output", type=click.Path(file_okay=False), help="Write bulk files there instead of loading the DB")
+@click.option("--format", "file_type", type=click.Choice(BULK_FORMATS), default="jsonl", show_default=True)
+def generate_data_command(scale, seed, output, file_type):
+    """Load a synthetic dataset into the (empty) DB, or write it to bulk files"""
+    data = synthetic_data(scale, seed)
+    if output:
+        for path, count in write_synthetic(data, output, file_type).items():
+            click.echo(f"{path}: {count} rows")
+        return
+    for report in load_synthetic(data):
+        click.echo(f"{report['table']}: {report['inserted']} inserted, {report['rejected']} rejected")
+        for error in report["errors"]:
+            click.echo(f"  {error}")